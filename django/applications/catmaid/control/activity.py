@@ -0,0 +1,112 @@
+""" Access to the number of treenodes and connectors users created or edited
+last and to the number of their reviews over time.
+
+The activity_rollup table counts these events per project, user and half
+hour. It is kept up to date by triggers on the treenode, connector and review
+tables. For edited treenodes and connectors it also stores their creator.
+Time ranges that don't start or end at a full half hour are completed with
+the raw events of the partial half hours at their ends.
+"""
+
+from django.db import connection
+
+
+# The table, user, creator and time column each activity is counted from
+ACTIVITIES = {
+    'treenode_created': ('treenode', 'user_id', 'user_id', 'creation_time'),
+    'treenode_edited': ('treenode', 'editor_id', 'user_id', 'edition_time'),
+    'connector_created': ('connector', 'user_id', 'user_id', 'creation_time'),
+    'connector_edited': ('connector', 'editor_id', 'user_id', 'edition_time'),
+    'review': ('review', 'reviewer_id', 'reviewer_id', 'review_time'),
+}
+
+# SQL expressions for the start of the interval an event at time t falls into
+INTERVALS = {
+    'halfhour': 'activity_bucket(t)',
+    'hour': "date_trunc('hour', t)",
+    'day': "date_trunc('day', t)",
+}
+
+# The first full half hour at or after the start and the last one that starts
+# at or before the end of a time range.
+_FIRST_BUCKET = "to_timestamp(ceil(extract(epoch FROM " \
+        "%(start_date)s::timestamptz) / 1800) * 1800)"
+_LAST_BUCKET = "activity_bucket(%(end_date)s::timestamptz)"
+
+
+def get_activity_counts(activity, group_by=('user_id',), project_id=None,
+        user_id=None, start_date=None, end_date=None, interval=None,
+        edited_by_other=False):
+    """ Returns a list of rows with the values of the <group_by> columns
+    (user_id and creator_id), the start of the interval, if one of 'halfhour',
+    'hour' or 'day' is passed as <interval>, and the number of events.
+    Events can be limited to a project, a user and a time range, which
+    includes its end points. With <edited_by_other>, only treenodes and
+    connectors that were edited last by another user than their creator are
+    counted.
+    """
+    table, user_column, creator_column, time_column = ACTIVITIES[activity]
+    params = {
+        'activity': activity,
+        'project_id': project_id,
+        'user_id': user_id,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+
+    rollup_conditions = ["activity = %(activity)s"]
+    raw_conditions = []
+    if project_id is not None:
+        rollup_conditions.append("project_id = %(project_id)s")
+        raw_conditions.append("project_id = %(project_id)s")
+    if user_id is not None:
+        rollup_conditions.append("user_id = %(user_id)s")
+        raw_conditions.append("%s = %%(user_id)s" % user_column)
+
+    # Full half hours are read from the rollup table, the partial ones at the
+    # ends of the time range from the raw data.
+    if start_date is not None:
+        rollup_conditions.append("bucket >= " + _FIRST_BUCKET)
+    if end_date is not None:
+        rollup_conditions.append("bucket < " + _LAST_BUCKET)
+    if start_date is not None and end_date is not None:
+        raw_conditions.append("%s BETWEEN %%(start_date)s AND %%(end_date)s "
+                "AND (%s < %s OR %s >= %s)" % (time_column, time_column,
+                    _FIRST_BUCKET, time_column, _LAST_BUCKET))
+    elif start_date is not None:
+        raw_conditions.append("%s >= %%(start_date)s AND %s < %s" % (
+                time_column, time_column, _FIRST_BUCKET))
+    elif end_date is not None:
+        raw_conditions.append("%s >= %s AND %s <= %%(end_date)s" % (
+                time_column, _LAST_BUCKET, time_column))
+
+    query = '''
+    SELECT user_id, creator_id, bucket AS t, count AS n
+    FROM activity_rollup
+    WHERE %s
+    ''' % ' AND '.join(rollup_conditions)
+    if start_date is not None or end_date is not None:
+        query += '''
+        UNION ALL
+        SELECT %s AS user_id, %s AS creator_id, %s AS t, 1 AS n
+        FROM %s
+        WHERE %s
+        ''' % (user_column, creator_column, time_column, table,
+                ' AND '.join(raw_conditions))
+
+    columns = list(group_by)
+    if interval:
+        columns.append(INTERVALS[interval])
+    query = '''
+    SELECT %s, sum(n)
+    FROM (%s) events
+    %s
+    GROUP BY %s
+    ORDER BY %s
+    ''' % (', '.join(columns), query,
+            'WHERE user_id <> creator_id' if edited_by_other else '',
+            ', '.join(columns), ', '.join(columns))
+
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    return cursor.fetchall()
@@ -9,13 +9,14 @@ from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.synapse_edges import get_downstream_partners, \
+        get_upstream_partners
 from catmaid.models import UserRole
 
 @requires_user_role(UserRole.Browse)
 def analyze_skeletons(request, project_id=None):
     project_id = int(project_id)
     skids = [int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids[')]
-    s_skids = ",".join(map(str, skids))
     extra = int(request.POST.get('extra', 0))
     adjacents = int(request.POST.get('adjacents', 0))
 
@@ -24,34 +25,36 @@ def analyze_skeletons(request, project_id=None):
 
     cursor = connection.cursor()
 
-    query = '''
-        SELECT tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2,
-             relation r1,
-             relation r2
-        WHERE tc1.skeleton_id IN (%s)
-          AND tc1.relation_id = r1.id
-          AND %s
-          AND tc1.connector_id = tc2.connector_id
-          AND tc2.relation_id = r2.id
-          AND %s
-        GROUP BY tc2.skeleton_id'''
+    def partners(partners_by_skeleton):
+        return set(partner for c in partners_by_skeleton.itervalues() for partner in c)
 
     if 0 == extra:
         # Just skids
         pass
     elif 1 == extra:
         # Include downstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'presynaptic_to'", "r2.relation_name = 'postsynaptic_to'"))
-        skids.extend([s[0] for s in cursor.fetchall()])
+        skids.extend(partners(get_downstream_partners(skids, cursor)))
     elif 2 == extra:
         # Include upstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'postsynaptic_to'", "r2.relation_name = 'presynaptic_to'"))
-        skids.extend([s[0] for s in cursor.fetchall()])
+        skids.extend(partners(get_upstream_partners(skids, cursor)))
     elif 3 == extra:
-        # Include both upstream and downstream skeletons
-        cursor.execute(query % (s_skids, "(r1.relation_name = 'presynaptic_to' OR r1.relation_name = 'postsynaptic_to')", "(r2.relation_name = 'presynaptic_to' OR r2.relation_name = 'postsynaptic_to')"))
+        # Include all skeletons that share a connector with skids, also
+        # those that are presynaptic or postsynaptic alongside them. These
+        # aren't synapse edges and can't come from the edge table.
+        cursor.execute('''
+        SELECT tc2.skeleton_id
+        FROM treenode_connector tc1,
+             treenode_connector tc2,
+             relation r1,
+             relation r2
+        WHERE tc1.skeleton_id IN (%s)
+          AND tc1.relation_id = r1.id
+          AND (r1.relation_name = 'presynaptic_to' OR r1.relation_name = 'postsynaptic_to')
+          AND tc1.connector_id = tc2.connector_id
+          AND tc2.relation_id = r2.id
+          AND (r2.relation_name = 'presynaptic_to' OR r2.relation_name = 'postsynaptic_to')
+        GROUP BY tc2.skeleton_id
+        ''' % ",".join(map(str, skids)))
         skids.extend([s[0] for s in cursor.fetchall()])
 
 
@@ -19,6 +19,11 @@ from django.shortcuts import _get_queryset
 from catmaid.models import Project, UserRole, ClassInstance, \
         ClassInstanceClassInstance
 from catmaid.control.common import my_render_to_response
+from catmaid.control.permission_cache import get_project_roles, \
+        get_edit_domain
+
+# The permissions on projects that requires_user_role() checks
+PROJECT_ROLE_PERMISSIONS = ('can_administer', 'can_annotate', 'can_browse')
 
 def login_vnc(request):
     return my_render_to_response(request,
@@ -93,11 +98,11 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
+            perms = project_roles(u, kwargs['project_id'])
 
             # Check for admin privs in all cases.
-            has_role = u.has_perm('can_administer', p)
+            has_role = 'can_administer' in perms
 
             if not has_role:
                 # Check the indicated role(s)
@@ -105,9 +110,9 @@ def requires_user_role(roles):
                     roles = [roles]
                 for role in roles:
                     if role == UserRole.Annotate:
-                        has_role = u.has_perm('can_annotate', p)
+                        has_role = 'can_annotate' in perms
                     elif role == UserRole.Browse:
-                        has_role = u.has_perm('can_browse', p)
+                        has_role = 'can_browse' in perms
                     if has_role:
                         break
 
@@ -124,6 +129,17 @@ def requires_user_role(roles):
         return wraps(f)(inner_decorator)
     return decorated_with_requires_user_role
 
+def project_roles(user, project_id):
+    """ Returns the set of role permissions (can_administer, can_annotate and
+    can_browse) the user has on the project. Results are cached for a short
+    time (see permission_cache).
+    """
+    def fetch():
+        p = Project.objects.get(pk=project_id)
+        return frozenset(perm for perm in PROJECT_ROLE_PERMISSIONS
+                if user.has_perm(perm, p))
+    return get_project_roles(user, project_id, fetch)
+
 def get_objects_and_perms_for_user(user, codenames, klass, use_groups=True, any_perm=False):
     """ Similar to what guardian's get_objects_for_user method does,
     this method return a dictionary of object IDs (!) of model klass
@@ -314,43 +330,33 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
 
 def user_can_edit(cursor, user_id, other_user_id):
     """ Determine whether the user with id 'user_'id' can edit the work of the user with id 'other_user_id'. This will be the case when the user_id belongs to a group whose name is identical to ther username of other_user_id.
-    This function is equivalent to 'other_user_id in user_domain(cursor, user_id), but consumes less resources."""
+    This function is equivalent to 'other_user_id in user_domain(cursor, user_id)'."""
     # The group with identical name to the username is implicit, doesn't have to exist. Therefore, check this edge case before querying:
     if user_id == other_user_id:
         return True
-    # Retrieve a value larger than zero when the user_id belongs to a group with name equal to that associated with other_user_id
-    cursor.execute("""
-    SELECT count(*)
-    FROM auth_user u,
-         auth_group g,
-         auth_user_groups ug
-    WHERE u.id = %s
-      AND u.username = g.name
-      AND g.id = ug.group_id
-      AND ug.user_id = %s
-    """ % (other_user_id, user_id))
-    rows = cursor.fetchall()
-    return rows and rows[0][0] > 0
+    return other_user_id in user_domain(cursor, user_id)
 
 
 def user_domain(cursor, user_id):
     """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
     A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
-    If a user can only edit its own nodes, then the returned set contains only its own user_id. """
-    cursor.execute("""
-    SELECT u2.id
-    FROM auth_user u1,
-         auth_user u2,
-         auth_group g,
-         auth_user_groups ug
-    WHERE u1.id = %s
-      AND u1.id = ug.user_id
-      AND ug.group_id = g.id
-      AND u2.username = g.name
-    """ % int(user_id))
-    domain = set(row[0] for row in cursor.fetchall())
-    domain.add(user_id)
-    return domain
+    If a user can only edit its own nodes, then the returned set contains only its own user_id. The set is cached for a short time (see permission_cache) and must not be modified. """
+    def fetch():
+        cursor.execute("""
+        SELECT u2.id
+        FROM auth_user u1,
+             auth_user u2,
+             auth_group g,
+             auth_user_groups ug
+        WHERE u1.id = %s
+          AND u1.id = ug.user_id
+          AND ug.group_id = g.id
+          AND u2.username = g.name
+        """ % int(user_id))
+        domain = set(row[0] for row in cursor.fetchall())
+        domain.add(user_id)
+        return frozenset(domain)
+    return get_edit_domain(user_id, fetch)
 
 @requires_user_role([UserRole.Annotate])
 def all_usernames(request, project_id=None):
@@ -0,0 +1,97 @@
+""" Per-process caches shared by the modules that keep data in memory between
+requests.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class TimedCache(object):
+    """ A thread safe dictionary of entries that expire after the number of
+    seconds configured in the setting named <timeout_setting>. A timeout of 0
+    disables the cache. If <keep_empty> is False, empty values aren't cached,
+    so that they are fetched again on the next lookup.
+    """
+
+    def __init__(self, timeout_setting, keep_empty=True):
+        self.timeout_setting = timeout_setting
+        self.keep_empty = keep_empty
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """ Returns the value cached for <key> or fetches, caches and returns
+        it with <fetch>, which is called without arguments, if there is none
+        or it expired.
+        """
+        timeout = getattr(settings, self.timeout_setting, 0)
+        if not timeout:
+            return fetch()
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+        value = fetch()
+        if value or self.keep_empty:
+            with self.lock:
+                self.entries[key] = (now + timeout, value)
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class LRUCache(object):
+    """ A thread safe dictionary of entries with a total size of at most
+    <max_size>, which evicts the least recently used entry first. The size of
+    an entry is computed with <sizeof>, by default every entry has a size of
+    one. Values larger than <max_size> are not cached.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.pop(key, default)
+            if value is not default:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self.sizeof(self.entries.popitem(last=False)[1])
+
+    def discard(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        if key in self.entries:
+            self.size -= self.sizeof(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -10,8 +10,8 @@ from django.template.context import RequestContext
 
 from catmaid.fields import Double3D
 from catmaid.models import Log, NeuronSearch, CELL_BODY_CHOICES, \
-        SORT_ORDERS_DICT,  Relation, Class, ClassInstance, \
-        ClassInstanceClassInstance
+        SORT_ORDERS_DICT, ClassInstance, ClassInstanceClassInstance
+from catmaid.control.ontology_cache import get_relation_ids, get_class_ids
 
 def _create_relation(user, project_id, relation_id, instance_a_id, instance_b_id):
     relation = ClassInstanceClassInstance()
@@ -206,10 +206,16 @@ def cursor_fetch_dictionary(cursor):
             ]
 
 def get_relation_to_id_map(project_id):
-    return {rname: ID for rname, ID in Relation.objects.filter(project=project_id).values_list("relation_name", "id")}
+    """ Returns a dictionary of relation name vs ID of the project. IDs are
+    cached for a short time (see ontology_cache).
+    """
+    return get_relation_ids(project_id)
 
 def get_class_to_id_map(project_id):
-    return {cname: ID for cname, ID in Class.objects.filter(project=project_id).values_list("class_name", "id")}
+    """ Returns a dictionary of class name vs ID of the project. IDs are
+    cached for a short time (see ontology_cache).
+    """
+    return get_class_ids(project_id)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
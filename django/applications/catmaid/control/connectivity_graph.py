@@ -0,0 +1,302 @@
+""" An in-memory copy of the synaptic connectivity between the skeletons of a
+project, for queries that follow synapse edges over several hops.
+
+The edges of a project are loaded once from the synapse_edge table and are
+then kept up to date with the synapse_edge_change table, which records the
+transaction that changed an edge last. Each refresh only reloads the edges
+changed by transactions that weren't finished at the time of the previous
+one. For queries the edges are converted to compressed sparse row (CSR)
+arrays of outgoing and incoming edges, weighted by the number of synapses.
+
+Graphs are held per process. Transactions that changed synapse edges
+themselves don't use (and don't update) the shared graph of a project, they
+get a private copy instead. This way uncommitted changes never end up in the
+shared graph.
+"""
+
+import threading
+
+from collections import defaultdict
+
+import numpy as np
+
+from django.db import connection
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def _edge_keys(pre, post):
+    """ Combines two arrays of skeleton IDs into one array of 64 bit keys,
+    which sort by the first and then by the second skeleton ID.
+    """
+    return (np.asarray(pre, dtype=np.int64) << 32) | \
+            np.asarray(post, dtype=np.int64)
+
+
+class Adjacency(object):
+    """ An immutable CSR representation of a set of weighted, directed edges
+    between skeletons. Skeletons are referred to by their index in
+    self.skeleton_ids.
+    """
+
+    def __init__(self, keys, weights):
+        pre = keys >> 32
+        post = keys & 0xffffffff
+        self.skeleton_ids = np.unique(np.concatenate((pre, post)))
+        src = np.searchsorted(self.skeleton_ids, pre)
+        dst = np.searchsorted(self.skeleton_ids, post)
+
+        # Keys are sorted, i.e. edges are already ordered by their source
+        self.out_ptr = self._pointers(src)
+        self.out_idx = dst
+        self.out_weights = weights
+
+        order = np.argsort(dst, kind='mergesort')
+        self.in_ptr = self._pointers(dst)
+        self.in_idx = src[order]
+        self.in_weights = weights[order]
+
+    def _pointers(self, nodes):
+        """ Returns the CSR row pointers for the passed in edge end points.
+        """
+        ptr = np.zeros(len(self.skeleton_ids) + 1, dtype=np.int64)
+        if len(nodes):
+            ptr[1:] = np.cumsum(np.bincount(nodes,
+                    minlength=len(self.skeleton_ids)))
+        return ptr
+
+    def indices(self, skeleton_ids):
+        """ Returns the indices of the passed in skeletons. Skeletons without
+        any edge are left out.
+        """
+        skids = np.unique(np.asarray(list(skeleton_ids), dtype=np.int64))
+        if 0 == len(skids) or 0 == len(self.skeleton_ids):
+            return np.empty(0, dtype=np.int64)
+        pos = np.searchsorted(self.skeleton_ids, skids)
+        pos[pos == len(self.skeleton_ids)] = 0
+        return pos[self.skeleton_ids[pos] == skids]
+
+    def _gather(self, ptr, idx, weights, nodes, min_weight):
+        """ Returns two arrays of the same length: the nodes out of <nodes>
+        and their neighbors in the passed in CSR arrays that are connected by
+        at least <min_weight> synapses. Edges of a node to itself are left
+        out.
+        """
+        starts = ptr[nodes]
+        lengths = ptr[nodes + 1] - starts
+        total = lengths.sum()
+        if 0 == total:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        offsets = np.cumsum(lengths) - lengths
+        pos = np.arange(total) - np.repeat(offsets - starts, lengths)
+        sources = np.repeat(nodes, lengths)
+        neighbors = idx[pos]
+        keep = (weights[pos] >= min_weight) & (neighbors != sources)
+        return sources[keep], neighbors[keep]
+
+    def downstream(self, nodes, min_synapses):
+        """ Returns the (pre, post) node pairs of all edges from <nodes> with
+        at least <min_synapses> synapses.
+        """
+        return self._gather(self.out_ptr, self.out_idx, self.out_weights,
+                nodes, min_synapses)
+
+    def upstream(self, nodes, min_synapses):
+        """ Returns the (pre, post) node pairs of all edges to <nodes> with at
+        least <min_synapses> synapses.
+        """
+        post, pre = self._gather(self.in_ptr, self.in_idx, self.in_weights,
+                nodes, min_synapses)
+        return pre, post
+
+    def expand(self, skeleton_ids, n_hops, min_pre=None, min_post=None):
+        """ Grows the passed in set of skeletons breadth-first by <n_hops>
+        hops. In every hop, skeletons that are postsynaptic to the current
+        ones with at least <min_post> synapses and skeletons that are
+        presynaptic to them with at least <min_pre> synapses are added. A
+        threshold of None doesn't follow edges of that direction. Returns the
+        set of reached skeleton IDs, without the passed in ones, and a tuple
+        of two arrays with the pre and post indices of all followed edges.
+        """
+        visited = np.zeros(len(self.skeleton_ids), dtype=bool)
+        frontier = self.indices(skeleton_ids)
+        visited[frontier] = True
+        edges_pre, edges_post = [], []
+
+        for _ in xrange(n_hops):
+            if 0 == len(frontier):
+                break
+            reached = []
+            if min_post is not None:
+                pre, post = self.downstream(frontier, min_post)
+                edges_pre.append(pre)
+                edges_post.append(post)
+                reached.append(post)
+            if min_pre is not None:
+                pre, post = self.upstream(frontier, min_pre)
+                edges_pre.append(pre)
+                edges_post.append(post)
+                reached.append(pre)
+            if not reached:
+                break
+            reached = np.unique(np.concatenate(reached))
+            frontier = reached[~visited[reached]]
+            visited[frontier] = True
+
+        found = set(self.skeleton_ids[visited].tolist()) - \
+                set(int(skid) for skid in skeleton_ids)
+        if edges_pre:
+            edges = (np.concatenate(edges_pre), np.concatenate(edges_post))
+        else:
+            edges = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        return found, edges
+
+    def directed_paths(self, skeleton_ids, max_inner, min_pre=None,
+            min_post=None):
+        """ Returns all simple directed paths between any two of the passed
+        in skeletons with at most <max_inner> skeletons in between, as lists
+        of skeleton IDs. Only edges found by growing the passed in skeletons
+        by <max_inner> hops with the given thresholds (see expand()) are
+        followed.
+        """
+        sources = self.indices(skeleton_ids)
+        if len(sources) < 2:
+            return []
+        max_edges = max_inner + 1
+        _, (pre, post) = self.expand(skeleton_ids, max_inner, min_pre,
+                min_post)
+
+        successors = defaultdict(list)
+        predecessors = defaultdict(list)
+        for a, b in set(zip(pre.tolist(), post.tolist())):
+            successors[a].append(b)
+            predecessors[b].append(a)
+
+        # Distance of every node to the closest source, along directed edges.
+        # Paths that can't reach a source anymore aren't followed.
+        targets = set(sources.tolist())
+        distance = dict((t, 0) for t in targets)
+        frontier = list(targets)
+        for d in xrange(1, max_edges):
+            next_frontier = []
+            for node in frontier:
+                for p in predecessors[node]:
+                    if p not in distance:
+                        distance[p] = d
+                        next_frontier.append(p)
+            frontier = next_frontier
+
+        skids = self.skeleton_ids
+        paths = []
+        for start in targets:
+            path = [start]
+            on_path = set(path)
+            stack = [iter(successors[start])]
+            while stack:
+                node = next(stack[-1], None)
+                if node is None:
+                    stack.pop()
+                    on_path.discard(path.pop())
+                    continue
+                if node in on_path:
+                    continue
+                n_edges = len(path)
+                if node in targets:
+                    paths.append([int(skids[i]) for i in path] +
+                            [int(skids[node])])
+                if n_edges + max(1, distance.get(node, max_edges)) <= max_edges:
+                    path.append(node)
+                    on_path.add(node)
+                    stack.append(iter(successors[node]))
+        return paths
+
+
+class ConnectivityGraph(object):
+    """ The synapse edges of one project, kept as a sorted array of edge keys
+    and their weights.
+    """
+
+    def __init__(self, project_id):
+        self.project_id = int(project_id)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.weights = np.empty(0, dtype=np.int64)
+        # All transactions before this one were visible to the last refresh
+        self.watermark = None
+        self.adjacency = None
+        self.lock = threading.Lock()
+
+    def refresh(self, cursor):
+        """ Loads all edges on the first call and all edges that changed
+        since the previous call after that. Returns the current adjacency.
+        """
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        watermark = cursor.fetchone()[0]
+        if self.watermark is None:
+            cursor.execute('''
+            SELECT pre_skeleton_id, post_skeleton_id, num_synapses
+            FROM synapse_edge
+            WHERE project_id = %s
+            ''' % self.project_id)
+        else:
+            cursor.execute('''
+            SELECT c.pre_skeleton_id, c.post_skeleton_id,
+                   COALESCE(e.num_synapses, 0)
+            FROM synapse_edge_change c
+            LEFT OUTER JOIN synapse_edge e
+              ON (e.pre_skeleton_id = c.pre_skeleton_id
+                  AND e.post_skeleton_id = c.post_skeleton_id)
+            WHERE c.project_id = %s
+              AND c.txid >= %s
+            ''' % (self.project_id, int(self.watermark)))
+        self.update(cursor.fetchall())
+        self.watermark = watermark
+        if self.adjacency is None:
+            self.adjacency = Adjacency(self.keys, self.weights)
+        return self.adjacency
+
+    def update(self, rows):
+        """ Sets the number of synapses of the passed in (pre skeleton ID,
+        post skeleton ID, synapse count) rows. Edges without synapses are
+        removed.
+        """
+        if not rows:
+            return
+        pre, post, weights = (np.array(c, dtype=np.int64) for c in zip(*rows))
+        keys = _edge_keys(pre, post)
+
+        # Adjacencies that are still in use share the weights array
+        current = self.weights.copy()
+        pos = np.searchsorted(self.keys, keys)
+        known = pos < len(self.keys)
+        known[known] = self.keys[pos[known]] == keys[known]
+        current[pos[known]] = weights[known]
+
+        new = ~known & (weights > 0)
+        keys = np.concatenate((self.keys, keys[new]))
+        weights = np.concatenate((current, weights[new]))
+        live = weights > 0
+        keys, weights = keys[live], weights[live]
+        order = np.argsort(keys, kind='mergesort')
+        self.keys, self.weights = keys[order], weights[order]
+        self.adjacency = None
+
+
+def get_adjacency(project_id, cursor=None):
+    """ Returns an up to date Adjacency of all synapse edges of a project.
+    """
+    cursor = cursor or connection.cursor()
+    cursor.execute("SELECT synapse_edges_changed()")
+    if cursor.fetchone()[0]:
+        # This transaction changed edges itself, which other transactions
+        # can't see (yet).
+        return ConnectivityGraph(project_id).refresh(cursor)
+
+    with _graphs_lock:
+        graph = _graphs.get(int(project_id))
+        if graph is None:
+            graph = _graphs[int(project_id)] = ConnectivityGraph(project_id)
+    with graph.lock:
+        return graph.refresh(cursor)
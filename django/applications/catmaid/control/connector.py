@@ -15,6 +15,7 @@ from catmaid.models import Project, Stack, ProjectStack, Connector, \
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.common import cursor_fetch_dictionary, \
         get_relation_to_id_map
+from catmaid.control import node_cache
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def graphedge_list(request, project_id=None):
@@ -347,14 +348,7 @@ def _connector_skeletons(connector_ids, project_id):
     and 'postsynaptic_to' with a list of skeleton IDs (maybe empty). """
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     PRE = relations['presynaptic_to']
     POST = relations['postsynaptic_to']
 
@@ -393,14 +387,7 @@ def _connector_associated_edgetimes(connector_ids, project_id):
     the timestamp of the edge. """
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     PRE = relations['presynaptic_to']
     POST = relations['postsynaptic_to']
 
@@ -464,6 +451,7 @@ def create_connector(request, project_id=None):
         location_z=float(query_parameters['z']),
         confidence=parsed_confidence)
     new_connector.save()
+    node_cache.invalidate_sections(project_id, [new_connector.location_z])
 
     return HttpResponse(json.dumps({'connector_id': new_connector.id}))
 
@@ -472,6 +460,7 @@ def create_connector(request, project_id=None):
 def delete_connector(request, project_id=None):
     connector_id = int(request.POST.get("connector_id", 0))
     can_edit_or_fail(request.user, connector_id, 'connector')
+    node_cache.invalidate_connectors(project_id, [connector_id])
     Connector.objects.filter(id=connector_id).delete()
     return HttpResponse(json.dumps({
         'message': 'Removed connector and class_instances',
@@ -7,17 +7,22 @@ from django.contrib.auth.decorators import login_required
 
 from catmaid.models import Stack, Project, ProjectStack, Message, User
 from catmaid.control.common import id_generator, json_error_response
+from catmaid.control.cache import LRUCache
 
 import urllib2 as urllib
 import os.path
 import glob
+import copy
+import struct
+from fractions import Fraction
+from multiprocessing.pool import ThreadPool
 from time import time
 from math import cos, sin, radians
 
 # The libuuid import is a workaround for a bug with GraphicsMagick
 # which expects the library to be loaded already. Therefore, it
 # has to be loaded before pgmagick.
-from pgmagick import Blob, Image, ImageList, Geometry, ChannelType, \
+from pgmagick import Blob, Image, Geometry, ChannelType, \
         CompositeOperator as co
 
 from celery.task import task
@@ -67,9 +72,37 @@ class CropJob:
             output_path = os.path.join(crop_output_path, file_name)
         self.single_channel = single_channel
         self.output_path = output_path
+        # Translations of the stacks relative to the project, they are
+        # retrieved when needed.
+        self.translations = {}
         # State that extra initialization is needed
         self.needs_initialization = True
 
+    def copy_for_region(self, x_min, x_max, y_min, y_max, z_min, z_max):
+        """ Returns a copy of this job that crops another region. Stacks,
+        their translations and the initialization state are shared with this
+        job, which avoids looking them up again.
+        """
+        job = copy.copy(self)
+        job.x_min = float(x_min)
+        job.x_max = float(x_max)
+        job.y_min = float(y_min)
+        job.y_max = float(y_max)
+        job.z_min = float(z_min)
+        job.z_max = float(z_max)
+        return job
+
+    def get_translation(self, stack):
+        """ Returns the translation of a stack of this job relative to the
+        project.
+        """
+        translation = self.translations.get(stack.id)
+        if translation is None:
+            translation = ProjectStack.objects.get(project_id=self.project_id,
+                    stack_id=stack.id).translation
+            self.translations[stack.id] = translation
+        return translation
+
     def initialize(self):
         """ This separate initialization method sets up methods to get the path
         to the tiles of the stacks used. It needs to be called from the
@@ -180,22 +213,14 @@ class ImagePart:
                     "extent should be zero!" )
 
     def get_image( self ):
-        # Open the image
-        try:
-            img_file = urllib.urlopen( self.path )
-            img_data = img_file.read()
-            bytes_read = len(img_data)
-        except urllib.HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except urllib.URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
-
-        blob = Blob( img_data )
-        image = Image( blob )
+        image, bytes_read = load_tile( self.path )
         # Check if the whole image should be used and cropped if necessary.
+        # The tile is shared through the tile cache, therefore only a copy
+        # of it is cropped.
         src_width = image.size().width()
         src_height = image.size().height()
         if self.width != src_width or self.height != src_height:
+            image = Image( image )
             box = Geometry( self.width, self.height, self.x_min_src, self.y_min_src )
             image.crop( box )
 
@@ -206,6 +231,74 @@ class ImagePart:
                                                float(src_width * src_height))
         return image
 
+def _decoded_size( entry ):
+    """ Estimates the memory a decoded tile of the tile cache takes up,
+    assuming four Bytes per pixel.
+    """
+    image = entry[0]
+    return 4 * image.size().width() * image.size().height()
+
+# The tile cache and the worker pool of this process are created when they are
+# first needed. This makes sure that Celery worker processes don't share them
+# with their parent. The tile cache is shared by all jobs of a process and
+# drops the least recently used tiles first.
+tile_cache = None
+worker_pool = None
+
+def load_tile( path ):
+    """ Returns the decoded tile image at the given path together with the
+    number of Bytes read for it. Recently used tiles are kept in a cache, which
+    must not be modified by callers.
+    """
+    global tile_cache
+    if tile_cache is None:
+        tile_cache = LRUCache( settings.CROPPING_TILE_CACHE_SIZE, _decoded_size )
+    entry = tile_cache.get( path )
+    if entry is not None:
+        return entry
+
+    try:
+        img_file = urllib.urlopen( path )
+        img_data = img_file.read()
+        bytes_read = len(img_data)
+    except urllib.HTTPError as e:
+        raise ImageRetrievalError(path, "Error code: %s" % e.code)
+    except urllib.URLError as e:
+        raise ImageRetrievalError(path, e.reason)
+
+    image = Image( Blob( img_data ) )
+    tile_cache.set( path, (image, bytes_read) )
+    return image, bytes_read
+
+def get_worker_pool():
+    """ Returns the thread pool used to fetch and decode tiles concurrently or
+    None if tiles should be loaded one after another.
+    """
+    global worker_pool
+    if settings.CROPPING_WORKERS < 2:
+        return None
+    if worker_pool is None:
+        worker_pool = ThreadPool( settings.CROPPING_WORKERS )
+    return worker_pool
+
+class ImagePartLoader:
+    """ Loads the image parts of a slice in the background, while the
+    previous slice is processed.
+    """
+    def __init__( self, image_parts ):
+        self.image_parts = image_parts
+        pool = get_worker_pool()
+        if pool is None or not image_parts:
+            self.result = None
+            self.images = [ip.get_image() for ip in image_parts]
+        else:
+            self.result = pool.map_async( ImagePart.get_image, image_parts )
+
+    def get( self ):
+        if self.result is None:
+            return self.images
+        return self.result.get()
+
 def to_x_index( x, job, enforce_bounds=True ):
     """ Converts a real world position to a x pixel position.
     Also, makes sure the value is in bounds.
@@ -233,68 +326,173 @@ def to_z_index( z, job, enforce_bounds=True ):
         section = min(max(section, 0.0), job.ref_stack.dimension.z - 1.0)
     return int( section )
 
-def addMetaData( path, job, result ):
-    """ Use this method to add meta data to the image. Due to a bug in
-    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
-    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
-    TIFF files. Instead, we use a separate tool called exiftool to write
-    meta data. Currently, there seems no better solution than this. If the
-    tool is not found, no meta data is produced and no error is raised.
+class TiffWriter:
+    """ Writes images one after another as pages of an uncompressed multi-page
+    RGB TIFF file, which makes it unnecessary to keep all of them in memory.
+    Every page contains the X and Y resolution of the job in pixel per
+    nanometer (if the resolution of the stack is nanometer based). The first
+    page also contains ImageJ specific meta data in its ImageDescription tag,
+    which allows easy embedding of units and display options.
     """
-    # Add resolution information in pixel per nanometer. The stack info
-    # available is nm/px and refers to a zoom-level of zero.
-    res_x_scaled = job.ref_stack.resolution.x * 2**job.zoom_level
-    res_y_scaled = job.ref_stack.resolution.y * 2**job.zoom_level
-    res_x_nm_px = 1.0 / res_x_scaled
-    res_y_nm_px = 1.0 / res_y_scaled
-    res_args = "-EXIF:XResolution={0} -EXIF:YResolution={1} -EXIF:" \
-            "ResolutionUnit=None".format( str(res_x_nm_px), str(res_y_nm_px) )
-
-    # ImageJ specific meta data to allow easy embedding of units and
-    # display options.
-    n_images = len( result )
-    ij_version= "1.45p"
-    unit = "nm"
-    newline = "\n"
-
-    # sample with (the actual is a line break instead of a .):
-    # ImageJ=1.45p.images={0}.channels=1.slices=2.hyperstack=true.mode=color.unit=micron.finterval=1.spacing=1.5.loop=false.min=0.0.max=4095.0.
-    ij_data = "ImageJ={1}{0}unit={2}{0}".format( newline, ij_version, unit)
-    if n_images > 1:
-        n_channels = len(job.stacks)
-        if n_images % n_channels != 0:
-            raise ValueError( "Meta data creation: the number of images " \
-                    "modulo the channel count is not zero" )
-        n_slices = n_images / n_channels
-        ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
-    ij_args = "-EXIF:ImageDescription=\"{0}\"".format( ij_data )
-
-    # Information about the software used
-    sw_args = "-EXIF:Software=\"Created with CATMAID and GraphicsMagic, " \
-            "processed with exiftool.\""
-    # Build up the final tag changing arguments for each slice
-    tag_args = "{0} {1} {2}".format( res_args, ij_args, sw_args )
-    per_slice_tag_args = []
-    for i in range(0, n_images):
-        # the string EXIF gets replaced for every image with IFD<N>
-        slice_args = tag_args.replace( "EXIF", "IFD" + str(i) )
-        per_slice_tag_args.append( slice_args  )
-    final_tag_args = " ".join( per_slice_tag_args )
-    # Create the final call and execute
-    call = "exiftool -overwrite_original {0} {1}".format( final_tag_args, path )
-    os.system( call )
-
-    # Re-save the image with GraphicsMagick, otherwise ImageJ won't read the
-    # images directly.
-    images = ImageList()
-    images.readImages( path )
-    images.writeImages( path )
+    # TIFF tags used
+    IMAGE_WIDTH = 256
+    IMAGE_LENGTH = 257
+    BITS_PER_SAMPLE = 258
+    COMPRESSION = 259
+    PHOTOMETRIC_INTERPRETATION = 262
+    IMAGE_DESCRIPTION = 270
+    STRIP_OFFSETS = 273
+    SAMPLES_PER_PIXEL = 277
+    ROWS_PER_STRIP = 278
+    STRIP_BYTE_COUNTS = 279
+    X_RESOLUTION = 282
+    Y_RESOLUTION = 283
+    PLANAR_CONFIGURATION = 284
+    RESOLUTION_UNIT = 296
+    SOFTWARE = 305
+    # TIFF field types used
+    ASCII = 2
+    SHORT = 3
+    LONG = 4
+    RATIONAL = 5
+
+    software = "Created with CATMAID and GraphicsMagick"
+
+    def __init__( self, path, job ):
+        self.job = job
+        self.n_images = 0
+        self.file = open( path, 'wb' )
+        # Little endian header, the offset of the first IFD is set once it
+        # is written.
+        self.file.write( struct.pack( '<2sHI', 'II', 42, 0 ) )
+        self.next_ifd_offset_pos = 4
+        self.description_entry_pos = None
+        # The stack info available is nm/px and refers to a zoom-level of
+        # zero.
+        self.res_x = self.to_rational( 1.0 / (job.ref_stack.resolution.x *
+                2**job.zoom_level) )
+        self.res_y = self.to_rational( 1.0 / (job.ref_stack.resolution.y *
+                2**job.zoom_level) )
+
+    def to_rational( self, value ):
+        f = Fraction( value ).limit_denominator( 2**31 - 1 )
+        return f.numerator, f.denominator
+
+    def append( self, data ):
+        """ Writes data at the end of the file, aligned to a word boundary,
+        and returns its offset.
+        """
+        self.file.seek( 0, os.SEEK_END )
+        offset = self.file.tell()
+        if offset % 2:
+            self.file.write( '\0' )
+            offset += 1
+        self.file.write( data )
+        return offset
+
+    def patch( self, position, fmt, *values ):
+        self.file.seek( position )
+        self.file.write( struct.pack( fmt, *values ) )
+
+    def write( self, image ):
+        """ Adds the passed in pgmagick image as a new page.
+        """
+        width = image.size().width()
+        height = image.size().height()
+        blob = Blob()
+        image.write( blob, 'RGB', 8 )
+        pixel_data = blob.data
+        del blob
+
+        strip_offset = self.append( pixel_data )
+        bits_offset = self.append( struct.pack( '<3H', 8, 8, 8 ) )
+        res_x_offset = self.append( struct.pack( '<2I', *self.res_x ) )
+        res_y_offset = self.append( struct.pack( '<2I', *self.res_y ) )
+        software = self.software + '\0'
+        software_offset = self.append( software )
+
+        # Entries are tuples of tag, type, count and value (or offset) and
+        # have to be sorted by tag.
+        entries = [
+            (self.IMAGE_WIDTH, self.LONG, 1, width),
+            (self.IMAGE_LENGTH, self.LONG, 1, height),
+            (self.BITS_PER_SAMPLE, self.SHORT, 3, bits_offset),
+            (self.COMPRESSION, self.SHORT, 1, 1),
+            (self.PHOTOMETRIC_INTERPRETATION, self.SHORT, 1, 2),
+            (self.STRIP_OFFSETS, self.LONG, 1, strip_offset),
+            (self.SAMPLES_PER_PIXEL, self.SHORT, 1, 3),
+            (self.ROWS_PER_STRIP, self.LONG, 1, height),
+            (self.STRIP_BYTE_COUNTS, self.LONG, 1, len(pixel_data)),
+            (self.X_RESOLUTION, self.RATIONAL, 1, res_x_offset),
+            (self.Y_RESOLUTION, self.RATIONAL, 1, res_y_offset),
+            (self.PLANAR_CONFIGURATION, self.SHORT, 1, 1),
+            (self.RESOLUTION_UNIT, self.SHORT, 1, 1),
+            (self.SOFTWARE, self.ASCII, len(software), software_offset),
+        ]
+        # The image description of the first page is written on closing,
+        # because only then the number of images is known.
+        first_page = self.n_images == 0
+        if first_page:
+            entries.insert( 5, (self.IMAGE_DESCRIPTION, self.ASCII, 0, 0) )
+
+        ifd = struct.pack( '<H', len(entries) )
+        for tag, field_type, count, value in entries:
+            if field_type == self.SHORT and count == 1:
+                ifd += struct.pack( '<HHIHH', tag, field_type, count, value, 0 )
+            else:
+                ifd += struct.pack( '<HHII', tag, field_type, count, value )
+        ifd += struct.pack( '<I', 0 )
+        ifd_offset = self.append( ifd )
+
+        # Link the new IFD from the previous one (or the header)
+        self.patch( self.next_ifd_offset_pos, '<I', ifd_offset )
+        self.next_ifd_offset_pos = ifd_offset + 2 + 12 * len(entries)
+        if first_page:
+            self.description_entry_pos = ifd_offset + 2 + 12 * 5
+        self.n_images += 1
+
+    def image_description( self ):
+        """ Creates ImageJ specific meta data. A sample (with actual line
+        breaks instead of dots) looks like this:
+        ImageJ=1.45p.images={0}.channels=1.slices=2.hyperstack=true.mode=color.unit=micron.finterval=1.spacing=1.5.loop=false.min=0.0.max=4095.0.
+        """
+        ij_version= "1.45p"
+        unit = "nm"
+        newline = "\n"
+        ij_data = "ImageJ={1}{0}unit={2}{0}".format( newline, ij_version, unit)
+        if self.n_images > 1:
+            n_channels = len(self.job.stacks)
+            if self.n_images % n_channels != 0:
+                raise ValueError( "Meta data creation: the number of images " \
+                        "modulo the channel count is not zero" )
+            n_slices = self.n_images / n_channels
+            ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(self.n_images), str(n_channels), str(n_slices) )
+        return ij_data
+
+    def close( self ):
+        """ Completes the meta data and closes the file.
+        """
+        try:
+            if self.description_entry_pos is not None:
+                description = self.image_description() + '\0'
+                description_offset = self.append( description )
+                self.patch( self.description_entry_pos, '<HHII',
+                        self.IMAGE_DESCRIPTION, self.ASCII, len(description),
+                        description_offset )
+        finally:
+            self.file.close()
 
 def extract_substack( job ):
     """ Extracts a sub-stack as specified in the passed job while respecting
     rotation requests. A list of pgmagick images is returned -- one for each
     slice, starting on top.
     """
+    return list( iterate_substack( job ) )
+
+def iterate_substack( job ):
+    """ Like extract_substack(), but the images of the sub-stack are created
+    and returned one after another by this generator.
+    """
 
     # Make sure tile source getters have been initialized on the job
     if job.needs_initialization:
@@ -303,22 +501,23 @@ def extract_substack( job ):
     # Treat rotation requests special
     if abs(job.rotation_cw) < 0.00001:
         # No rotation, create the sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        for img in iterate_substack_no_rotation( job ):
+            yield img
     elif abs(job.rotation_cw - 90.0) < 0.00001:
         # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
+        for img in iterate_substack_no_rotation( job ):
             img.rotate(270.0)
+            yield img
     elif abs(job.rotation_cw - 180.0) < 0.00001:
         # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
+        for img in iterate_substack_no_rotation( job ):
             img.rotate(180.0)
+            yield img
     elif abs(job.rotation_cw - 270.0) < 0.00001:
         # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
+        for img in iterate_substack_no_rotation( job ):
             img.rotate(90.0)
+            yield img
     else:
         # Some methods do counter-clockwise rotation
         rotation_ccw = 360.0 - job.rotation_cw
@@ -346,17 +545,10 @@ def extract_substack( job ):
         job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
         job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
         job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
 
-        # Next, rotate the whole result stack counterclockwise to have the
-        # actual ROI axis aligned.
-        for img in cropped_stack:
-            img.rotate(rotation_ccw)
-
-        # Last, do a second crop to remove the not needed parts. The region
-        # to crop is defined by the relative original crop-box coordinates to
-        # to the rotated bounding box.
+        # After rotating the enlarged sub-stack, a second crop removes the
+        # not needed parts. The region to crop is defined by the relative
+        # original crop-box coordinates to the rotated bounding box.
         rot_bb_p1 = rotate2d(rotation_ccw,
             [job.x_min, job.y_min], center)
         rot_bb_p2 = rotate2d(rotation_ccw,
@@ -383,25 +575,37 @@ def extract_substack( job ):
         crop_y_max_px = to_y_index(crop_y_max, job, False)
         crop_width_px = crop_x_max_px - crop_x_min_px
         crop_height_px = crop_y_max_px - crop_y_min_px
-        # Crop all images (Geometry: width, height, xOffset, yOffset)
+        # Crop geometry (Geometry: width, height, xOffset, yOffset)
         crop_geometry = Geometry(crop_width_px, crop_height_px,
             crop_x_min_px, crop_y_min_px)
-        for img in cropped_stack:
-            img.crop(crop_geometry)
-
-        # Reset the original job parameters
-        job.x_min = real_x_min
-        job.x_max = real_x_max
-        job.y_min = real_y_min
-        job.y_max = real_y_max
 
-    return cropped_stack
+        try:
+            # Create the enlarged sub-stack, rotate each image counterclockwise
+            # to have the actual ROI axis aligned and crop it.
+            for img in iterate_substack_no_rotation( job ):
+                img.rotate(rotation_ccw)
+                img.crop(crop_geometry)
+                yield img
+        finally:
+            # Reset the original job parameters
+            job.x_min = real_x_min
+            job.x_max = real_x_max
+            job.y_min = real_y_min
+            job.y_max = real_y_max
 
 def extract_substack_no_rotation( job ):
     """ Extracts a sub-stack as specified in the passed job without respecting
     rotation requests. A list of pgmagick images is returned -- one for each
     slice, starting on top.
     """
+    return list( iterate_substack_no_rotation( job ) )
+
+def iterate_substack_no_rotation( job ):
+    """ Like extract_substack_no_rotation(), but the images of the sub-stack
+    are created and returned one after another by this generator. While an
+    image is composed, the tiles of the next one are already loaded in the
+    background.
+    """
 
     # The actual bounding boxes used for creating the images of each stack
     # depend not only on the request, but also on the translation of the stack
@@ -410,8 +614,7 @@ def extract_substack_no_rotation( job ):
     s_to_bb = {}
     for stack in job.stacks:
         # Retrieve translation relative to current project
-        translation = ProjectStack.objects.get(
-                project_id=job.project_id, stack_id=stack.id).translation
+        translation = job.get_translation(stack)
         x_min_t = job.x_min - translation.x
         x_max_t = job.x_max - translation.x
         y_min_t = job.y_min - translation.y
@@ -463,100 +666,111 @@ def extract_substack_no_rotation( job ):
     # Each stack to export is treated as a separate channel. The order
     # of the exported dimensions is XYCZ. This means all the channels of
     # one slice are exported, then the next slice follows, etc.
-    cropped_stack = []
+    slices = [(nz, stack) for nz in range(n_slices) for stack in job.stacks]
+    if not slices:
+        return
+
     # Accumulator for estimated result size
     estimated_total_size = 0
-    # Iterate over all slices
-    for nz in range(n_slices):
-        for stack in job.stacks:
-            bb = s_to_bb[stack.id]
-            # Shortcut for tile width and height
-            tile_width = stack.tile_width
-            tile_height = stack.tile_height
-            # Get indices for bounding tiles (0 indexed)
-            tile_x_min = int(bb.px_x_min / tile_width)
-            tile_x_max = int(bb.px_x_max / tile_width)
-            tile_y_min = int(bb.px_y_min / tile_height)
-            tile_y_max = int(bb.px_y_max / tile_height)
-            # Get the number of needed tiles for each direction
-            num_x_tiles = tile_x_max - tile_x_min + 1
-            num_y_tiles = tile_y_max - tile_y_min + 1
-            # Associate image parts with all tiles
-            image_parts = []
-            x_dst = bb.px_x_offset
-            for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
-                # The min x,y for the image part in the current tile are 0
-                # for all tiles except the first one.
-                cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
-                # The max x,y for the image part of current tile are the tile
-                # size minus one except for the last one.
-                if nx < (num_x_tiles - 1):
-                    cur_px_x_max = tile_width - 1
-                else:
-                    cur_px_x_max = bb.px_x_max - x * tile_width
-                # Reset y destination component
-                y_dst = bb.px_y_offset
-                for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
-                    cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
-                    if ny < (num_y_tiles - 1):
-                        cur_px_y_max = tile_height - 1
-                    else:
-                        cur_px_y_max = bb.px_y_max - y * tile_height
-                    # Create an image part definition
-                    z = bb.px_z_min + nz
-                    path = job.get_tile_path(stack, (x, y, z))
-                    try:
-                        part = ImagePart(path, cur_px_x_min, cur_px_x_max,
-                                cur_px_y_min, cur_px_y_max, x_dst, y_dst)
-                        image_parts.append( part )
-                    except:
-                        # ignore failed slices
-                        pass
-                    # Update y component of destination position
-                    y_dst += cur_px_y_max - cur_px_y_min
-                # Update x component of destination position
-                x_dst += cur_px_x_max - cur_px_x_min
-
-            # Write out the image parts and make sure the maximum allowed file
-            # size isn't exceeded.
-            cropped_slice = None
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-
-                # Estimate total file size and abort if this exceeds the
-                # maximum allowed file size.
-                estimated_total_size = estimated_total_size + ip.estimated_size
-                if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
-                    raise ValueError("The estimated size of the requested image "
-                                     "region is larger than the maximum allowed "
-                                     "file size: %0.2f > %s Bytes" % \
-                                     (estimated_total_size,
-                                      settings.GENERATED_FILES_MAXIMUM_SIZE))
-
-                # It is unfortunately not possible to create proper composite
-                # images based on a canvas image newly created like this:
-                # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
-                # Therefore, this workaround is used.
-                if not cropped_slice:
-                    cropped_slice = Image(image)
-                    cropped_slice.backgroundColor("black")
-                    cropped_slice.erase()
-                    # The '!' makes sure the aspect ration is ignored
-                    cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
-                # Draw the image onto result image
-                cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
-                # Delete tile image - it's not needed anymore
-                del image
-
-            if cropped_slice:
-                # Optionally, use only a single channel
-                if job.single_channel:
-                    cropped_slice.channel( ChannelType.RedChannel )
-                # Add the image to the cropped stack
-                cropped_stack.append( cropped_slice )
-
-    return cropped_stack
+    # Start loading the tiles of the first slice
+    loader = ImagePartLoader(get_image_parts(job, s_to_bb, *slices[0]))
+    for n, (nz, stack) in enumerate(slices):
+        bb = s_to_bb[stack.id]
+        image_parts = loader.image_parts
+        images = loader.get()
+        # Start loading the tiles of the next slice
+        if n + 1 < len(slices):
+            loader = ImagePartLoader(get_image_parts(job, s_to_bb,
+                    *slices[n + 1]))
+
+        # Write out the image parts and make sure the maximum allowed file
+        # size isn't exceeded.
+        cropped_slice = None
+        for ip, image in zip(image_parts, images):
+            # Estimate total file size and abort if this exceeds the
+            # maximum allowed file size.
+            estimated_total_size = estimated_total_size + ip.estimated_size
+            if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+                raise ValueError("The estimated size of the requested image "
+                                 "region is larger than the maximum allowed "
+                                 "file size: %0.2f > %s Bytes" % \
+                                 (estimated_total_size,
+                                  settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+            # It is unfortunately not possible to create proper composite
+            # images based on a canvas image newly created like this:
+            # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
+            # Therefore, this workaround is used.
+            if not cropped_slice:
+                cropped_slice = Image(image)
+                cropped_slice.backgroundColor("black")
+                cropped_slice.erase()
+                # The '!' makes sure the aspect ration is ignored
+                cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
+            # Draw the image onto result image
+            cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
+        # Delete tile images - they are not needed anymore
+        del images
+
+        if cropped_slice:
+            # Optionally, use only a single channel
+            if job.single_channel:
+                cropped_slice.channel( ChannelType.RedChannel )
+            yield cropped_slice
+
+def get_image_parts( job, s_to_bb, nz, stack ):
+    """ Returns a list of image parts that make up the image of the given
+    stack in the slice <nz>, relative to the sub-stack's first slice.
+    """
+    bb = s_to_bb[stack.id]
+    # Shortcut for tile width and height
+    tile_width = stack.tile_width
+    tile_height = stack.tile_height
+    # Get indices for bounding tiles (0 indexed)
+    tile_x_min = int(bb.px_x_min / tile_width)
+    tile_x_max = int(bb.px_x_max / tile_width)
+    tile_y_min = int(bb.px_y_min / tile_height)
+    tile_y_max = int(bb.px_y_max / tile_height)
+    # Get the number of needed tiles for each direction
+    num_x_tiles = tile_x_max - tile_x_min + 1
+    num_y_tiles = tile_y_max - tile_y_min + 1
+    # Associate image parts with all tiles
+    image_parts = []
+    x_dst = bb.px_x_offset
+    for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
+        # The min x,y for the image part in the current tile are 0
+        # for all tiles except the first one.
+        cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
+        # The max x,y for the image part of current tile are the tile
+        # size minus one except for the last one.
+        if nx < (num_x_tiles - 1):
+            cur_px_x_max = tile_width - 1
+        else:
+            cur_px_x_max = bb.px_x_max - x * tile_width
+        # Reset y destination component
+        y_dst = bb.px_y_offset
+        for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
+            cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
+            if ny < (num_y_tiles - 1):
+                cur_px_y_max = tile_height - 1
+            else:
+                cur_px_y_max = bb.px_y_max - y * tile_height
+            # Create an image part definition
+            z = bb.px_z_min + nz
+            path = job.get_tile_path(stack, (x, y, z))
+            try:
+                part = ImagePart(path, cur_px_x_min, cur_px_x_max,
+                        cur_px_y_min, cur_px_y_max, x_dst, y_dst)
+                image_parts.append( part )
+            except:
+                # ignore failed slices
+                pass
+            # Update y component of destination position
+            y_dst += cur_px_y_max - cur_px_y_min
+        # Update x component of destination position
+        x_dst += cur_px_x_max - cur_px_x_min
+
+    return image_parts
 
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
@@ -578,23 +792,23 @@ def process_crop_job(job, create_message=True):
     and the creation of the sub-stack. It can be executed as Celery task.
     """
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack( job )
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
-
-        # Save the resulting micro_stack to a temporary location
+        # Create the sub-stack and save each of its images to a temporary
+        # location as soon as it is available. The output file is only
+        # created if parts of stacks are within the output.
         no_error_occured = True
         error_message = ""
-        # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
-        else:
+        writer = None
+        try:
+            for img in iterate_substack( job ):
+                if writer is None:
+                    writer = TiffWriter( job.output_path, job )
+                writer.write( img )
+                del img
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if writer is None:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
                     "Therefore, no image was produced."
@@ -666,8 +880,26 @@ def sanity_check( job ):
                 "allows (%s)" % str(allowed_zoom_level))
     if job.zoom_level < 0:
         errors.append( "zoom_level must not be smaller than 0" )
+    # Refuse jobs that would exceed the maximum file size before any tile is
+    # loaded. The output is an uncompressed RGB TIFF file, one page per slice
+    # and stack.
+    if not errors:
+        output_size = estimate_output_size( job )
+        if output_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+            errors.append( "the requested image region is larger than the " \
+                    "maximum allowed file size (%s > %s Bytes)" % \
+                    (output_size, settings.GENERATED_FILES_MAXIMUM_SIZE) )
     return errors
 
+def estimate_output_size( job ):
+    """ Returns the size in Bytes of the uncompressed TIFF file a crop job
+    would produce, not counting meta data.
+    """
+    width = to_x_index( job.x_max - job.x_min, job, False )
+    height = to_y_index( job.y_max - job.y_min, job, False )
+    n_slices = to_z_index( job.z_max, job ) + 1 - to_z_index( job.z_min, job )
+    return 3 * width * height * max(n_slices, 0) * len(job.stacks)
+
 @login_required
 def crop(request, project_id=None, stack_ids=None, x_min=None, x_max=None,
         y_min=None, y_max=None, z_min=None, z_max=None, zoom_level=None,
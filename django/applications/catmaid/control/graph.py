@@ -19,6 +19,7 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.review import get_treenodes_to_reviews
 from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
         spanning_tree, cable_length
+from catmaid.control.split_cache import cached_splits
 
 def split_by_confidence_and_add_edges(confidence_threshold, digraphs, rows):
     """ dipgrahs is a dictionary of skeleton IDs as keys and DiGraph instances as values,
@@ -51,16 +52,17 @@ def split_by_confidence_and_add_edges(confidence_threshold, digraphs, rows):
 
     return arbors
 
-def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, minis):
-    """ locations: dictionary of treenode ID vs tuple with x,y,z
-        arbors: dictionary of skeleton ID vs list of DiGraph (that were, or not, split by confidence)
-        treenode_connectors: dictionary of treenode ID vs list of tuples of connector_id, string of 'presynaptic_to' or 'postsynaptic_to'
+def find_synapse_domains(bandwidth, locations, arbors, treenode_connector, skeleton_ids):
+    """ Clusters the synapses of each DiGraph of the given skeletons into synapse domains.
+        Returns a dictionary of skeleton ID vs a dictionary of the smallest treenode ID of
+        each DiGraph with synapses vs a tuple of (local_max, tuple of treenode IDs) per domain.
+        For the other parameters, see split_by_synapse_domain.
     """
-    arbors2 = {} # Some arbors will be split further
-    for skeleton_id, graphs in arbors.iteritems():
-        subdomains = []
-        arbors2[skeleton_id] = subdomains
-        for graph in graphs:
+    domains = {}
+    for skeleton_id in skeleton_ids:
+        graph_domains = {}
+        domains[skeleton_id] = graph_domains
+        for graph in arbors[skeleton_id]:
             treenode_ids = []
             connector_ids =[]
             relation_ids = []
@@ -72,7 +74,6 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                     relation_ids.append(relation)
 
             if not connector_ids:
-                subdomains.append(graph)
                 continue
 
             for parent_id, treenode_id in graph.edges_iter():
@@ -84,12 +85,35 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
             synapse_group = tree_max_density(graph.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
             # The list of nodes of each synapse_group contains only nodes that have connectors
             # A local_max is the skeleton node most central to a synapse_group
+            graph_domains[min(graph.nodes_iter())] = tuple((domain.local_max, tuple(domain.node_ids)) for domain in synapse_group.itervalues())
+
+    return domains
+
+def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, minis, domains=None):
+    """ locations: dictionary of treenode ID vs tuple with x,y,z
+        arbors: dictionary of skeleton ID vs list of DiGraph (that were, or not, split by confidence)
+        treenode_connectors: dictionary of treenode ID vs list of tuples of connector_id, string of 'presynaptic_to' or 'postsynaptic_to'
+        domains: the synapse domains of all arbors as returned by find_synapse_domains, which are found if not given
+    """
+    if domains is None:
+        domains = find_synapse_domains(bandwidth, locations, arbors, treenode_connector, arbors.keys())
+    arbors2 = {} # Some arbors will be split further
+    for skeleton_id, graphs in arbors.iteritems():
+        subdomains = []
+        arbors2[skeleton_id] = subdomains
+        graph_domains = domains[skeleton_id]
+        for graph in graphs:
+            synapse_group = graph_domains.get(min(graph.nodes_iter())) if graph else None
+            if not synapse_group:
+                subdomains.append(graph)
+                continue
+
             anchors = {}
-            for domain in synapse_group.itervalues():
+            for local_max, node_ids in synapse_group:
                 g = nx.DiGraph()
-                g.add_nodes_from(domain.node_ids) # bogus graph, containing treenodes that point to connectors
+                g.add_nodes_from(node_ids) # bogus graph, containing treenodes that point to connectors
                 subdomains.append(g)
-                anchors[domain.local_max] = g
+                anchors[local_max] = g
             # Define edges between domains: create a simplified graph
             mini = simplify(graph, anchors.keys())
             # Replace each node by the corresponding graph, or a graph of a single node
@@ -164,7 +188,10 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
             for treenode_id in chain.from_iterable(pp[relations['postsynaptic_to']]):
                 treenode_connector[treenode_id].append((connector_id, "postsynaptic_to"))
         arbors_to_expand = {skid: ls for skid, ls in arbors.iteritems() if skid in expand}
-        expanded_arbors, minis = split_by_synapse_domain(bandwidth, locations, arbors_to_expand, treenode_connector, minis)
+        # Synapse domains are cached per skeleton, only changed skeletons are clustered again
+        domains = cached_splits('domains', (confidence_threshold, bandwidth), arbors_to_expand.keys(),
+                partial(find_synapse_domains, bandwidth, locations, arbors_to_expand, treenode_connector), cursor)
+        expanded_arbors, minis = split_by_synapse_domain(bandwidth, locations, arbors_to_expand, treenode_connector, minis, domains)
         arbors.update(expanded_arbors)
 
 
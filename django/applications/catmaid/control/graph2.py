@@ -2,7 +2,8 @@ import json
 import networkx as nx
 from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
-from itertools import izip, count
+from itertools import izip, count, chain, groupby
+from operator import itemgetter
 from functools import partial
 from synapseclustering import tree_max_density
 from numpy import subtract
@@ -13,44 +14,16 @@ from django.http import HttpResponse
 
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.tree_util import simplify
+from catmaid.control.synapse_edges import get_edges
+from catmaid.control.split_cache import cached_splits
 
 def basic_graph(project_id, skeleton_ids):
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    cursor = connection.cursor()
-
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
-
-    cursor.execute('''
-    SELECT tc.connector_id, tc.relation_id, tc.skeleton_id
-    FROM treenode_connector tc
-    WHERE tc.project_id = %s
-      AND tc.skeleton_id IN (%s)
-    ''' % (int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
-
-    # stores entire query set in memory, linking pre and post
-    connectors = defaultdict(partial(defaultdict, list))
-    for row in cursor.fetchall():
-        connectors[row[0]][row[1]].append(row[2])
-
-    # Safe to placeholder, half-complete connectors:
-    # only adds the edge if both pre and post exist
-    edges = defaultdict(partial(defaultdict, int))
-    for c in connectors.itervalues():
-        for pre in c[preID]: # should be one or none
-            for post in c[postID]:
-                edges[pre][post] += 1
-
-    return {'edges': tuple((pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems())}
+    return {'edges': tuple(get_edges(skeleton_ids))}
 
     '''
     return {'edges': [{'source': pre,
@@ -75,81 +48,132 @@ def basic_graph(project_id, skeleton_ids):
     """
 
 
-def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
-    """ Assumes 0 < confidence_threshold <= 5. """
-    if not skeleton_ids:
-        raise ValueError("No skeleton IDs provided")
+def _relations(project_id, cursor):
+    """ Returns the IDs of the presynaptic_to and postsynaptic_to relations. """
+    relations = get_relation_to_id_map(project_id)
+    return relations['presynaptic_to'], relations['postsynaptic_to']
 
-    cursor = connection.cursor()
-    skids = ",".join(str(int(skid)) for skid in skeleton_ids)
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
-
-    # Fetch synapses of all skeletons
+def _fetch_synapses(project_id, skeleton_ids, cursor):
+    """ Returns a dictionary of skeleton ID vs list of (treenode_id, connector_id, relation_id). """
+    stc = defaultdict(list)
+    if not skeleton_ids:
+        return stc
     cursor.execute('''
     SELECT skeleton_id, treenode_id, connector_id, relation_id
     FROM treenode_connector
     WHERE project_id = %s
       AND skeleton_id IN (%s)
-    ''' % (int(project_id), skids))
-
-    stc = defaultdict(list)
+    ''' % (int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
     for row in cursor.fetchall():
-        stc[row[0]].append(row[1:]) # skeleton_id vs (treenode_id, connector_id, relation_id)
+        stc[row[0]].append(row[1:])
+    return stc
+
 
-    # Fetch all treenodes of all skeletons
+def _fetch_trees(project_id, skeleton_ids, confidence_threshold, cursor, with_locations=False):
+    """ Generates a tuple of skeleton ID, DiGraph and dictionary of treenode ID vs location
+    (if requested) for each skeleton. The DiGraph has no edges with a confidence below
+    the threshold, and nodes without edges are not part of it. Edges with a confidence
+    equal to the threshold are kept, whichever node of a skeleton they belong to. """
     cursor.execute('''
-    SELECT skeleton_id, id, parent_id, confidence
+    SELECT skeleton_id, id, parent_id, confidence%s
     FROM treenode
     WHERE project_id = %s
       AND skeleton_id IN (%s)
     ORDER BY skeleton_id
-    ''' % (project_id, skids))
-
-    # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
-    connectors = defaultdict(partial(defaultdict, list))
-
-    # All nodes of the graph
-    nodeIDs = []
+    ''' % (", location_x, location_y, location_z" if with_locations else "",
+           int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
 
     # Read out into memory only one skeleton at a time
-    current_skid = None
-    tree = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
+    for skid, rows in groupby(cursor.fetchall(), itemgetter(0)):
+        tree = nx.DiGraph()
+        locations = {}
+        for row in rows:
+            if with_locations:
+                locations[row[1]] = row[4:]
             # Build the tree, breaking it at the low-confidence edges
             if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
+                tree.add_edge(row[2], row[1])
+        yield skid, tree, locations
 
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
 
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
+def _links(connectors):
+    """ Flattens a dictionary of connector_id vs relation_id vs list of node IDs into
+    a tuple of (connector_id, relation_id, node ID). """
+    return tuple((connector_id, relation_id, nodeID)
+                 for connector_id, relations in connectors.iteritems()
+                 for relation_id, nodeIDs in relations.iteritems()
+                 for nodeID in nodeIDs)
 
-    if tree:
-        nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
 
-    # Create the edges of the graph from the connectors, which was populated as a side effect of 'split_by_confidence'
+def _split_by_confidence(project_id, confidence_threshold, skeleton_ids):
+    """ Returns a dictionary of skeleton ID vs a tuple of node IDs, branch node IDs,
+    intraedges and connector links of its parts, as used by _merge_splits. """
+    cursor = connection.cursor()
+    stc = _fetch_synapses(project_id, skeleton_ids, cursor)
+    splits = {}
+    for skid, tree, _ in _fetch_trees(project_id, skeleton_ids, confidence_threshold, cursor):
+        connectors = defaultdict(partial(defaultdict, list))
+        nodeIDs = split_by_confidence(skid, tree, stc[skid], connectors) if tree else ()
+        splits[skid] = (tuple(nodeIDs), (), (), _links(connectors))
+    return splits
+
+
+def _split_by_both(project_id, confidence_threshold, bandwidth, skeleton_ids):
+    """ Like _split_by_confidence, but each part is split further into synapse domains. """
+    cursor = connection.cursor()
+    stc = _fetch_synapses(project_id, skeleton_ids, cursor)
+    splits = {}
+    for skid, tree, locations in _fetch_trees(project_id, skeleton_ids, confidence_threshold, cursor, True):
+        connectors = defaultdict(partial(defaultdict, list))
+        intraedges = []
+        ns, bs = split_by_both(skid, tree, locations, bandwidth, stc[skid], connectors, intraedges) if tree else ((), ())
+        splits[skid] = (tuple(ns), tuple(bs), tuple(intraedges), _links(connectors))
+    return splits
+
+
+def _merge_splits(splits, preID, postID):
+    """ Combines the parts of all split skeletons into the nodes, edges, branch nodes
+    and intraedges of a graph. """
+    # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
+    connectors = defaultdict(partial(defaultdict, list))
+    nodeIDs = []
+    branch_nodeIDs = []
+    intraedges = []
+    for nodes, branch_nodes, edges, links in splits:
+        nodeIDs.extend(nodes)
+        branch_nodeIDs.extend(branch_nodes)
+        intraedges.extend(edges)
+        for connector_id, relation_id, nodeID in links:
+            connectors[connector_id][relation_id].append(nodeID)
+
+    # Create the edges of the graph from the connectors
     edges = defaultdict(partial(defaultdict, int)) # pre vs post vs count
     for c in connectors.itervalues():
         for pre in c[preID]:
             for post in c[postID]:
                 edges[pre][post] += 1
 
+    edges = [(pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems()]
+    return nodeIDs, edges, branch_nodeIDs, intraedges
+
+
+def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
+    """ Assumes 0 < confidence_threshold <= 5. """
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+
+    cursor = connection.cursor()
+    preID, postID = _relations(project_id, cursor)
+
+    # Splits are cached per skeleton, only changed skeletons are split again
+    splits = cached_splits('confidence', (confidence_threshold,), skeleton_ids,
+            partial(_split_by_confidence, project_id, confidence_threshold), cursor)
+
+    nodeIDs, edges, _, _ = _merge_splits((splits[skid] for skid in sorted(splits)), preID, postID)
+
     return {'nodes': nodeIDs,
-            'edges': [(pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems()]}
+            'edges': edges}
 
 
 def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand):
@@ -163,132 +187,30 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
 
     # assumes all skeleton_id in expand are also present in skeleton_ids
 
-    skids = ",".join(str(int(skid)) for skid in skeleton_ids)
-
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
-
-    # Fetch synapses of all skeletons
-    cursor.execute('''
-    SELECT skeleton_id, treenode_id, connector_id, relation_id
-    FROM treenode_connector
-    WHERE project_id = %s
-      AND skeleton_id IN (%s)
-    ''' % (int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
-
-    stc = defaultdict(list)
-    for row in cursor.fetchall():
-        stc[row[0]].append(row[1:]) # skeleton_id vs (treenode_id, connector_id, relation_id)
-
-    # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
-    connectors = defaultdict(partial(defaultdict, list))
-
-    # All nodes of the graph (with or without edges. Includes those representing synapse domains)
-    nodeIDs = []
+    preID, postID = _relations(project_id, cursor)
 
     not_to_expand = skeleton_ids - expand
 
     if confidence_threshold > 0 and not_to_expand:
-        # Now fetch all treenodes of only skeletons in skeleton_ids (the ones not to expand)
-        cursor.execute('''
-        SELECT skeleton_id, id, parent_id, confidence
-        FROM treenode
-        WHERE project_id = %s
-          AND skeleton_id IN (%s)
-        ORDER BY skeleton_id
-        ''' % (project_id, ",".join(str(int(skid)) for skid in not_to_expand)))
-
-        # Read out into memory only one skeleton at a time
-        current_skid = None
-        tree = None
-        for row in cursor.fetchall():
-            if row[0] == current_skid:
-                # Build the tree, breaking it at the low-confidence edges
-                if row[2] and row[3] >= confidence_threshold:
-                        tree.add_edge(row[2], row[1])
-                continue
-
-            if tree:
-                nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-            # Start the next tree
-            current_skid = row[0]
-            tree = nx.DiGraph()
-            if row[2] and row[3] > confidence_threshold:
-                tree.add_edge(row[2], row[1])
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+        splits = cached_splits('confidence', (confidence_threshold,), not_to_expand,
+                partial(_split_by_confidence, project_id, confidence_threshold), cursor)
     else:
         # No need to split.
         # Populate connectors from the connections among them
-        for skid in not_to_expand:
-            nodeIDs.append(skid)
-            for c in stc[skid]:
-                connectors[c[1]][c[2]].append(skid)
+        stc = _fetch_synapses(project_id, not_to_expand, cursor)
+        splits = {skid: ((skid,), (), (), tuple((c[1], c[2], skid) for c in stc[skid]))
+                  for skid in not_to_expand}
 
+    expanded = cached_splits('both', (confidence_threshold, bandwidth), expand,
+            partial(_split_by_both, project_id, confidence_threshold, bandwidth), cursor)
 
-    # Now fetch all treenodes of all skeletons to expand
-    cursor.execute('''
-    SELECT skeleton_id, id, parent_id, confidence, location_x, location_y, location_z
-    FROM treenode
-    WHERE project_id = %s
-      AND skeleton_id IN (%s)
-    ORDER BY skeleton_id
-    ''' % (project_id, ",".join(str(int(skid)) for skid in expand)))
-
-    # list of edges among synapse domains
-    intraedges = []
-
-    # list of branch nodes, merely structural
-    branch_nodeIDs = []
-
-    # reset
-    current_skid = None
-    tree = None
-    locations = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            locations[row[1]] = row[4:]
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-            nodeIDs.extend(ns)
-            branch_nodeIDs.extend(bs)
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        locations = {}
-        locations[row[1]] = row[4:]
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-        nodeIDs.extend(ns)
-        branch_nodeIDs.extend(bs)
-
-
-    # Create the edges of the graph
-    edges = defaultdict(partial(defaultdict, int)) # pre vs post vs count
-    for c in connectors.itervalues():
-        for pre in c[preID]:
-            for post in c[postID]:
-                edges[pre][post] += 1
+    nodeIDs, edges, branch_nodeIDs, intraedges = _merge_splits(
+            chain((splits[skid] for skid in sorted(splits)),
+                  (expanded[skid] for skid in sorted(expanded))),
+            preID, postID)
 
     return {'nodes': nodeIDs,
-            'edges': [(pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems()],
+            'edges': edges,
             'branch_nodes': branch_nodeIDs,
             'intraedges': intraedges}
 
@@ -1,6 +1,5 @@
 from django.db import connection
 from collections import defaultdict
-from itertools import chain
 
 def find_empty_neurons():
     """ Returns a set of empty neurons. Also prints the total
@@ -74,11 +73,10 @@ def neuron_treenode_counts(neuron_ids):
     neurons_with_treenodes = set()
     if skeleton_neuron:
         cursor.execute("""
-        SELECT count(*), skeleton_id
-        FROM treenode
+        SELECT num_nodes, skeleton_id
+        FROM skeleton_summary
         WHERE skeleton_id IN (%s)
-        GROUP BY skeleton_id
-        """ % ','.join(chain.from_iterable(skeleton_neuron.keys()))) # flatten list of lists
+        """ % ','.join(map(str, skeleton_neuron.iterkeys())))
         for row in cursor.fetchall():
             # counts of skeleton treenodes vs list of neuron IDs
             neuronID = skeleton_neuron[row[1]]
@@ -8,6 +8,7 @@ from django.contrib.auth.models import User
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_all_or_fail
 from catmaid.control.common import insert_into_log
+from catmaid.control import node_cache
 from catmaid.models import UserRole, Project, Class, ClassInstance, \
         ClassInstanceClassInstance, Relation, Treenode
 
@@ -128,6 +129,7 @@ def delete_neuron(request, project_id=None, neuron_id=None):
         DELETE FROM review WHERE skeleton_id=%s AND project_id=%s;
         COMMIT;
         ''', (skid, project_id) * 7)
+    node_cache.invalidate_project(project_id)
 
     # Insert log entry and refer to position of the first skeleton's root node
     insert_into_log(project_id, request.user.id, 'remove_neuron', root_location,
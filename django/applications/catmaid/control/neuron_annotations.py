@@ -9,7 +9,8 @@ from django.db import connection
 from catmaid.models import UserRole, Project, Class, ClassInstance, \
         ClassInstanceClassInstance, Relation
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
-from catmaid.control.common import defaultdict
+from catmaid.control.common import defaultdict, get_class_to_id_map, \
+        get_relation_to_id_map
 
 def create_basic_annotated_entity_query(project, params, relations, classes,
         allowed_classes=['neuron', 'annotation']):
@@ -47,98 +48,73 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
     if name:
         filters['name__iregex'] = name
 
-    # Add annotator and time constraints, if available
+    # Without requested annotations, annotator and time constraints refer to
+    # any link of an entity. Without any restriction, the result set will
+    # contain all instances of the given set of allowed classes.
+    if not annotations:
+        if annotator_id:
+            filters['cici_via_a__user'] = annotator_id
+        if start_date:
+            filters['cici_via_a__creation_time__gte'] = start_date
+        if end_date:
+            filters['cici_via_a__creation_time__lte'] = end_date
+        return ClassInstance.objects.filter(**filters)
+
+    # Otherwise, entities have to be annotated with every requested annotation
+    # or, if requested, with one of its sub-annotations, which are read from
+    # the annotation closure. Annotator and time constraints refer to these
+    # annotation links.
+    link_filters = []
+    link_params = []
     if annotator_id:
-        filters['cici_via_a__user'] = annotator_id
+        link_filters.append('cici.user_id = %s')
+        link_params.append(annotator_id)
     if start_date:
-        filters['cici_via_a__creation_time__gte'] = start_date
+        link_filters.append('cici.creation_time >= %s')
+        link_params.append(start_date)
     if end_date:
-        filters['cici_via_a__creation_time__lte'] = end_date
-
-    # Get map of annotations to expand and their sub-annotations
-    sub_annotation_ids = get_sub_annotation_ids(project, annotations_to_expand,
-            relations, classes)
+        link_filters.append('cici.creation_time <= %s')
+        link_params.append(end_date)
 
-    # Collect all annotations and their sub-annotation IDs (if requested) in a
-    # set each. For the actual query each set is connected with AND while
-    # for everything within one set OR is used.
-    annotation_id_sets = []
-    for a in annotations:
-        current_annotation_ids = set([a])
-        # Add sub annotations, if requested
-        sa_ids = sub_annotation_ids.get(a)
-        if sa_ids and len(sa_ids):
-            current_annotation_ids.update(sa_ids)
-        annotation_id_sets.append(current_annotation_ids)
-
-    # Due to Django's QuerySet syntax, we have to add the first
-    # annotation ID set constraint to the first filter we add.
-    if annotation_id_sets:
-        first_id_set = annotation_id_sets.pop()
-        filters['cici_via_a__relation_id'] = annotated_with
-        # Use IN (OR) for a single annotation and its sub-annotations
-        filters['cici_via_a__class_instance_b_id__in'] = first_id_set
-
-    # Create basic filter, possibly containing *one* annotation ID set
-    entities = ClassInstance.objects.filter(**filters)
-
-    # Add remaining filters for annotation constraints, if any
-    for annotation_id_set in annotation_id_sets:
-        entities = entities.filter(
-            cici_via_a__relation_id=annotated_with,
-            cici_via_a__class_instance_b_id__in=annotation_id_set)
-
-    # Create final query. Without any restriction, the result set will contain
-    # all instances of the given set of allowed classes.
-    return entities
-
-def get_sub_annotation_ids(project_id, annotation_set, relations, classes):
+    where = []
+    where_params = []
+    for a in sorted(annotations):
+        annotation_filter = 'cici.class_instance_b = %s'
+        where_params.extend((annotated_with, a))
+        if a in annotations_to_expand:
+            annotation_filter = '''(%s OR cici.class_instance_b IN (
+                SELECT sub_annotation_id FROM annotation_closure
+                WHERE annotation_id = %%s))''' % annotation_filter
+            where_params.append(a)
+        where_params.extend(link_params)
+        where.append('''class_instance.id IN (
+            SELECT cici.class_instance_a
+            FROM class_instance_class_instance cici
+            WHERE cici.relation_id = %%s
+              AND %s)''' % ' AND '.join([annotation_filter] + link_filters))
+
+    return ClassInstance.objects.filter(**filters).extra(where=where,
+            params=where_params)
+
+def get_sub_annotation_ids(project_id, annotation_set):
     """ Sub-annotations are annotations that are annotated with an annotation
     from the annotation_set passed. Additionally, transivitely annotated
-    annotations are returned as well.
+    annotations are returned as well. They are read from the annotation
+    hierarchy's closure, which is kept up to date by the database.
     """
     if not annotation_set:
         return {}
 
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
-
-    # Collect all sub-annotations by following the annotation hierarchy for
-    # every annotation in the annotation set passed.
-    sa_ids = {}
-    for a in annotation_set:
-        # Start with an empty result set for each requested annotation
-        ls = set()
-        working_set = set([a])
-        while working_set:
-            parent_id = working_set.pop()
-            # Try to get the sub-annotations for this parent
-            child_ids = aaa.get(parent_id) or set_wrapper()
-            for child_id in child_ids.data:
-                if child_id not in sa_ids:
-                    # Add all children as sub annotations
-                    ls.add(child_id)
-                    working_set.add(child_id)
-        # Store the result list for this ID
-        sa_ids[a] = list(ls)
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT annotation_id, sub_annotation_id
+    FROM annotation_closure
+    WHERE annotation_id IN (%s)
+    ''' % ','.join(str(int(a)) for a in annotation_set))
+
+    sa_ids = dict((a, []) for a in annotation_set)
+    for annotation_id, sub_annotation_id in cursor.fetchall():
+        sa_ids[annotation_id].append(sub_annotation_id)
 
     return sa_ids
 
@@ -201,8 +177,8 @@ def create_annotated_entity_list(project, entities_qs, relations, annotations=Tr
 def query_neurons_by_annotations(request, project_id = None):
     p = get_object_or_404(Project, pk = project_id)
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id)
+    relations = get_relation_to_id_map(project_id)
 
     display_start = int(request.POST.get('display_start', 0))
     display_length = int(request.POST.get('display_length', -1))
@@ -230,8 +206,8 @@ def query_neurons_by_annotations(request, project_id = None):
 def query_neurons_by_annotations_datatable(request, project_id=None):
     p = get_object_or_404(Project, pk = project_id)
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id)
+    relations = get_relation_to_id_map(project_id)
 
     display_start = int(request.POST.get('iDisplayStart', 0))
     display_length = int(request.POST.get('iDisplayLength', -1))
@@ -457,8 +433,8 @@ def remove_annotation(request, project_id=None, annotation_id=None):
 
 def create_annotation_query(project_id, param_dict):
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id)
+    relations = get_relation_to_id_map(project_id)
 
     annotation_query = ClassInstance.objects.filter(project_id=project_id,
             class_column__id=classes['annotation'])
@@ -653,8 +629,8 @@ def list_annotations(request, project_id=None):
     return HttpResponse(json.dumps({'annotations': annotations}), content_type="text/json")
 
 def _fast_co_annotations(request, project_id, display_start, display_length):
-    classIDs = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relationIDs = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classIDs = get_class_to_id_map(project_id)
+    relationIDs = get_relation_to_id_map(project_id)
     co_annotation_ids = set(int(v) for k, v in request.POST.iteritems() if k.startswith('parallel_annotations'))
 
     select, rest = generate_co_annotation_query(int(project_id), co_annotation_ids, classIDs, relationIDs)
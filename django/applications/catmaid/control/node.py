@@ -1,19 +1,21 @@
 import json
+import math
 import re
 
 from collections import defaultdict
 from datetime import datetime
 
+from django.conf import settings
 from django.db import connection
 from django.http import HttpResponse
 from django.contrib.auth.models import User 
 
 from catmaid.models import UserRole, Treenode, TreenodeConnector, Connector, \
         Location, ClassInstanceClassInstance, Review
-from catmaid.control.authentication import requires_user_role, \
-        can_edit_all_or_fail, user_domain
+from catmaid.control.authentication import requires_user_role, user_domain
 from catmaid.control.common import get_relation_to_id_map, insert_into_log
 from catmaid.control.treenode import can_edit_treenode_or_fail
+from catmaid.control import node_cache
 
 try:
     import networkx as nx
@@ -21,6 +23,106 @@ except:
     pass
 
 
+def _fetch_fov_tile(cursor, params):
+    """ Fetch the treenodes and connectors in the box defined by the top, left,
+    bottom, right and z fields of <params>. The box includes its top and left
+    borders, but not its bottom and right ones. Returns a tuple of three lists
+    of rows: treenodes joined with their parents and children, connectors
+    linked to any of these treenodes and connectors within the box.
+    """
+    # Fetch treenodes which are in the bounding box,
+    # which in z it includes the full thickess of the prior section
+    # and of the next section (therefore the '<' and not '<=' for zhigh)
+    cursor.execute('''
+    SELECT
+        t1.id,
+        t1.parent_id,
+        t1.location_x,
+        t1.location_y,
+        t1.location_z,
+        t1.confidence,
+        t1.radius,
+        t1.skeleton_id,
+        t1.user_id,
+        t2.id,
+        t2.parent_id,
+        t2.location_x,
+        t2.location_y,
+        t2.location_z,
+        t2.confidence,
+        t2.radius,
+        t2.skeleton_id,
+        t2.user_id
+    FROM treenode t1
+         INNER JOIN treenode t2 ON
+           (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
+            OR (t1.parent_id IS NULL AND t1.id = t2.id))
+    WHERE
+        t1.location_z = %(z)s
+        AND t1.location_x >= %(left)s
+        AND t1.location_x < %(right)s
+        AND t1.location_y >= %(top)s
+        AND t1.location_y < %(bottom)s
+        AND t1.project_id = %(project_id)s
+    LIMIT %(limit)s
+    ''', params)
+
+    # Above, notice that the join is done for:
+    # 1. A parent-child or child-parent pair (where the first one is in section z)
+    # 2. A node with itself when the parent is null
+    # This is by far the fastest way to retrieve all parents and children nodes
+    # of the nodes in section z within the specified 2d bounds.
+    treenode_rows = list(cursor.fetchall())
+
+    # Find connectors related to treenodes in the box
+    treenode_ids = set(row[0] for row in treenode_rows)
+    treenode_ids.update(row[9] for row in treenode_rows)
+    linked_connector_rows = []
+    if treenode_ids:
+        cursor.execute('''
+        SELECT connector.id,
+            connector.location_x,
+            connector.location_y,
+            connector.location_z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id
+        FROM treenode_connector,
+             connector
+        WHERE treenode_connector.treenode_id IN (%s)
+          AND treenode_connector.connector_id = connector.id
+        ''' % ','.join(map(str, treenode_ids)))
+        linked_connector_rows = list(cursor.fetchall())
+
+    # Obtain connectors within the box that were not captured above.
+    # Uses a LEFT OUTER JOIN to include disconnected connectors,
+    # that is, connectors that aren't referenced from treenode_connector.
+    cursor.execute('''
+    SELECT connector.id,
+        connector.location_x,
+        connector.location_y,
+        connector.location_z,
+        connector.confidence,
+        treenode_connector.relation_id,
+        treenode_connector.treenode_id,
+        treenode_connector.confidence,
+        connector.user_id
+    FROM connector LEFT OUTER JOIN treenode_connector
+                   ON connector.id = treenode_connector.connector_id
+    WHERE connector.project_id = %(project_id)s
+      AND connector.location_z = %(z)s
+      AND connector.location_x >= %(left)s
+      AND connector.location_x < %(right)s
+      AND connector.location_y >= %(top)s
+      AND connector.location_y < %(bottom)s
+    ''', params)
+    connector_rows = list(cursor.fetchall())
+
+    return treenode_rows, linked_connector_rows, connector_rows
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_list_tuples(request, project_id=None):
     ''' Retrieve an JSON array with four entries:
@@ -35,6 +137,8 @@ def node_list_tuples(request, project_id=None):
     so care must be taken never to alter the order of the variables in the SQL
     statements without modifying the accesses to said data both in this function
     and in the client that consumes it.
+    If a field of view cache is configured, treenodes and connectors are
+    assembled from cached tiles of the section (see node_cache).
     '''
     project_id = int(project_id) # sanitize
     params = {}
@@ -54,10 +158,7 @@ def node_list_tuples(request, project_id=None):
     try:
         cursor = connection.cursor()
 
-        cursor.execute('''
-        SELECT relation_name, id FROM relation WHERE project_id=%s
-        ''' % project_id)
-        relation_map = dict(cursor.fetchall())
+        relation_map = get_relation_to_id_map(project_id)
 
         response_on_error = 'Failed to query treenodes'
 
@@ -68,50 +169,17 @@ def node_list_tuples(request, project_id=None):
         # For a superuser, the domain is all users, and implicit.
         domain = None if is_superuser else user_domain(cursor, user_id)
 
-        # Fetch treenodes which are in the bounding box,
-        # which in z it includes the full thickess of the prior section
-        # and of the next section (therefore the '<' and not '<=' for zhigh)
         params['bottom'] = params['top'] + params['height']
         params['right'] = params['left'] + params['width']
-        cursor.execute('''
-        SELECT
-            t1.id,
-            t1.parent_id,
-            t1.location_x,
-            t1.location_y,
-            t1.location_z,
-            t1.confidence,
-            t1.radius,
-            t1.skeleton_id,
-            t1.user_id,
-            t2.id,
-            t2.parent_id,
-            t2.location_x,
-            t2.location_y,
-            t2.location_z,
-            t2.confidence,
-            t2.radius,
-            t2.skeleton_id,
-            t2.user_id
-        FROM treenode t1
-             INNER JOIN treenode t2 ON
-               (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
-                OR (t1.parent_id IS NULL AND t1.id = t2.id))
-        WHERE
-            t1.location_z = %(z)s
-            AND t1.location_x > %(left)s
-            AND t1.location_x < %(right)s
-            AND t1.location_y > %(top)s
-            AND t1.location_y < %(bottom)s
-            AND t1.project_id = %(project_id)s
-        LIMIT %(limit)s
-        ''', params)
-
-        # Above, notice that the join is done for:
-        # 1. A parent-child or child-parent pair (where the first one is in section z)
-        # 2. A node with itself when the parent is null
-        # This is by far the fastest way to retrieve all parents and children nodes
-        # of the nodes in section z within the specified 2d bounds.
+        left, right = params['left'], params['right']
+        top, bottom = params['top'], params['bottom']
+
+        # Get the treenodes and connectors of all tiles that cover the field of
+        # view. Without cache, the field of view is queried as a single tile.
+        tiles = node_cache.get_tiles(project_id, params,
+                lambda tile_params: _fetch_fov_tile(cursor, tile_params))
+        if tiles is None:
+            tiles = [_fetch_fov_tile(cursor, params)]
 
         # A list of tuples, each tuple containing the selected columns for each treenode
         # The id is the first element of each tuple
@@ -119,68 +187,40 @@ def node_list_tuples(request, project_id=None):
         # A set of unique treenode IDs
         treenode_ids = set()
 
-        n_retrieved_nodes = 0 # at one per row, only those within the section
-        for row in cursor.fetchall():
-            n_retrieved_nodes += 1
-            t1id = row[0]
-            if t1id not in treenode_ids:
-                treenode_ids.add(t1id)
-                treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
-            t2id = row[9]
-            if t2id not in treenode_ids:
-                treenode_ids.add(t2id)
-                treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
-
-
-        # Find connectors related to treenodes in the field of view
-        # Connectors found attached to treenodes
-        crows = []
-
-        if treenode_ids:
-            response_on_error = 'Failed to query connector locations.'
-            cursor.execute('''
-            SELECT connector.id,
-                connector.location_x,
-                connector.location_y,
-                connector.location_z,
-                connector.confidence,
-                treenode_connector.relation_id,
-                treenode_connector.treenode_id,
-                treenode_connector.confidence,
-                connector.user_id
-            FROM treenode_connector,
-                 connector
-            WHERE treenode_connector.treenode_id IN (%s)
-              AND treenode_connector.connector_id = connector.id
-            ''' % ','.join(map(str, treenode_ids)))
-
-            crows = list(cursor.fetchall())
-
-        # Obtain connectors within the field of view that were not captured above.
-        # Uses a LEFT OUTER JOIN to include disconnected connectors,
-        # that is, connectors that aren't referenced from treenode_connector.
+        # Connectors found attached to treenodes of any tile
+        linked_crows = []
+        # Connectors found in the field of view
+        fov_crows = []
 
-        cursor.execute('''
-        SELECT connector.id,
-            connector.location_x,
-            connector.location_y,
-            connector.location_z,
-            connector.confidence,
-            treenode_connector.relation_id,
-            treenode_connector.treenode_id,
-            treenode_connector.confidence,
-            connector.user_id
-        FROM connector LEFT OUTER JOIN treenode_connector
-                       ON connector.id = treenode_connector.connector_id
-        WHERE connector.project_id = %(project_id)s
-          AND connector.location_z = %(z)s
-          AND connector.location_x > %(left)s
-          AND connector.location_x < %(right)s
-          AND connector.location_y > %(top)s
-          AND connector.location_y < %(bottom)s
-        ''', params)
-
-        crows.extend(cursor.fetchall())
+        n_retrieved_nodes = 0 # at one per row, only those within the section
+        # A tile that reached the node limit may miss nodes in the field of view
+        limit_reached = False
+        for treenode_rows, linked_connector_rows, connector_rows in tiles:
+            limit_reached = limit_reached or len(treenode_rows) == params['limit']
+            linked_crows.extend(linked_connector_rows)
+            for row in treenode_rows:
+                # Tiles can extend beyond the field of view, whose borders
+                # are excluded.
+                if not (left < row[2] < right and top < row[3] < bottom):
+                    continue
+                if n_retrieved_nodes == params['limit']:
+                    break
+                n_retrieved_nodes += 1
+                t1id = row[0]
+                if t1id not in treenode_ids:
+                    treenode_ids.add(t1id)
+                    treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
+                t2id = row[9]
+                if t2id not in treenode_ids:
+                    treenode_ids.add(t2id)
+                    treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
+            fov_crows.extend(row for row in connector_rows
+                    if left < row[1] < right and top < row[2] < bottom)
+
+        # Connectors related to treenodes in the field of view, followed by
+        # connectors within the field of view.
+        crows = [row for row in linked_crows if row[6] in treenode_ids]
+        crows.extend(fov_crows)
 
         connectors = []
         # A set of missing treenode IDs
@@ -291,7 +331,7 @@ def node_list_tuples(request, project_id=None):
                 for row in cursor.fetchall():
                     labels[row[0]].append(row[1])
 
-        return HttpResponse(json.dumps((treenodes, connectors, labels, n_retrieved_nodes == params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+        return HttpResponse(json.dumps((treenodes, connectors, labels, limit_reached or n_retrieved_nodes == params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -332,6 +372,7 @@ def update_confidence(request, project_id=None, node_id=0):
         rows_affected = Treenode.objects.filter(id=tnid).update(confidence=new_confidence,editor=request.user)
 
     if rows_affected > 0:
+        node_cache.invalidate_treenodes(project_id, [tnid])
         location = Location.objects.filter(id=tnid).values_list('location_x',
                 'location_y', 'location_z')[0]
         insert_into_log(project_id, request.user.id, "change_confidence", location, "Changed to %s" % new_confidence)
@@ -373,21 +414,83 @@ def most_recent_treenode(request, project_id=None):
     }))
 
 
-def _update(Kind, table, nodes, now, user):
-    if not nodes:
-        return
-    # 0: id
-    # 1: X
-    # 2: Y
-    # 3: Z
-    can_edit_all_or_fail(user, (node[0] for node in nodes.itervalues()), table)
-    for node in nodes.itervalues():
-        Kind.objects.filter(id=int(node[0])).update(
-            editor=user,
-            edition_time=now,
-            location_x=float(node[1]),
-            location_y=float(node[2]),
-            location_z=float(node[3]))
+def _update(project_id, nodes, user):
+    """ Moves treenodes and connectors to new locations. <nodes> maps the
+    table names 'treenode' and 'connector' to lists of [id, x, y, z] lists.
+    Nodes with an invalid ID, that don't exist, that the user can't edit or
+    whose location isn't finite are skipped, all others are moved by a single
+    statement. At least settings.NODE_UPDATE_BULK_MIN_NODES nodes are moved as
+    bulk update, which updates each affected skeleton summary once, fewer are
+    left to the triggers of each row. Returns the number of moved nodes and a
+    list of [table, id, error] lists of the skipped ones.
+    """
+    cursor = connection.cursor()
+    domain = None if user.is_superuser else user_domain(cursor, user.id)
+    updates = []
+    moved = {'treenode': [], 'connector': []}
+    failed = []
+    for table, rows in nodes.iteritems():
+        locations = {}
+        for row in rows:
+            try:
+                node_id = int(row[0])
+                location = tuple(float(row[i]) for i in (1, 2, 3))
+            except (KeyError, ValueError):
+                failed.append([table, row.get(0), 'Invalid node'])
+                continue
+            if any(math.isnan(v) or math.isinf(v) for v in location):
+                failed.append([table, node_id, 'Invalid location'])
+                continue
+            locations[node_id] = location
+        if not locations:
+            continue
+
+        cursor.execute('''
+        SELECT id, user_id FROM %s WHERE id = ANY(%%s)
+        ''' % table, (list(locations),))
+        owners = dict(cursor.fetchall())
+        for node_id, location in locations.iteritems():
+            if node_id not in owners:
+                failed.append([table, node_id, 'Node not found'])
+            elif domain is not None and owners[node_id] not in domain:
+                failed.append([table, node_id, 'User %s cannot edit this '
+                        'node' % user.username])
+            else:
+                updates.append((node_id,) + location)
+                moved[table].append(node_id)
+
+    if not updates:
+        return 0, failed
+
+    # Invalidate cached tiles of the sections nodes are moved from and to
+    node_cache.invalidate_treenodes(project_id, moved['treenode'])
+    node_cache.invalidate_connectors(project_id, moved['connector'])
+
+    bulk = len(updates) >= settings.NODE_UPDATE_BULK_MIN_NODES
+    if bulk:
+        cursor.execute('''
+        SELECT begin_bulk_update(%s::bigint[], %s::bigint[])
+        ''', (moved['treenode'], moved['connector']))
+    # Treenodes and connectors are both updated through the location table
+    # they inherit from.
+    params = [user.id]
+    for update in updates:
+        params.extend(update)
+    cursor.execute('''
+    UPDATE location l
+    SET location_x = v.x, location_y = v.y, location_z = v.z,
+        editor_id = %%s, edition_time = now()
+    FROM (VALUES %s) v(id, x, y, z)
+    WHERE l.id = v.id
+    ''' % ','.join(['(%s::bigint, %s::float8, %s::float8, %s::float8)'] *
+            len(updates)), params)
+    if bulk:
+        cursor.execute('SELECT end_bulk_update()')
+
+    node_cache.invalidate_treenodes(project_id, moved['treenode'])
+    node_cache.invalidate_connectors(project_id, moved['connector'])
+
+    return len(updates), failed
 
 
 @requires_user_role(UserRole.Annotate)
@@ -408,12 +511,16 @@ def node_update(request, project_id=None):
             nodes[key[0]][i] = node = {}
         node[j] = value
 
-    now = datetime.now()
-    _update(Treenode, 'treenode', nodes['t'], now, request.user)
-    _update(Connector, 'connector', nodes['c'], now, request.user)
+    num_updated_nodes, failed = _update(project_id, {
+            'treenode': nodes['t'].values(),
+            'connector': nodes['c'].values()}, request.user)
 
-    num_updated_nodes = len(nodes['t'].keys()) + len(nodes['c'].keys())
-    return HttpResponse(json.dumps({'updated': num_updated_nodes}))
+    result = {'updated': num_updated_nodes}
+    if failed:
+        result['failed'] = failed
+        result['error'] = 'Could not update %s of the %s nodes' % (
+                len(failed), len(failed) + num_updated_nodes)
+    return HttpResponse(json.dumps(result))
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -0,0 +1,226 @@
+""" A tiled cache for the field of view queries of the tracing overlay.
+
+Treenodes and connectors of a field of view are cached in square tiles of a
+section, keyed by project, section (Z) and tile position. Every key also
+contains a generation counter for its project and its section. Write
+operations increase these counters, which makes all tiles cached for the
+affected sections unreachable at once. They eventually expire.
+
+The cache is only used if settings.NODE_LIST_CACHE names a cache in CACHES.
+Since write operations in one process have to invalidate tiles cached by
+another one, this cache has to be shared between processes (e.g. memcached).
+"""
+
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.signals import request_finished
+from django.db import connection
+from django.dispatch import receiver
+
+
+_cache = None
+# Generation keys bumped in the current thread. They are bumped once more
+# after the request finished, i.e. after its transaction has been committed.
+# Tiles that were cached in between from not yet committed data are discarded
+# this way.
+_pending = threading.local()
+
+
+def get_node_cache():
+    """ Returns the cache configured in settings.NODE_LIST_CACHE or None if
+    the field of view cache is disabled.
+    """
+    global _cache
+    name = getattr(settings, 'NODE_LIST_CACHE', None)
+    if not name:
+        return None
+    if _cache is None:
+        _cache = get_cache(name)
+    return _cache
+
+
+def _project_key(project_id):
+    return 'catmaid.fov.%s' % int(project_id)
+
+
+def _section_key(project_id, z):
+    return 'catmaid.fov.%s.%r' % (int(project_id), float(z))
+
+
+def _tile_key(project_id, z, project_gen, section_gen, tx, ty):
+    return 'catmaid.fov.%s.%r.%s.%s.%s.%s' % (int(project_id), float(z),
+            project_gen, section_gen, tx, ty)
+
+
+def _initial_generation():
+    """ Generations start at the current time in milliseconds. This way a
+    counter that got evicted from the cache never reuses an old value, which
+    could make stale tiles valid again.
+    """
+    return int(time.time() * 1000)
+
+
+def _generations(cache, keys):
+    """ Returns a dictionary of the current value for each of the passed in
+    generation keys. Missing counters are initialized.
+    """
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _initial_generation(), None)
+            generations[key] = cache.get(key)
+    return generations
+
+
+def _bump(cache, keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The counter is not available (anymore)
+            cache.add(key, _initial_generation(), None)
+
+
+def _invalidate(keys):
+    cache = get_node_cache()
+    if not cache or not keys:
+        return
+    _bump(cache, keys)
+    pending = getattr(_pending, 'keys', None)
+    if pending is None:
+        pending = _pending.keys = set()
+    pending.update(keys)
+
+
+@receiver(request_finished)
+def _bump_pending(sender, **kwargs):
+    keys = getattr(_pending, 'keys', None)
+    if keys:
+        _pending.keys = None
+        _bump(get_node_cache(), keys)
+
+
+def get_tiles(project_id, params, fetch_tile):
+    """ Returns a list of all cached tiles that intersect with the field of
+    view described by the top, left, width, height and z fields of <params>.
+    Tiles that are not yet cached are created with <fetch_tile>, which is
+    expected to accept a dictionary with the fields project_id, z, top, left,
+    bottom, right and limit. None is returned if the cache is disabled or the
+    field of view spans too many tiles.
+    """
+    cache = get_node_cache()
+    if not cache:
+        return None
+
+    size = float(settings.NODE_LIST_CACHE_TILE_SIZE)
+    tx0 = int(math.floor(params['left'] / size))
+    tx1 = int(math.floor((params['left'] + params['width']) / size))
+    ty0 = int(math.floor(params['top'] / size))
+    ty1 = int(math.floor((params['top'] + params['height']) / size))
+    if (tx1 - tx0 + 1) * (ty1 - ty0 + 1) > settings.NODE_LIST_CACHE_MAX_TILES:
+        return None
+
+    z = params['z']
+    project_key = _project_key(project_id)
+    section_key = _section_key(project_id, z)
+    generations = _generations(cache, [project_key, section_key])
+
+    tile_keys = {}
+    for tx in xrange(tx0, tx1 + 1):
+        for ty in xrange(ty0, ty1 + 1):
+            key = _tile_key(project_id, z, generations[project_key],
+                    generations[section_key], tx, ty)
+            tile_keys[key] = (tx, ty)
+
+    tiles = cache.get_many(tile_keys.keys())
+
+    new_tiles = {}
+    for key, (tx, ty) in tile_keys.iteritems():
+        if key in tiles:
+            continue
+        new_tiles[key] = fetch_tile({
+            'project_id': project_id,
+            'z': z,
+            'left': tx * size,
+            'right': (tx + 1) * size,
+            'top': ty * size,
+            'bottom': (ty + 1) * size,
+            'limit': params['limit']})
+    if new_tiles:
+        cache.set_many(new_tiles, settings.NODE_LIST_CACHE_TIMEOUT)
+        tiles.update(new_tiles)
+
+    return tiles.values()
+
+
+def invalidate_project(project_id):
+    """ Invalidates all cached tiles of a project. This is meant for
+    operations that change many sections at once, like splitting or joining
+    skeletons.
+    """
+    _invalidate([_project_key(project_id)])
+
+
+def invalidate_sections(project_id, z_values):
+    """ Invalidates all cached tiles in the sections at <z_values>.
+    """
+    _invalidate(set(_section_key(project_id, z) for z in z_values))
+
+
+def _treenode_sections(cursor, treenode_ids):
+    """ Returns the sections of the passed in treenodes, of their parents and
+    children and of the connectors linked to them. The tiles of all of these
+    sections can include these treenodes.
+    """
+    ids = ','.join(str(int(tnid)) for tnid in treenode_ids)
+    cursor.execute('''
+    SELECT t.location_z
+    FROM treenode t
+    WHERE t.id IN (%s) OR t.parent_id IN (%s)
+    UNION
+    SELECT p.location_z
+    FROM treenode t, treenode p
+    WHERE t.id IN (%s) AND t.parent_id = p.id
+    UNION
+    SELECT c.location_z
+    FROM treenode_connector tc, connector c
+    WHERE tc.treenode_id IN (%s) AND tc.connector_id = c.id
+    ''' % (ids, ids, ids, ids))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def invalidate_treenodes(project_id, treenode_ids):
+    """ Invalidates all cached tiles that can include the passed in
+    treenodes. When treenodes are moved or deleted, this has to be called
+    before and after the change.
+    """
+    if not treenode_ids or not get_node_cache():
+        return
+    z_values = _treenode_sections(connection.cursor(), treenode_ids)
+    invalidate_sections(project_id, z_values)
+
+
+def invalidate_connectors(project_id, connector_ids):
+    """ Invalidates all cached tiles that can include the passed in connectors
+    or links to them. When connectors are moved or deleted, this has to be
+    called before and after the change.
+    """
+    if not connector_ids or not get_node_cache():
+        return
+    cursor = connection.cursor()
+    ids = ','.join(str(int(cid)) for cid in connector_ids)
+    cursor.execute('''
+    SELECT location_z FROM connector WHERE id IN (%s)
+    ''' % ids)
+    z_values = [row[0] for row in cursor.fetchall()]
+    cursor.execute('''
+    SELECT treenode_id FROM treenode_connector WHERE connector_id IN (%s)
+    ''' % ids)
+    treenode_ids = [row[0] for row in cursor.fetchall()]
+    if treenode_ids:
+        z_values.extend(_treenode_sections(cursor, treenode_ids))
+    invalidate_sections(project_id, z_values)
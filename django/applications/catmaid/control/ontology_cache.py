@@ -0,0 +1,111 @@
+""" A per-process cache of the relation and class IDs of projects, keyed by
+their names.
+
+Almost every request needs some of these IDs, but they change only when
+tracing is set up for a project or ontologies are edited. The names and IDs
+of a project are loaded at once and are kept for
+settings.ONTOLOGY_CACHE_TIMEOUT seconds, a timeout of 0 disables the cache.
+Projects without any relations or classes aren't cached. Saving or deleting
+relations and classes clears the entries of their project in the process
+that made the change right away and once more after the request finished,
+i.e. after its transaction has been committed. Other processes see such
+changes after the timeout at the latest, or when a name is looked up that
+is missing from the cached dictionary: this loads the names and IDs of the
+project again once, before a KeyError is raised.
+"""
+
+import threading
+
+from django.core.signals import request_finished
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from catmaid.models import Relation, Class
+from catmaid.control.cache import TimedCache
+
+
+_relations = TimedCache('ONTOLOGY_CACHE_TIMEOUT', keep_empty=False)
+_classes = TimedCache('ONTOLOGY_CACHE_TIMEOUT', keep_empty=False)
+# IDs of the projects whose relations or classes were changed by the current
+# thread during the current request.
+_pending = threading.local()
+
+
+class _IdMap(dict):
+    """ A copy of the name vs ID dictionary of a project. The first lookup of
+    a missing name loads the dictionary again, because the name may have been
+    created by another process after the dictionary was cached.
+    """
+
+    def __init__(self, ids, reload):
+        super(_IdMap, self).__init__(ids)
+        self._reload = reload
+
+    def __missing__(self, name):
+        reload, self._reload = self._reload, None
+        if reload is None:
+            raise KeyError(name)
+        self.update(reload())
+        return self[name]
+
+
+def _cached(cache, project_id, fetch):
+    """ Returns a copy of the name vs ID dictionary cached for the project or
+    fetches and caches it with <fetch> if there is none or it expired.
+    """
+    project_id = int(project_id)
+    def reload():
+        cache.discard(project_id)
+        return cache.get(project_id, lambda: fetch(project_id))
+    return _IdMap(cache.get(project_id, lambda: fetch(project_id)), reload)
+
+
+def get_relation_ids(project_id):
+    """ Returns a dictionary of relation name vs ID of the project.
+    """
+    return _cached(_relations, project_id, lambda pid: dict(
+            Relation.objects.filter(project=pid).values_list(
+                'relation_name', 'id')))
+
+
+def get_class_ids(project_id):
+    """ Returns a dictionary of class name vs ID of the project.
+    """
+    return _cached(_classes, project_id, lambda pid: dict(
+            Class.objects.filter(project=pid).values_list('class_name', 'id')))
+
+
+def clear_ontology_cache(project_id=None):
+    """ Removes the relations and classes of the project with the passed in
+    ID or of all projects from the cache.
+    """
+    if project_id is None:
+        _relations.clear()
+        _classes.clear()
+    else:
+        _relations.discard(int(project_id))
+        _classes.discard(int(project_id))
+
+
+def _on_change(sender, instance, **kwargs):
+    clear_ontology_cache(instance.project_id)
+    pending = getattr(_pending, 'project_ids', None)
+    if pending is None:
+        pending = _pending.project_ids = set()
+    pending.add(instance.project_id)
+
+
+for model in (Relation, Class):
+    post_save.connect(_on_change, sender=model,
+            dispatch_uid='catmaid.ontology_cache.save.%s' % model.__name__)
+    post_delete.connect(_on_change, sender=model,
+            dispatch_uid='catmaid.ontology_cache.delete.%s' % model.__name__)
+
+
+@receiver(request_finished)
+def _clear_pending(sender, **kwargs):
+    project_ids = getattr(_pending, 'project_ids', None)
+    if project_ids:
+        _pending.project_ids = None
+        for project_id in project_ids:
+            clear_ontology_cache(project_id)
@@ -0,0 +1,75 @@
+""" A per-process cache of the roles users have in projects and of the users
+whose work they can edit (their edit domain).
+
+Both are looked up on almost every request, but change rarely. Entries expire
+after settings.PERMISSION_CACHE_TIMEOUT seconds, a timeout of 0 disables the
+cache. Changes to users, groups, group memberships and object permissions
+clear the cache of the process that made them right away and once more after
+the request finished, i.e. after its transaction has been committed. Other
+processes see such changes after the timeout at the latest.
+"""
+
+import threading
+
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+from django.contrib.auth.models import User, Group
+from django.core.signals import request_finished
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from catmaid.control.cache import TimedCache
+
+
+_roles = TimedCache('PERMISSION_CACHE_TIMEOUT')
+_domains = TimedCache('PERMISSION_CACHE_TIMEOUT')
+# Set in threads that changed permissions during the current request
+_pending = threading.local()
+
+
+def get_project_roles(user, project_id, fetch):
+    """ Returns the set of permission codenames <user> has on the project
+    with ID <project_id>. If they aren't cached, they are computed with
+    <fetch>, which is called without arguments.
+    """
+    return _roles.get((user.id, int(project_id)), fetch)
+
+
+def get_edit_domain(user_id, fetch):
+    """ Returns the set of IDs of the users whose work the user with ID
+    <user_id> can edit. If it isn't cached, it is computed with <fetch>, which
+    is called without arguments.
+    """
+    return _domains.get(int(user_id), fetch)
+
+
+def clear_permission_cache():
+    _roles.clear()
+    _domains.clear()
+
+
+def _on_change(sender, **kwargs):
+    # Logins save users only to update their last login time, which doesn't
+    # affect permissions.
+    if kwargs.get('update_fields') == frozenset(['last_login']):
+        return
+    clear_permission_cache()
+    _pending.changed = True
+
+
+for model in (User, Group, UserObjectPermission, GroupObjectPermission):
+    post_save.connect(_on_change, sender=model,
+            dispatch_uid='catmaid.permission_cache.save.%s' % model.__name__)
+    post_delete.connect(_on_change, sender=model,
+            dispatch_uid='catmaid.permission_cache.delete.%s' % model.__name__)
+for through in (User.groups.through, User.user_permissions.through,
+        Group.permissions.through):
+    m2m_changed.connect(_on_change, sender=through,
+            dispatch_uid='catmaid.permission_cache.m2m.%s' % through.__name__)
+
+
+@receiver(request_finished)
+def _clear_pending(sender, **kwargs):
+    if getattr(_pending, 'changed', False):
+        _pending.changed = False
+        clear_permission_cache()
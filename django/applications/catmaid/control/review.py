@@ -90,42 +90,52 @@ def get_review_status(skeleton_ids, user_ids=None, excluding_user_ids=None):
         num_reviewed = 0
     skeletons = defaultdict(Skeleton)
 
-    # Count nodes of each skeleton
+    # Get the number of nodes and the total number of reviewed nodes of
+    # each skeleton from the skeleton summary.
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes, num_reviewed
+    FROM skeleton_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
     ''' % ",".join(map(str, skeleton_ids)))
     for row in cursor.fetchall():
-        skeletons[row[0]].num_nodes = row[1]
-
-    # Optionally, add a user filter
-    if user_ids:
-        # Count number of nodes reviewed by a certain set of users,
-        # per skeleton.
-        user_filter = " AND reviewer_id IN (%s)" % \
-            ",".join(map(str, user_ids))
-    elif excluding_user_ids:
-        # Count number of nodes reviewed by all users excluding the
-        # specified ones, per skeleton.
-        user_filter = " AND reviewer_id NOT IN (%s)" % \
-            ",".join(map(str, excluding_user_ids))
-    else:
-        # Count total number of reviewed nodes per skeleton, regardless
-        # of reviewer.
-        user_filter = ""
-
-    cursor.execute('''
-    SELECT skeleton_id, count(*)
-    FROM (SELECT skeleton_id, treenode_id
-          FROM review
-          WHERE skeleton_id IN (%s)%s
-          GROUP BY skeleton_id, treenode_id) AS sub
-    GROUP BY skeleton_id
-    ''' % (",".join(map(str, skeleton_ids)), user_filter))
-    for row in cursor.fetchall():
-        skeletons[row[0]].num_reviewed = row[1]
+        skeleton = skeletons[row[0]]
+        skeleton.num_nodes = row[1]
+        if not user_ids and not excluding_user_ids:
+            skeleton.num_reviewed = row[2]
+
+    if user_ids and len(user_ids) == 1:
+        # Count number of nodes reviewed by a single user, per skeleton
+        cursor.execute('''
+        SELECT skeleton_id, num_reviewed
+        FROM review_summary
+        WHERE skeleton_id IN (%s) AND reviewer_id = %s
+        ''' % (",".join(map(str, skeleton_ids)), int(next(iter(user_ids)))))
+        for row in cursor.fetchall():
+            skeletons[row[0]].num_reviewed = row[1]
+    elif user_ids or excluding_user_ids:
+        # Nodes can be reviewed by more than one user, therefore the number of
+        # nodes reviewed by a set of users has to be counted.
+        if user_ids:
+            # Count number of nodes reviewed by a certain set of users,
+            # per skeleton.
+            user_filter = " AND reviewer_id IN (%s)" % \
+                ",".join(map(str, user_ids))
+        else:
+            # Count number of nodes reviewed by all users excluding the
+            # specified ones, per skeleton.
+            user_filter = " AND reviewer_id NOT IN (%s)" % \
+                ",".join(map(str, excluding_user_ids))
+
+        cursor.execute('''
+        SELECT skeleton_id, count(*)
+        FROM (SELECT skeleton_id, treenode_id
+              FROM review
+              WHERE skeleton_id IN (%s)%s
+              GROUP BY skeleton_id, treenode_id) AS sub
+        GROUP BY skeleton_id
+        ''' % (",".join(map(str, skeleton_ids)), user_filter))
+        for row in cursor.fetchall():
+            skeletons[row[0]].num_reviewed = row[1]
 
     status = {}
     for skid, s in skeletons.iteritems():
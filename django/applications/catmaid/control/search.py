@@ -1,10 +1,77 @@
 import json
 
+from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.models import UserRole, ClassInstance, TreenodeClassInstance
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.common import get_relation_to_id_map, \
+        get_class_to_id_map
+
+# The maximum number of names returned if no valid limit is requested, and
+# the largest limit that can be requested
+DEFAULT_RESULT_LIMIT = 500
+MAX_RESULT_LIMIT = 10000
+
+
+def _escape_like(text):
+    """ Escapes the wildcards of LIKE patterns in <text>.
+    """
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _find_by_name(project_id, search_string, prefix_only, limit,
+        class_names=None):
+    """ Returns a list of the class instances of the project whose name
+    contains (or starts with) the search string, regardless of case, as
+    dictionaries with the fields id, name and class_column__class_name. The
+    best matching <limit> names are returned: exact matches come first, then
+    names starting with the search string and then all other ones. The
+    returned names are ordered by class name and name. If class names are
+    passed, only instances of these classes are searched.
+
+    Prefixes are looked up with an index on the lower case names, substrings
+    with a trigram index, if the pg_trgm extension is available.
+    """
+    params = {
+        'project_id': int(project_id),
+        'name': search_string.lower(),
+        'prefix': _escape_like(search_string.lower()) + '%',
+        'substring': '%' + _escape_like(search_string) + '%',
+        'limit': int(limit),
+    }
+    if prefix_only:
+        condition = "lower(ci.name) LIKE %(prefix)s"
+    else:
+        condition = "ci.name ILIKE %(substring)s"
+    if class_names:
+        class_map = get_class_to_id_map(project_id)
+        params['class_ids'] = [class_map[c] for c in class_names
+                if c in class_map]
+        if not params['class_ids']:
+            return []
+        condition += " AND ci.class_id = ANY(%(class_ids)s)"
+
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT matches.id, matches.name, c.class_name
+    FROM (
+        SELECT ci.id, ci.name, ci.class_id,
+               CASE WHEN lower(ci.name) = %%(name)s THEN 0
+                    WHEN lower(ci.name) LIKE %%(prefix)s THEN 1
+                    ELSE 2 END AS rank
+        FROM class_instance ci
+        WHERE ci.project_id = %%(project_id)s
+          AND %s
+        ORDER BY rank, ci.name
+        LIMIT %%(limit)s
+    ) matches
+    JOIN class c ON c.id = matches.class_id
+    ORDER BY c.class_name, matches.name
+    ''' % condition, params)
+
+    return [{'id': row[0], 'name': row[1], 'class_column__class_name': row[2]}
+            for row in cursor.fetchall()]
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -25,17 +92,17 @@ def search(request, project_id=None):
             'skid': node['treenode__skeleton']}
 
     search_string = request.GET.get('substring', "")
+    match = request.GET.get('match', 'substring')
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_RESULT_LIMIT))
+    except ValueError:
+        limit = DEFAULT_RESULT_LIMIT
+    limit = max(1, min(limit, MAX_RESULT_LIMIT))
+    class_names = request.GET.getlist('class_names[]')
 
-    ids = set()
-
-    # 1. Query ClassInstance objects, where the name contains the search string.
-    # This retrieves neurons, skeletons and groups by name.
-    row_query = ClassInstance.objects.values('id', 'name', 'class_column__class_name').filter(
-        name__icontains=search_string,
-        project=project_id).order_by('class_column__class_name', 'name')
-    rows = list(row_query)
-    for row in rows:
-        ids.add(row['id'])
+    rows = _find_by_name(project_id, search_string, match == 'prefix', limit,
+            class_names)
+    ids = set(row['id'] for row in rows)
 
     # 2. Query skeletons and neurons by ID, if the search string is a number
     try:
@@ -44,6 +111,9 @@ def search(request, project_id=None):
                 pk=int(oid),
                 class_column__class_name__in=('neuron', 'skeleton')
                 ).values('id', 'name', 'class_column__class_name')
+        if class_names:
+            oid_query = oid_query.filter(
+                    class_column__class_name__in=class_names)
         for row in oid_query:
             if row['id'] not in ids:
                 rows.append(row)
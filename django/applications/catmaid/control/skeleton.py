@@ -1,6 +1,5 @@
 import decimal
 import json
-import networkx as nx
 from operator import itemgetter
 from datetime import datetime, timedelta
 from collections import defaultdict
@@ -14,13 +13,17 @@ from catmaid.models import Project, UserRole, Class, ClassInstance, Review, \
 from catmaid.objects import Skeleton
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
-from catmaid.control.common import insert_into_log, get_relation_to_id_map 
+from catmaid.control.common import insert_into_log, get_relation_to_id_map, \
+        get_class_to_id_map
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.neuron_annotations import create_annotation_query, \
         _annotate_entities, _update_neuron_annotations
 from catmaid.control.review import get_treenodes_to_reviews, get_review_status
+from catmaid.control.synapse_edges import get_downstream_partners, \
+        get_upstream_partners
 from catmaid.control.treenode import _create_interpolated_treenode
-from catmaid.control.tree_util import reroot, edge_count_to_root
+from catmaid.control.tree_util import ArrayTree
+from catmaid.control import node_cache
 
 
 def get_skeleton_permissions(request, project_id, skeleton_id):
@@ -57,50 +60,31 @@ def last_openleaf(request, project_id=None, skeleton_id=None):
     ''' % (labeled_as, int(skeleton_id)))
 
     # Some entries repeated, when a node has more than one tag
-    # Create a graph with edges from parent to child, and accumulate parents
-    tree = nx.DiGraph()
+    nodes = {}
+    tags = {}
     for row in cursor.fetchall():
-        nodeID = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], nodeID)
-        else:
-            tree.add_node(nodeID)
-        tree.node[nodeID]['loc'] = (row[2], row[3], row[4])
+        nodes[row[0]] = row[1:5]
         if row[5]:
-            props = tree.node[nodeID]
-            tags = props.get('tags')
-            if tags:
-                tags.append(row[5])
-            else:
-                props['tags'] = [row[5]]
+            tags.setdefault(row[0], []).append(row[5])
 
-    if tnid not in tree:
+    if tnid not in nodes:
         raise Exception("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
-    reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
-
-    # Iterate end nodes, find closest
-    nearest = None
-    distance = tree.number_of_nodes() + 1
-    loc = None
-    other_tags = set(('uncertain continuation', 'not a branch', 'soma'))
+    node_ids = nodes.keys()
+    rows = nodes.values()
+    tree = ArrayTree.from_parent_ids(node_ids, [r[0] for r in rows],
+            [r[1:] for r in rows])
+    tree.reroot(tree.index(tnid))
+    distances = tree.depths()
 
-    for nodeID, out_degree in tree.out_degree_iter():
-        if 0 == out_degree:
-            # Found an end node
-            props = tree.node[nodeID]
-            # Check if not tagged with a tag containing 'end'
-            if not 'tags' in props and not [s for s in props if 'end' in s or s in other_tags]:
-                # Found an open end
-                d = distances[nodeID]
-                if d < distance:
-                    nearest = nodeID
-                    distance = d
-                    loc = props['loc']
+    # Iterate end nodes, find the closest one that is not tagged
+    open_ends = [i for i in tree.end_nodes() if tree.node_ids[i] not in tags]
+    if not open_ends:
+        return HttpResponse(json.dumps((None, None)))
+    nearest = min(open_ends, key=lambda i: distances[i])
+    loc = tuple(nodes[tree.node_ids[nearest]][1:])
 
-    return HttpResponse(json.dumps((nearest, loc)))
+    return HttpResponse(json.dumps((int(tree.node_ids[nearest]), loc)))
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -153,7 +137,7 @@ def contributor_statistics(request, project_id=None, skeleton_id=None):
                 min_review_minutes.add(minute)
         multi_review_minutes += len(reviewer_minutes)
 
-    relations = {row[0]: row[1] for row in Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id')}
+    relations = get_relation_to_id_map(project_id)
 
     synapses = {}
     synapses[relations['presynaptic_to']] = defaultdict(int)
@@ -315,26 +299,6 @@ def split_skeleton(request, project_id=None):
     # Make sure the user has permissions to edit
     can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
 
-    # retrieve the id, parent_id of all nodes in the skeleton
-    # with minimal ceremony
-    cursor.execute('''
-    SELECT id, parent_id FROM treenode WHERE skeleton_id=%s
-    ''' % skeleton_id) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -362,25 +326,51 @@ def split_skeleton(request, project_id=None):
     cici.user = skeleton.user # The same user that owned the skeleton to split
     cici.project_id = project_id
     cici.save()
-    # update skeleton_id of list in treenode table
-    # This creates a lazy QuerySet that, upon calling update, returns a new QuerySet
-    # that is then executed. It does NOT create an update SQL query for every treenode.
-    tns = Treenode.objects.filter(id__in=change_list).update(skeleton=new_skeleton)
-    # update the skeleton_id value of the treenode_connector table
-    tc = TreenodeConnector.objects.filter(
-        relation__relation_name__endswith = 'synaptic_to',
-        treenode__in=change_list,
-    ).update(skeleton=new_skeleton)
+    # Move the treenodes downstream of the split node, including it, as well
+    # as their synaptic links and reviews to the new skeleton. The subtree is
+    # found by the database and all three tables are updated by one statement.
+    # This is done as bulk update, which updates the summaries of both
+    # skeletons once instead of for every row.
+    relations = get_relation_to_id_map(project_id)
+    synaptic_relation_ids = [rid for name, rid in relations.iteritems()
+            if name.endswith('synaptic_to')]
+    cursor.execute('''
+    SELECT begin_bulk_update(ARRAY(
+        WITH RECURSIVE downstream(id) AS (
+            SELECT %s::bigint
+            UNION ALL
+            SELECT t.id FROM treenode t JOIN downstream d ON t.parent_id = d.id
+        )
+        SELECT id FROM downstream), '{}')
+    ''', (treenode_id,))
+    cursor.execute('''
+    WITH links AS (
+        UPDATE treenode_connector tc SET skeleton_id = %(skeleton_id)s
+        FROM bulk_treenode b
+        WHERE tc.treenode_id = b.id
+          AND tc.relation_id = ANY(%(relation_ids)s)
+    ), reviews AS (
+        UPDATE review r SET skeleton_id = %(skeleton_id)s
+        FROM bulk_treenode b
+        WHERE r.treenode_id = b.id
+    )
+    UPDATE treenode t SET skeleton_id = %(skeleton_id)s
+    FROM bulk_treenode b
+    WHERE t.id = b.id
+    ''', {
+        'skeleton_id': new_skeleton.id,
+        'relation_ids': synaptic_relation_ids,
+    })
     # setting new root treenode's parent to null
     Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
+    cursor.execute('SELECT end_bulk_update()')
 
     # Update annotations of existing neuron to have only over set
     _update_neuron_annotations(project_id, request.user, neuron.id,
             upstream_annotation_map)
 
-    # Update all reviews of the treenodes that are moved to a new neuron to
-    # refer to the new skeleton.
-    Review.objects.filter(treenode_id__in=change_list).update(skeleton=new_skeleton)
+    # Cached field of view tiles carry skeleton IDs
+    node_cache.invalidate_project(project_id)
 
     # Update annotations of under skeleton
     _annotate_entities(project_id, [new_neuron.id], downstream_annotation_map)
@@ -474,7 +464,11 @@ def skeleton_ancestry(request, project_id=None):
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
-def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_of_id, cursor):
+def _connected_skeletons(skeleton_ids, op, downstream, model_of_id, cursor):
+    """ Returns a dictionary of skeletons that are postsynaptic (if
+    <downstream> is true) or presynaptic to the passed in skeletons vs a
+    Partner object with information about them.
+    """
     class Partner:
         def __init__(self):
             self.name = None
@@ -488,20 +482,16 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
         return Partner()
     partners = defaultdict(newPartner)
 
-    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2:
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, skeleton_ids)), int(relation_id_1), int(relation_id_2)))
+    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse
+    if downstream:
+        connections = get_downstream_partners(skeleton_ids, cursor)
+    else:
+        connections = get_upstream_partners(skeleton_ids, cursor)
 
     # Sum the number of synapses
-    for srcID, partnerID in cursor.fetchall():
-        partners[partnerID].skids[srcID] += 1
+    for srcID, c in connections.iteritems():
+        for partnerID, count in c.iteritems():
+            partners[partnerID].skids[srcID] += count
 
     # There may not be any synapses
     if not partners:
@@ -520,40 +510,29 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
     # Obtain a string with unique skeletons
     skids_string = ','.join(map(str, partners.iterkeys()))
 
-    # Count nodes of each partner skeleton
+    # Get the number of nodes and the total number of reviewed nodes of each
+    # partner skeleton from the skeleton summary.
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, num_nodes, num_reviewed
+    FROM skeleton_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
     ''' % skids_string) # no need to sanitize
     for row in cursor.fetchall():
-        partners[row[0]].num_nodes = row[1]
+        partner = partners[row[0]]
+        partner.num_nodes = row[1]
+        partner.union_reviewed = row[2]
 
-    # Count nodes that have been reviewed by each user in each partner skeleton
+    # Get the number of nodes that have been reviewed by each user in each
+    # partner skeleton
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
+    SELECT skeleton_id, reviewer_id, num_reviewed
+    FROM review_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
     ''' % skids_string) # no need to sanitize
     for row in cursor.fetchall():
         partner = partners[row[0]]
         partner.reviewed[row[1]] = row[2]
 
-    # Count total number of reviewed nodes per skeleton
-    cursor.execute('''
-    SELECT skeleton_id, count(*)
-    FROM (SELECT skeleton_id, treenode_id
-          FROM review
-          WHERE skeleton_id IN (%s)
-          GROUP BY skeleton_id, treenode_id) AS sub
-    GROUP BY skeleton_id
-    ''' % skids_string) # no need to sanitize
-    for row in cursor.fetchall():
-        partner = partners[row[0]]
-        partner.union_reviewed = row[1]
-
     # Obtain name of each skeleton's neuron
     cursor.execute('''
     SELECT class_instance_class_instance.class_instance_a,
@@ -572,20 +551,18 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
 def _skeleton_info_raw(project_id, skeletons, op):
     cursor = connection.cursor()
 
-    # Obtain the IDs of the 'presynaptic_to', 'postsynaptic_to' and 'model_of' relations
+    # Obtain the ID of the 'model_of' relation
     cursor.execute('''
-    SELECT relation_name,
-           id
+    SELECT id
     FROM relation
     WHERE project_id=%s
-      AND (relation_name='presynaptic_to'
-        OR relation_name='postsynaptic_to'
-        OR relation_name='model_of')''' % project_id)
-    relation_ids = dict(cursor.fetchall())
+      AND relation_name='model_of'
+    ''' % project_id)
+    model_of_id = cursor.fetchone()[0]
 
     # Obtain partner skeletons and their info
-    incoming = _connected_skeletons(skeletons, op, relation_ids['postsynaptic_to'], relation_ids['presynaptic_to'], relation_ids['model_of'], cursor)
-    outgoing = _connected_skeletons(skeletons, op, relation_ids['presynaptic_to'], relation_ids['postsynaptic_to'], relation_ids['model_of'], cursor)
+    incoming = _connected_skeletons(skeletons, op, False, model_of_id, cursor)
+    outgoing = _connected_skeletons(skeletons, op, True, model_of_id, cursor)
 
     def prepare(partners):
         for partnerID in partners.keys():
@@ -720,38 +697,15 @@ def _reroot_skeleton(treenode_id, project_id):
         if first_parent is None:
             return False
 
-        # Traverse up the chain of parents, reversing the parent relationships so
+        # Reverse the parent relationships along the path to the old root so
         # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parent = treenode
-        new_confidence = treenode.confidence
-        node = first_parent
-
-        while True:
-            response_on_error = 'Failed to update treenode with id %s to have new parent %s' % (node.id, new_parent.id)
-
-            # Store current values to be used in next iteration
-            parent = node.parent
-            confidence = node.confidence
-
-            # Set new values
-            node.parent = new_parent
-            node.confidence = new_confidence
-            node.save()
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        response_on_error = 'Failed to set treenode with ID %s as root.' % treenode.id
+        response_on_error = 'Failed to reverse the path from treenode ' \
+                'with ID %s to the root.' % treenode.id
+        _reverse_path_to_root(treenode.id)
         treenode.parent = None
-        treenode.confidence = 5 # reset to maximum confidence, now it is root.
-        treenode.save()
+        treenode.confidence = 5 # maximum confidence, now it is root.
+
+        node_cache.invalidate_project(project_id)
 
         return treenode
 
@@ -759,6 +713,45 @@ def _reroot_skeleton(treenode_id, project_id):
         raise Exception(response_on_error + ':' + str(e))
 
 
+def _reverse_path_to_root(treenode_id):
+    """ Makes the treenode with the passed in ID the root of its skeleton by
+    reversing the parent relationships of all nodes on the path to the current
+    root. Edge confidences move with their edges and the new root gets the
+    maximum confidence. All nodes are updated by a single statement, as bulk
+    update. Returns the number of updated nodes.
+    """
+    path_query = '''
+    WITH RECURSIVE path(id, parent_id, confidence, depth) AS (
+        SELECT id, parent_id, confidence, 0
+        FROM treenode WHERE id = %(treenode_id)s
+        UNION ALL
+        SELECT t.id, t.parent_id, t.confidence, p.depth + 1
+        FROM treenode t JOIN path p ON t.id = p.parent_id
+    )
+    '''
+    params = {'treenode_id': int(treenode_id)}
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT begin_bulk_update(ARRAY(%s SELECT id FROM path), '{}')
+    ''' % path_query, params)
+    cursor.execute(path_query + '''
+    , reversed AS (
+        SELECT id,
+               lag(id) OVER w AS parent_id,
+               coalesce(lag(confidence) OVER w, 5) AS confidence
+        FROM path
+        WINDOW w AS (ORDER BY depth)
+    )
+    UPDATE treenode t
+    SET parent_id = r.parent_id, confidence = r.confidence
+    FROM reversed r
+    WHERE t.id = r.id
+    ''', params)
+    count = cursor.rowcount
+    cursor.execute('SELECT end_bulk_update()')
+    return count
+
+
 def _root_as_parent(oid):
     """ Returns True if the parent group of the given element ID is the root group. """
     cursor = connection.cursor()
@@ -861,7 +854,13 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         _reroot_skeleton(to_treenode_id, project_id)
 
         # The target skeleton is removed and its treenode assumes
-        # the skeleton id of the from-skeleton.
+        # the skeleton id of the from-skeleton. All nodes of the target
+        # skeleton are changed as one bulk update.
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT begin_bulk_update(ARRAY(
+            SELECT id FROM treenode WHERE skeleton_id = %s), '{}')
+        ''', (to_skid,))
 
         response_on_error = 'Could not update Treenode table with new skeleton id for joined treenodes.'
         Treenode.objects.filter(skeleton=to_skid).update(skeleton=from_skid)
@@ -874,6 +873,12 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         response_on_error = 'Couldn not update reviews with new skeleton IDs for joined treenodes.'
         Review.objects.filter(skeleton_id=to_skid).update(skeleton=from_skid)
 
+        # Update the parent of to_treenode.
+        response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
+        Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
+
+        cursor.execute('SELECT end_bulk_update()')
+
         # Remove skeleton of to_id (deletes cicic part_of to neuron by cascade,
         # leaving the parent neuron dangling in the object tree).
         response_on_error = 'Could not delete skeleton with ID %s.' % to_skid
@@ -882,9 +887,7 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         # Remove the 'losing' neuron if it is empty
         _delete_if_empty(to_neuron['neuronid'])
 
-        # Update the parent of to_treenode.
-        response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
-        Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
+        node_cache.invalidate_project(project_id)
 
         # Update linked annotations of neuron
         response_on_error = 'Could not update annotations of neuron ' \
@@ -932,7 +935,7 @@ def join_skeletons_interpolated(request, project_id=None):
     params['skeleton_id'] = Treenode.objects.get(pk=params['from_id']).skeleton_id
 
     # Create interpolate nodes skipping the last one
-    last_treenode_id, skeleton_id = _create_interpolated_treenode(request, params, project_id, True)
+    last_treenode_id, skeleton_id, _ = _create_interpolated_treenode(request, params, project_id, True)
 
     # Get set of annoations the combinet skeleton should have
     annotation_map = json.loads(request.POST.get('annotation_set'))
@@ -990,8 +993,8 @@ def annotation_list(request, project_id=None):
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id)
+    relations = get_relation_to_id_map(project_id)
 
     cursor = connection.cursor()
 
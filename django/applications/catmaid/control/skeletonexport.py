@@ -1,22 +1,33 @@
 import json
+import struct
+import tarfile
+import time
 import networkx as nx
-from itertools import imap
+import numpy as np
+from cStringIO import StringIO
+from itertools import imap, groupby
+from operator import itemgetter
 from functools import partial
 from collections import defaultdict
-from math import sqrt
 from datetime import datetime
 
-from django.db import connection
-from django.http import HttpResponse
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 
-from catmaid.models import UserRole, ClassInstance, Treenode, \
-        TreenodeClassInstance, ConnectorClassInstance, Review
+from catmaid.models import Project, UserRole, ClassInstance, Treenode, \
+        TreenodeClassInstance, ConnectorClassInstance, Review, \
+        ClassInstanceClassInstance
 from catmaid.control import export_NeuroML_Level3
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map, \
+        get_class_to_id_map
+from catmaid.control.neuron_annotations import \
+        create_basic_annotated_entity_query
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
 
-from tree_util import edge_count_to_root, partition
+from tree_util import edge_count_to_root
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
@@ -38,21 +49,14 @@ def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     return treenode_qs, labels_qs, labelconnector_qs
 
 
+def _swc_line(node_id, parent_id, x, y, z, radius):
+    return "%s 0 %s %s %s %s %s\n" % (node_id, x, y, z, max(radius, 0),
+            -1 if parent_id is None else parent_id)
+
+
 def get_swc_string(treenodes_qs):
-    all_rows = []
-    for tn in treenodes_qs:
-        swc_row = [tn.id]
-        swc_row.append(0)
-        swc_row.append(tn.location_x)
-        swc_row.append(tn.location_y)
-        swc_row.append(tn.location_z)
-        swc_row.append(max(tn.radius, 0))
-        swc_row.append(-1 if tn.parent_id is None else tn.parent_id)
-        all_rows.append(swc_row)
-    result = ""
-    for row in all_rows:
-        result += " ".join(map(str, row)) + "\n"
-    return result
+    return "".join(_swc_line(tn.id, tn.parent_id, tn.location_x,
+            tn.location_y, tn.location_z, tn.radius) for tn in treenodes_qs)
 
 def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
     treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
@@ -65,12 +69,144 @@ def export_skeleton_response(request, project_id=None, skeleton_id=None, format=
         raise Exception, "Unknown format ('%s') in export_skeleton_response" % (format,)
 
 
+# Column types of the binary skeleton format, in the order they are selected
+# from the database (big-endian, as sent by PostgreSQL) and in the order they
+# are written to a response (little-endian).
+NODE_COLUMNS = (
+    ('id', 'bigint', '<i8'),
+    ('parent_id', 'bigint', '<i8'),
+    ('user_id', 'integer', '<i4'),
+    ('x', 'real', '<f4'),
+    ('y', 'real', '<f4'),
+    ('z', 'real', '<f4'),
+    ('radius', 'real', '<f4'),
+    ('confidence', 'smallint', '<u1'))
+
+SKELETON_CONNECTOR_COLUMNS = (
+    ('treenode_id', 'bigint', '<i8'),
+    ('connector_id', 'bigint', '<i8'),
+    ('relation', 'smallint', '<u1'),
+    ('x', 'real', '<f4'),
+    ('y', 'real', '<f4'),
+    ('z', 'real', '<f4'))
+
+ARBOR_CONNECTOR_COLUMNS = (
+    ('treenode_id', 'bigint', '<i8'),
+    ('confidence', 'smallint', '<u1'),
+    ('connector_id', 'bigint', '<i8'),
+    ('partner_confidence', 'smallint', '<u1'),
+    ('partner_treenode_id', 'bigint', '<i8'),
+    ('partner_skeleton_id', 'bigint', '<i8'),
+    ('relation', 'smallint', '<u1'),
+    ('partner_relation', 'smallint', '<u1'))
+
+TAG_COLUMNS = (
+    ('treenode_id', 'bigint', '<i8'),
+    ('tag', 'integer', '<i4'))
+
+# PostgreSQL's binary representation of the types above
+_PG_BINARY_TYPES = {'bigint': '>i8', 'integer': '>i4', 'smallint': '>i2',
+                    'real': '>f4', 'double precision': '>f8'}
+
+
+def _binary_format_requested(request):
+    return 'binary' == request.GET.get('format', request.POST.get('format'))
+
+
+def _fetch_columns(cursor, query, columns):
+    """ Runs the passed in query as binary COPY and returns a NumPy record
+    array with one field for each of the given columns. The query has to
+    select exactly these columns, cast to their SQL types and without NULL
+    values. This avoids creating Python objects for every row.
+    """
+    buf = StringIO()
+    cursor.copy_expert('COPY (%s) TO STDOUT WITH BINARY' % query, buf)
+    data = buf.getvalue()
+    # The header consists of an 11 byte signature, 32 bit flags and the 32 bit
+    # length of a header extension. A 16 bit trailer marks the end of data.
+    extension_length = struct.unpack('>i', data[15:19])[0]
+    body = data[19 + extension_length:-2]
+    # Every row starts with its 16 bit field count and every field with its
+    # 32 bit length.
+    fields = [('n_fields', '>i2')]
+    for name, sql_type, _ in columns:
+        fields.append((name + '_length', '>i4'))
+        fields.append((name, _PG_BINARY_TYPES[sql_type]))
+    if not body:
+        return np.zeros(0, dtype=np.dtype(fields))
+    return np.frombuffer(body, dtype=np.dtype(fields))
+
+
+def _binary_response(tables, tag_names):
+    """ Creates a response in the binary skeleton format from a list of
+    (table name, columns, record array) tuples and a list of tag names. All
+    values are little-endian. The format starts with a header:
+
+        4 bytes 'CMSK', uint16 version (1), uint16 number of tables
+
+    Each table starts with a header, followed by its columns as contiguous
+    arrays:
+
+        uint16 name length, name, uint32 number of rows,
+        uint16 number of columns, and for each column:
+            uint16 name length, name, 3 byte NumPy type (e.g. '<i8')
+
+    The response ends with the tag names, referenced by index from the tags
+    table, as UTF-8 encoded JSON list, prefixed with its uint32 length.
+    """
+    out = StringIO()
+    out.write(struct.pack('<4sHH', 'CMSK', 1, len(tables)))
+    for table_name, columns, records in tables:
+        out.write(struct.pack('<H', len(table_name)))
+        out.write(table_name)
+        out.write(struct.pack('<IH', len(records), len(columns)))
+        for name, _, dtype in columns:
+            out.write(struct.pack('<H', len(name)))
+            out.write(name)
+            out.write(dtype)
+        for name, _, dtype in columns:
+            out.write(records[name].astype(dtype).tostring())
+    names = json.dumps(tag_names, separators=(',', ':')).encode('utf-8')
+    out.write(struct.pack('<I', len(names)))
+    out.write(names)
+    return HttpResponse(out.getvalue(), content_type='application/octet-stream')
+
+
+def _binary_tags(tags):
+    """ Converts a dictionary of tag names vs treenode IDs into a list of names
+    and a record array with treenode IDs and tag indices.
+    """
+    names = tags.keys()
+    records = np.zeros(sum(len(v) for v in tags.itervalues()),
+            dtype=[('treenode_id', '<i8'), ('tag', '<i4')])
+    i = 0
+    for index, name in enumerate(names):
+        treenode_ids = tags[name]
+        records['treenode_id'][i:i + len(treenode_ids)] = treenode_ids
+        records['tag'][i:i + len(treenode_ids)] = index
+        i += len(treenode_ids)
+    return names, records
+
+
+def _node_columns_query(skeleton_id):
+    return '''
+        SELECT id::bigint, COALESCE(parent_id, -1)::bigint, user_id::integer,
+               location_x::real, location_y::real, location_z::real,
+               radius::real, confidence::smallint
+        FROM treenode
+        WHERE skeleton_id = %s
+    ''' % skeleton_id
+
+
 @requires_user_role(UserRole.Browse)
 def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors=None, with_tags=None):
     """
         Performance-critical function. Do not edit unless to improve performance.
 
         Returns, in JSON, [[nodes], [connectors], {nodeID: [tags]}], with connectors and tags being empty when 0 == with_connectors and 0 == with_tags, respectively
+
+        With format=binary, the same data is returned in the binary skeleton
+        format (see _binary_response), with a nodes, connectors and tags table.
     """
 
     # Sanitize
@@ -78,18 +214,23 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
     skeleton_id = int(skeleton_id)
     with_connectors  = int(with_connectors)
     with_tags = int(with_tags)
+    binary = _binary_format_requested(request)
 
     cursor = connection.cursor()
 
-    cursor.execute('''
-        SELECT id, parent_id, user_id,
-               location_x, location_y, location_z,
-               radius, confidence
-        FROM treenode
-        WHERE skeleton_id = %s
-    ''' % skeleton_id)
+    if binary:
+        nodes = _fetch_columns(cursor, _node_columns_query(skeleton_id),
+                NODE_COLUMNS)
+    else:
+        cursor.execute('''
+            SELECT id, parent_id, user_id,
+                   location_x, location_y, location_z,
+                   radius, confidence
+            FROM treenode
+            WHERE skeleton_id = %s
+        ''' % skeleton_id)
 
-    nodes = tuple(cursor.fetchall())
+        nodes = tuple(cursor.fetchall())
 
     if 0 == len(nodes):
         # Check if the skeleton exists
@@ -101,11 +242,20 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
     tags = defaultdict(list)
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id)
 
-    if 0 != with_connectors:
+    if 0 != with_connectors and binary:
+        connectors = _fetch_columns(cursor, '''
+            SELECT tc.treenode_id::bigint, tc.connector_id::bigint,
+                   (CASE WHEN tc.relation_id = %s THEN 1 ELSE 0 END)::smallint,
+                   c.location_x::real, c.location_y::real, c.location_z::real
+            FROM treenode_connector tc,
+                 connector c
+            WHERE tc.skeleton_id = %s
+              AND tc.connector_id = c.id
+        ''' % (relations['postsynaptic_to'], skeleton_id),
+        SKELETON_CONNECTOR_COLUMNS)
+    elif 0 != with_connectors:
         # Fetch all connectors with their partner treenode IDs
         cursor.execute('''
             SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
@@ -135,6 +285,15 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
         for row in cursor.fetchall():
             tags[row[0]].append(row[1])
 
+    if binary:
+        if not len(connectors):
+            connectors = np.zeros(0, dtype=[(c[0], c[2]) for c in SKELETON_CONNECTOR_COLUMNS])
+        tag_names, tag_records = _binary_tags(tags)
+        return _binary_response((
+            ('nodes', NODE_COLUMNS, nodes),
+            ('connectors', SKELETON_CONNECTOR_COLUMNS, connectors),
+            ('tags', TAG_COLUMNS, tag_records)), tag_names)
+
     return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
 
 
@@ -156,6 +315,10 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     Notice that the index in the array correponds to the position in the chain:
     (skeleton ->) treenode -> confidence -> relation -> connector -> relation -> confidence -> treenode -> skeleton.
     The relation_id is 0 for pre and 1 for post.
+
+    With format=binary, the same data is returned in the binary skeleton
+    format (see _binary_response), with a nodes, connectors and tags table.
+    Inputs and outputs are both part of the connectors table.
     """
 
     # Sanitize
@@ -164,6 +327,7 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     with_nodes = int(with_nodes)
     with_connectors  = int(with_connectors)
     with_tags = int(with_tags)
+    binary = _binary_format_requested(request)
 
     cursor = connection.cursor()
 
@@ -171,7 +335,12 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     connectors = []
     tags = defaultdict(list)
 
-    if 0 != with_nodes:
+    if 0 != with_nodes and binary:
+        nodes = _fetch_columns(cursor, _node_columns_query(skeleton_id),
+                NODE_COLUMNS)
+        if 0 == len(nodes) and 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
+            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+    elif 0 != with_nodes:
         cursor.execute('''
             SELECT id, parent_id, user_id,
                 location_x, location_y, location_z,
@@ -189,9 +358,7 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
             # Otherwise returns an empty list of nodes
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id)
 
     if 0 != with_connectors:
         # Fetch all inputs and outputs
@@ -199,6 +366,25 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
         pre = relations['presynaptic_to']
         post = relations['postsynaptic_to']
 
+    if 0 != with_connectors and binary:
+        # Only pre-post and post-pre pairs are selected, like below
+        connectors = _fetch_columns(cursor, '''
+            SELECT tc1.treenode_id::bigint, tc1.confidence::smallint,
+                   tc1.connector_id::bigint,
+                   tc2.confidence::smallint, tc2.treenode_id::bigint,
+                   tc2.skeleton_id::bigint,
+                   (CASE WHEN tc1.relation_id = %(post)s THEN 1 ELSE 0 END)::smallint,
+                   (CASE WHEN tc2.relation_id = %(post)s THEN 1 ELSE 0 END)::smallint
+            FROM treenode_connector tc1,
+                 treenode_connector tc2
+            WHERE tc1.skeleton_id = %(skid)s
+              AND tc1.id != tc2.id
+              AND tc1.connector_id = tc2.connector_id
+              AND ((tc1.relation_id = %(pre)s AND tc2.relation_id = %(post)s)
+                OR (tc1.relation_id = %(post)s AND tc2.relation_id = %(pre)s))
+        ''' % {'skid': skeleton_id, 'pre': pre, 'post': post},
+        ARBOR_CONNECTOR_COLUMNS)
+    elif 0 != with_connectors:
         cursor.execute('''
             SELECT tc1.treenode_id, tc1.confidence,
                    tc1.connector_id,
@@ -235,6 +421,17 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
         for row in cursor.fetchall():
             tags[row[0]].append(row[1])
 
+    if binary:
+        if not len(nodes):
+            nodes = np.zeros(0, dtype=[(c[0], c[2]) for c in NODE_COLUMNS])
+        if not len(connectors):
+            connectors = np.zeros(0, dtype=[(c[0], c[2]) for c in ARBOR_CONNECTOR_COLUMNS])
+        tag_names, tag_records = _binary_tags(tags)
+        return _binary_response((
+            ('nodes', NODE_COLUMNS, nodes),
+            ('connectors', ARBOR_CONNECTOR_COLUMNS, connectors),
+            ('tags', TAG_COLUMNS, tag_records)), tag_names)
+
     return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
 
 
@@ -377,151 +574,176 @@ def skeleton_with_metadata(request, project_id=None, skeleton_id=None):
     return HttpResponse(json.dumps(_skeleton_for_3d_viewer(skeleton_id, project_id, \
         with_connectors=True, lean=0, all_field=True), separators=(',', ':'), default=default))
 
-def _measure_skeletons(skeleton_ids):
+class SkeletonMeasurements(object):
+    """ Morphology measurements of a single skeleton. """
+    def __init__(self):
+        self.n_nodes = 0
+        self.raw_cable = 0
+        self.smooth_cable = 0
+        self.principal_branch_cable = 0
+        self.n_ends = 0
+        self.n_branch = 0
+        self.n_pre = 0
+        self.n_post = 0
+
+
+MEASUREMENT_COLUMNS = (
+    ('id', 'bigint', '<i8'),
+    ('parent_id', 'bigint', '<i8'),
+    ('skeleton_id', 'bigint', '<i8'),
+    ('x', 'double precision', '<f8'),
+    ('y', 'double precision', '<f8'),
+    ('z', 'double precision', '<f8'))
+
+
+def _measure_skeleton_chunk(cursor, skeleton_ids):
+    """ Measure all passed in skeletons at once. The treenodes of all skeletons
+    are loaded into arrays, where each node refers to the index of its parent,
+    and all measurements are computed with array operations over all of them.
+    """
+    nodes = _fetch_columns(cursor, '''
+        SELECT id::bigint, COALESCE(parent_id, -1)::bigint,
+               skeleton_id::bigint, location_x::double precision,
+               location_y::double precision, location_z::double precision
+        FROM treenode
+        WHERE skeleton_id IN (%s)
+    ''' % ",".join(map(str, skeleton_ids)), MEASUREMENT_COLUMNS)
+
+    n = len(nodes)
+    skids, sk = np.unique(nodes['skeleton_id'], return_inverse=True)
+    n_skeletons = len(skids)
+    ids = nodes['id']
+    xyz = np.column_stack((nodes['x'], nodes['y'], nodes['z']))
+
+    # Index of each node's parent, -1 for root nodes
+    order = np.argsort(ids)
+    has_parent = nodes['parent_id'] != -1
+    parent = np.empty(n, dtype=np.int64)
+    parent.fill(-1)
+    parent[has_parent] = order[np.searchsorted(ids[order],
+            nodes['parent_id'][has_parent])]
+    children = np.nonzero(has_parent)[0]
+    parents = parent[children]
+
+    # Distance of each node to its parent
+    distance = np.zeros(n)
+    distance[children] = np.sqrt(((xyz[children] - xyz[parents]) ** 2).sum(axis=1))
+    raw_cable = np.bincount(sk[children], weights=distance[children],
+            minlength=n_skeletons)
+
+    # Count end nodes and branch nodes. A root node with a single child is an
+    # end node, one with two children is a slab node.
+    n_children = np.bincount(parents, minlength=n)
+    is_root = ~has_parent
+    is_end = (has_parent & (0 == n_children)) | (is_root & (1 == n_children))
+    is_branch = (has_parent & (n_children > 1)) | (is_root & (n_children > 2))
+    n_ends = np.bincount(sk[is_end], minlength=n_skeletons)
+    n_branch = np.bincount(sk[is_branch], minlength=n_skeletons)
+
+    # Move slab nodes towards the average position of their neighbors,
+    # weighted by the distance to them. Root, branch and end nodes don't move.
+    is_slab = (has_parent & (1 == n_children)) | (is_root & (2 == n_children))
+    sum_distances = distance + np.bincount(parents, weights=distance[children],
+            minlength=n)
+    smooth = xyz.copy()
+    for i in xrange(3):
+        weighted = np.zeros(n)
+        weighted[children] = xyz[parents, i] * distance[children]
+        weighted += np.bincount(parents,
+                weights=xyz[children, i] * distance[children], minlength=n)
+        slab = is_slab & (sum_distances != 0)
+        smooth[slab, i] = xyz[slab, i] * 0.4 + \
+                weighted[slab] / sum_distances[slab] * 0.6
+    smooth_distance = np.zeros(n)
+    smooth_distance[children] = np.sqrt(
+            ((smooth[children] - smooth[parents]) ** 2).sum(axis=1))
+    smooth_cable = np.bincount(sk[children], weights=smooth_distance[children],
+            minlength=n_skeletons)
+
+    # The principal branch runs from the node with the most edges to the root
+    # node to the root node. Accumulate edge counts and smoothed distances to
+    # the root by pointer jumping, which needs log(depth) steps.
+    depth = has_parent.astype(np.int64)
+    length = smooth_distance.copy()
+    jump = parent.copy()
+    while True:
+        valid = np.nonzero(jump != -1)[0]
+        if 0 == len(valid):
+            break
+        target = jump[valid]
+        depth[valid] += depth[target]
+        length[valid] += length[target]
+        jump[valid] = jump[target]
+    # Nodes are sorted by skeleton, pick the deepest node of each skeleton
+    by_skeleton = np.lexsort((-depth, sk))
+    first = np.searchsorted(sk[by_skeleton], np.arange(n_skeletons))
+    principal_branch_cable = length[by_skeleton[first]]
+
+    n_nodes = np.bincount(sk, minlength=n_skeletons)
+
+    skeletons = {}
+    for i, skid in enumerate(skids):
+        m = SkeletonMeasurements()
+        m.n_nodes = int(n_nodes[i])
+        m.raw_cable = float(raw_cable[i])
+        m.smooth_cable = float(smooth_cable[i])
+        m.principal_branch_cable = float(principal_branch_cable[i])
+        m.n_ends = int(n_ends[i])
+        m.n_branch = int(n_branch[i])
+        skeletons[int(skid)] = m
+
+    return skeletons
+
+
+def _measure_skeletons(skeleton_ids, chunk_size=500):
+    """ Returns a dictionary of skeleton ID vs SkeletonMeasurements. Skeletons
+    are loaded and measured in chunks of <chunk_size> skeletons.
+    """
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
-    skids_string = ",".join(map(str, skeleton_ids))
-
+    skeleton_ids = list(skeleton_ids)
     cursor = connection.cursor()
-    cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
-
-    # Count inputs
-    cursor.execute('''
-    SELECT tc.skeleton_id, count(tc.skeleton_id)
-    FROM treenode_connector tc,
-         relation r
-    WHERE tc.skeleton_id IN (%s)
-      AND tc.relation_id = r.id
-      AND r.relation_name = 'postsynaptic_to'
-    GROUP BY tc.skeleton_id
-    ''' % skids_string)
+    skeletons = {}
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
+    for offset in xrange(0, len(skeleton_ids), chunk_size):
+        chunk = skeleton_ids[offset:offset + chunk_size]
+        skids_string = ",".join(map(str, chunk))
+        chunk_skeletons = _measure_skeleton_chunk(cursor, chunk)
+        skeletons.update(chunk_skeletons)
 
-    # Count outputs
-    cursor.execute('''
-    SELECT tc1.skeleton_id, count(tc1.skeleton_id)
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         relation r1,
-         relation r2
-    WHERE tc1.skeleton_id IN (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = r1.id
-      AND r1.relation_name = 'presynaptic_to'
-      AND tc2.relation_id = r2.id
-      AND r2.relation_name = 'postsynaptic_to'
-      GROUP BY tc1.skeleton_id
-    ''' % skids_string)
+        # Count inputs
+        cursor.execute('''
+        SELECT tc.skeleton_id, count(tc.skeleton_id)
+        FROM treenode_connector tc,
+             relation r
+        WHERE tc.skeleton_id IN (%s)
+          AND tc.relation_id = r.id
+          AND r.relation_name = 'postsynaptic_to'
+        GROUP BY tc.skeleton_id
+        ''' % skids_string)
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
+        for row in cursor.fetchall():
+            chunk_skeletons[row[0]].n_pre = row[1]
+
+        # Count outputs
+        cursor.execute('''
+        SELECT tc1.skeleton_id, count(tc1.skeleton_id)
+        FROM treenode_connector tc1,
+             treenode_connector tc2,
+             relation r1,
+             relation r2
+        WHERE tc1.skeleton_id IN (%s)
+          AND tc1.connector_id = tc2.connector_id
+          AND tc1.relation_id = r1.id
+          AND r1.relation_name = 'presynaptic_to'
+          AND tc2.relation_id = r2.id
+          AND r2.relation_name = 'postsynaptic_to'
+          GROUP BY tc1.skeleton_id
+        ''' % skids_string)
+
+        for row in cursor.fetchall():
+            chunk_skeletons[row[0]].n_post = row[1]
 
     return skeletons
 
@@ -530,7 +752,7 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
     return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
 
 
@@ -570,13 +792,7 @@ def skeletons_neuroml(request, project_id=None):
 
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % project_id)
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID = relations['presynaptic_to']
     postID = relations['postsynaptic_to']
 
@@ -600,15 +816,7 @@ def export_neuroml_level3_v181(request, project_id=None):
     skeleton_strings = ",".join(map(str, skeleton_ids))
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to'
-           OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     presynaptic_to = relations['presynaptic_to']
     postsynaptic_to = relations['postsynaptic_to']
 
@@ -703,6 +911,128 @@ def skeleton_swc(*args, **kwargs):
     return export_skeleton_response(*args, **kwargs)
 
 
+def _skeleton_nodes(project_id, skeleton_ids, chunk_size=10000):
+    """ Yields a (skeleton ID, node rows) tuple for each of the passed in
+    skeletons that has nodes. Each node row has the columns of NODE_COLUMNS
+    (after the skeleton ID). Nodes are read with a server-side cursor in
+    chunks of <chunk_size> rows, ordered by skeleton. This way only the nodes
+    of the current skeleton have to be held in memory, and only if the caller
+    collects them.
+    """
+    # Make sure there is a database connection to create the named cursor on
+    connection.cursor()
+    cursor = connection.connection.cursor('skeleton_export')
+    try:
+        cursor.execute('''
+        SELECT skeleton_id, id, parent_id, user_id,
+               location_x, location_y, location_z, radius, confidence
+        FROM treenode
+        WHERE project_id = %s
+          AND skeleton_id = ANY(%s)
+        ORDER BY skeleton_id
+        ''', (int(project_id), list(skeleton_ids)))
+
+        def rows():
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield row
+
+        for skeleton_id, nodes in groupby(rows(), itemgetter(0)):
+            yield skeleton_id, (node[1:] for node in nodes)
+    finally:
+        cursor.close()
+
+
+def _skeleton_swc(skeleton_id, nodes):
+    return "".join(_swc_line(node_id, parent_id, x, y, z, radius)
+            for node_id, parent_id, _, x, y, z, radius, _ in nodes)
+
+
+def _skeleton_json(skeleton_id, nodes):
+    return json.dumps({
+        'id': skeleton_id,
+        'columns': [c[0] for c in NODE_COLUMNS],
+        'nodes': list(nodes)}, separators=(',', ':'))
+
+
+_ARCHIVE_FORMATS = {
+    'swc': _skeleton_swc,
+    'json': _skeleton_json,
+}
+
+
+class _StreamBuffer(object):
+    """ A file object that only collects what is written to it, until it is
+    taken out with read().
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def read(self):
+        data = "".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _skeleton_archive(project_id, skeleton_ids, format):
+    """ Yields the parts of a gzipped tar archive with one file per skeleton,
+    named after the skeleton ID and the format (swc or json). Parts are
+    created as the skeletons are read from the database.
+    """
+    to_text = _ARCHIVE_FORMATS[format]
+    buf = _StreamBuffer()
+    archive = tarfile.open(mode='w|gz', fileobj=buf)
+    # The response is streamed after the view returned and with it its
+    # transaction, but the server-side cursor needs one.
+    with transaction.atomic():
+        for skeleton_id, nodes in _skeleton_nodes(project_id, skeleton_ids):
+            data = to_text(skeleton_id, nodes)
+            info = tarfile.TarInfo('%s.%s' % (skeleton_id, format))
+            info.size = len(data)
+            info.mtime = time.time()
+            archive.addfile(info, StringIO(data))
+            yield buf.read()
+    archive.close()
+    yield buf.read()
+
+
+@requires_user_role(UserRole.Browse)
+def export_skeletons_archive(request, project_id=None, format=None):
+    """ Streams a gzipped tar archive with one SWC or JSON file for each of
+    the requested skeletons. Skeletons are either passed as a list of IDs
+    (skeleton_ids[]) or are found with the same neuron_query_by_* parameters
+    as used to query neurons by annotations, in which case the skeletons
+    modeling the matching neurons are exported.
+    """
+    project_id = int(project_id)
+    skeleton_ids = set(int(v) for v in request.POST.getlist('skeleton_ids[]'))
+    if not skeleton_ids:
+        if not any(k.startswith('neuron_query_by_') for k in request.POST):
+            raise Exception('Neither skeleton IDs nor a neuron query were '
+                    'provided')
+        p = get_object_or_404(Project, pk=project_id)
+        relations = get_relation_to_id_map(project_id)
+        neurons = create_basic_annotated_entity_query(p, request.POST,
+                relations, get_class_to_id_map(project_id),
+                allowed_classes=['neuron'])
+        skeleton_ids = set(ClassInstanceClassInstance.objects.filter(
+                relation_id=relations['model_of'],
+                class_instance_b__in=neurons.values('id')).values_list(
+                        'class_instance_a', flat=True))
+
+    response = StreamingHttpResponse(_skeleton_archive(project_id,
+            sorted(skeleton_ids), format), content_type='application/x-gzip')
+    response['Content-Disposition'] = \
+            'attachment; filename="skeletons-%s.tar.gz"' % format
+    return response
+
+
 def _export_review_skeleton(project_id=None, skeleton_id=None, format=None,
                             subarbor_node_id=None):
     """ Returns a list of segments for the requested skeleton. Each segment
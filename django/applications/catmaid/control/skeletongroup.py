@@ -8,18 +8,20 @@ from catmaid.objects import SkeletonGroup, \
         compartmentalize_skeletongroup_by_edgecount, \
         compartmentalize_skeletongroup_by_confidence
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.skeleton import _neuronnames
+from catmaid.control.synapse_edges import get_edges
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def adjacency_matrix(request, project_id=None):
     skeletonlist = request.POST.getlist('skeleton_list[]')
-    skeletonlist = map(int, skeletonlist)
+    skeletonlist = list(set(map(int, skeletonlist)))
     p = get_object_or_404(Project, pk=project_id)
-    skelgroup = SkeletonGroup( skeletonlist, p.id )
+    neuronnames = _neuronnames(skeletonlist, p.id)
 
     nodeslist = [ {'group': 1,
-                   'id': k,
-                   'name': d['neuronname']} for k,d in skelgroup.graph.nodes_iter(data=True)  ]
+                   'id': skid,
+                   'name': neuronnames.get(skid, str(skid))} for skid in skeletonlist ]
     nodesid_list = [ele['id'] for ele in nodeslist]
 
     data = {
@@ -27,7 +29,7 @@ def adjacency_matrix(request, project_id=None):
         'links': [ {'id': '%i_%i' % (u,v),
                     'source': nodesid_list.index(u),
                     'target': nodesid_list.index(v),
-                    'value': d['count']} for u,v,d in skelgroup.graph.edges_iter(data=True)  ]
+                    'value': count} for u,v,count in get_edges(skeletonlist) ]
     }
 
     return HttpResponse(json.dumps(data, sort_keys=True, indent=4), content_type='text/json')
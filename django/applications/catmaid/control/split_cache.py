@@ -0,0 +1,91 @@
+""" A cache for the results of splitting skeletons into parts for circuit
+graphs, e.g. at low-confidence edges or into synapse domains.
+
+Results are cached per skeleton, together with the split parameters and the
+edit version of the skeleton. The edit version is kept in the skeleton's
+summary and changes with every change to the skeleton's nodes, connector
+links or reviews (see update_skeleton_summary()). Once a skeleton changed,
+its cached results are therefore not found anymore and are eventually evicted
+as the least recently used ones.
+
+Since keys contain the version, cached results never have to be invalidated
+explicitly and the cache is held in memory, per process. Its size is set with
+settings.GRAPH_SPLIT_CACHE_SIZE, a size of 0 disables it.
+"""
+
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control.cache import LRUCache
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_split_cache():
+    """ Returns the split cache of this process or None if it is disabled.
+    """
+    global _cache
+    size = getattr(settings, 'GRAPH_SPLIT_CACHE_SIZE', 0)
+    if not size:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LRUCache(size)
+    return _cache
+
+
+def get_edit_versions(skeleton_ids, cursor=None):
+    """ Returns a dictionary of skeleton ID vs its current edit version.
+    Skeletons without summary are left out.
+    """
+    if not skeleton_ids:
+        return {}
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+    SELECT skeleton_id, edit_version
+    FROM skeleton_summary
+    WHERE skeleton_id IN (%s)
+    ''' % ','.join(str(int(skid)) for skid in skeleton_ids))
+    return dict(cursor.fetchall())
+
+
+def cached_splits(kind, params, skeleton_ids, split, cursor=None):
+    """ Returns a dictionary of skeleton ID vs the result of splitting that
+    skeleton. The string <kind> and the tuple <params> identify the type of
+    split. Results that aren't cached are computed with <split>, which is
+    called with the set of IDs of these skeletons and is expected to return a
+    dictionary of skeleton ID vs result for them. Cached results are shared
+    between requests and must not be modified.
+    """
+    skeleton_ids = set(skeleton_ids)
+    if not skeleton_ids:
+        return {}
+    cache = get_split_cache()
+    if not cache:
+        return split(skeleton_ids)
+
+    versions = get_edit_versions(skeleton_ids, cursor)
+    results = {}
+    missing = set()
+    for skid in skeleton_ids:
+        version = versions.get(skid)
+        result = None
+        if version is not None:
+            result = cache.get((kind, skid, version) + params)
+        if result is None:
+            missing.add(skid)
+        else:
+            results[skid] = result
+
+    if missing:
+        for skid, result in split(missing).iteritems():
+            version = versions.get(skid)
+            if version is not None and result is not None:
+                cache.set((kind, skid, version) + params, result)
+            results[skid] = result
+
+    return results
@@ -4,25 +4,22 @@ from datetime import timedelta, datetime
 from dateutil import parser as dateparser
 
 from django.http import HttpResponse
-from django.db.models.aggregates import Count
 from django.db import connection
 
 from catmaid.control.authentication import requires_user_role
-from catmaid.models import ClassInstance, Connector, Treenode, User, UserRole, \
-        Review, Relation, TreenodeConnector
+from catmaid.control.activity import get_activity_counts
+from catmaid.models import ClassInstance, Treenode, User, UserRole, \
+        Relation, TreenodeConnector
 
 
-def _process(query, minus1name):
-    cursor = connection.cursor()
-    cursor.execute(query)
-
+def _process(rows, minus1name):
     # Get name dictonary separatly to avaoid joining the user table to the
     # treenode table, which in turn improves performance.
     names = dict(User.objects.values_list('id', 'username'))
 
     result = {'users': [],
               'values': []}
-    for row in cursor.fetchall():
+    for row in rows:
         result['values'].append(row[1])
         s = (names[row[0]], row[1]) if -1 != row[0] else (minus1name, row[1])
         result['users'].append('%s (%d)' % s)
@@ -31,43 +28,27 @@ def _process(query, minus1name):
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_nodecount(request, project_id=None):
-    return _process('''
-    SELECT user_id, count(*)
-    FROM treenode
-    WHERE project_id=%s
-    GROUP BY user_id
-    ''' % int(project_id), "*anonymous*")
+    return _process(get_activity_counts('treenode_created',
+            project_id=int(project_id)), "*anonymous*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_editor(request, project_id=None):
-    return _process('''
-    SELECT editor_id, count(editor_id)
-    FROM treenode
-    WHERE project_id=%s
-      AND editor_id != user_id
-    GROUP BY username
-    ''' % int(project_id), "*unedited*")
+    return _process(get_activity_counts('treenode_edited',
+            project_id=int(project_id), edited_by_other=True), "*unedited*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_summary(request, project_id=None):
     startdate = datetime.today()
-    result = {
-        'treenodes_created': Treenode.objects.filter(
-            project=project_id,
-            user=request.user.id,
-            creation_time__year=startdate.year,
-            creation_time__month=startdate.month,
-            creation_time__day=startdate.day).count(),
-        'connectors_created': Connector.objects.filter(
-            project=project_id,
-            user=request.user.id,
-            creation_time__year=startdate.year,
-            creation_time__month=startdate.month,
-            creation_time__day=startdate.day
-            ).count(),
-    }
+    start = datetime(startdate.year, startdate.month, startdate.day)
+    end = start + timedelta(days=1) - timedelta(microseconds=1)
+    result = {}
+    for key, activity in (('treenodes_created', 'treenode_created'),
+                          ('connectors_created', 'connector_created')):
+        counts = get_activity_counts(activity, project_id=int(project_id),
+                user_id=request.user.id, start_date=start, end_date=end)
+        result[key] = counts[0][1] if counts else 0
     for key, class_name in [
             ('skeletons_created', 'skeleton')
             ]:
@@ -88,28 +69,16 @@ def stats_history(request, project_id=None):
     start_date = request.GET.get('start_date', datetime.now() - timedelta(30))
     end_date = request.GET.get('end_date', datetime.now())
 
-    # Look up all tree nodes for the project in the given date range.
-    # Also add a computed field which is just the day of the last edited
-    # date/time.
-    tree_nodes = Treenode.objects \
-        .filter(
-            project=project_id,
-            edition_time__range=(start_date, end_date)) \
-        .extra(select={
-            'date': 'to_char("treenode"."edition_time", \'YYYYMMDD\')'}) \
-        .order_by('user', 'date')
-
-    # Get the count of tree nodes for each user/day combination.
-    stats = tree_nodes.values('user__username', 'date') \
-        .annotate(count=Count('id'))
-
-    # Change the 'user__username' field name to just 'name'.
-    # (If <https://code.djangoproject.com/ticket/12222> ever gets implemented
-    # then this wouldn't be necessary.)
+    # Count the tree nodes of each user that were edited last on each day in
+    # the given date range.
+    names = dict(User.objects.values_list('id', 'username'))
     stats = [{
-        'name': stat['user__username'],
-        'date': stat['date'],
-        'count': stat['count']} for stat in stats]
+        'name': names[user_id],
+        'date': date.strftime('%Y%m%d'),
+        'count': count} for user_id, date, count in get_activity_counts(
+            'treenode_edited', group_by=('creator_id',),
+            project_id=int(project_id), start_date=start_date,
+            end_date=end_date, interval='day')]
 
     return HttpResponse(json.dumps(stats), content_type='text/json')
 
@@ -221,14 +190,9 @@ def stats_user_history(request, project_id=None):
     ''', (project_id, start_date, end_date))
     connector_stats = cursor.fetchall()
 
-    tree_reviewed_nodes = Review.objects \
-        .filter(
-            project_id=project_id,
-            review_time__range=(start_date, end_date)) \
-        .extra(select={'date': "date_trunc('day', review_time)"}) \
-        .order_by('date') \
-        .values_list('reviewer_id', 'date') \
-        .annotate(count = Count('treenode'))
+    tree_reviewed_nodes = get_activity_counts('review',
+            project_id=int(project_id), start_date=start_date,
+            end_date=end_date, interval='day')
 
     for di in treenode_stats:
         user_id = str(di[0])
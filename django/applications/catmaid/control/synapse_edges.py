@@ -0,0 +1,70 @@
+""" Access to the synaptic connectivity between skeletons.
+
+The synapse_edge table stores for each pair of connected skeletons the number
+of synapses from the first (presynaptic) to the second (postsynaptic)
+skeleton. A synapse is a pair of a presynaptic and a postsynaptic link to the
+same connector. The table is kept up to date by a trigger on
+treenode_connector.
+"""
+
+from collections import defaultdict
+from functools import partial
+
+from django.db import connection
+
+
+def _skid_list(skeleton_ids):
+    return ','.join(str(int(skid)) for skid in skeleton_ids)
+
+
+def get_edges(skeleton_ids, cursor=None):
+    """ Returns a list of (pre skeleton ID, post skeleton ID, synapse count)
+    tuples for all edges between the passed in skeletons.
+    """
+    if not skeleton_ids:
+        return []
+    cursor = cursor or connection.cursor()
+    skids = _skid_list(skeleton_ids)
+    cursor.execute('''
+    SELECT pre_skeleton_id, post_skeleton_id, num_synapses
+    FROM synapse_edge
+    WHERE pre_skeleton_id IN (%s)
+      AND post_skeleton_id IN (%s)
+    ''' % (skids, skids))
+    return cursor.fetchall()
+
+
+def get_downstream_partners(skeleton_ids, cursor=None):
+    """ Returns a dictionary of each passed in skeleton ID vs a dictionary of
+    the skeletons it is presynaptic to vs the number of synapses.
+    """
+    partners = defaultdict(partial(defaultdict, int))
+    if not skeleton_ids:
+        return partners
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+    SELECT pre_skeleton_id, post_skeleton_id, num_synapses
+    FROM synapse_edge
+    WHERE pre_skeleton_id IN (%s)
+    ''' % _skid_list(skeleton_ids))
+    for pre, post, count in cursor.fetchall():
+        partners[pre][post] = count
+    return partners
+
+
+def get_upstream_partners(skeleton_ids, cursor=None):
+    """ Returns a dictionary of each passed in skeleton ID vs a dictionary of
+    the skeletons that are presynaptic to it vs the number of synapses.
+    """
+    partners = defaultdict(partial(defaultdict, int))
+    if not skeleton_ids:
+        return partners
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+    SELECT post_skeleton_id, pre_skeleton_id, num_synapses
+    FROM synapse_edge
+    WHERE post_skeleton_id IN (%s)
+    ''' % _skid_list(skeleton_ids))
+    for post, pre, count in cursor.fetchall():
+        partners[post][pre] = count
+    return partners
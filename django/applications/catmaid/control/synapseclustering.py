@@ -5,101 +5,196 @@ import networkx as nx
 from collections import namedtuple
 
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
+from catmaid.control.tree_util import ArrayTree, lazy_load_trees, \
+        LOCATION_COLUMNS
 
 
-try:
-    from scipy.sparse.csgraph import dijkstra
-except:
-    pass
+# Synapses further away from a node than this factor times the largest
+# bandwidth are ignored for the density at that node. Their contribution
+# would be below exp(-9), i.e. about 0.01% of that of a synapse at the node.
+DENSITY_CUTOFF_FACTOR = 3.0
+
+SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
+
 
 def synapse_clustering( skeleton_id, h_list ):
 
-    Gwud = createSpatialGraphFromSkeletonID( skeleton_id )
+    tree = next(lazy_load_trees([skeleton_id], LOCATION_COLUMNS,
+            as_arrays=True))[1]
     synNodes, connector_ids, relations = synapseNodesFromSkeletonID( skeleton_id )
-    
-    return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
 
+    return tree_max_density(tree, synNodes, connector_ids, relations, h_list)
 
-def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
+
+def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list,
+        cutoff_factor=DENSITY_CUTOFF_FACTOR):
     """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+        Alternatively an ArrayTree with locations.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+        cutoff_factor: synapses further away from a node than this factor
+        times the largest bandwidth don't contribute to its density. With
+        None, all synapses are taken into account.
+        Returns a dictionary of bandwidth vs a dictionary of group index vs
+        SynapseGroup.
     """
+    if isinstance(Gwud, ArrayTree):
+        node_ids, parents, lengths = _array_tree_edges(Gwud)
+    else:
+        node_ids, parents, lengths = _graph_tree_edges(Gwud)
+    index = dict((node, i) for i, node in enumerate(node_ids))
+    syn_indices = np.array([index[node] for node in synNodes], dtype=np.int64)
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
-    
-    SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
-    synapseGroups = {}
+    h = np.asarray(h_list, dtype=np.float64)
+    cutoff = np.inf if cutoff_factor is None else cutoff_factor * h.max()
+    density = _density_fields(parents, lengths, np.unique(syn_indices), h,
+            cutoff)
 
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-    
-        targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:    
-                currNode = startNode
-                allOnPath = []
-                
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-    
-                while True:
-                    allOnPath.append(currNode)
-    
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-                    
-                    for nn in Gwud.neighbors( currNode ): 
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-                    
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-                                                    
-                    if currNode == prevNode:
-                        break
-                            
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
+    synapseGroups = {}
+    for k, bandwidth in enumerate(h_list):
+        targets = _hill_climb(parents, density[:, k])[syn_indices]
 
+        # Groups are numbered in order of their first synapse
         loc2group = {}
-
-        synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
-            loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
-        
-        for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
-            synapseGroups[h][ gi ].node_ids.append( node )
-            synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
-            synapseGroups[h][ gi ].relations.append( relations[ind] )
+        synapseGroups[bandwidth] = groups = {}
+        for ind, target in enumerate(targets.tolist()):
+            gi = loc2group.get(target)
+            if gi is None:
+                gi = loc2group[target] = len(loc2group)
+                groups[gi] = SynapseGroup([], [], [], node_ids[target])
+            groups[ gi ].node_ids.append( synNodes[ind] )
+            groups[ gi ].connector_ids.append( connector_ids[ind] )
+            groups[ gi ].relations.append( relations[ind] )
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
+def _graph_tree_edges(G):
+    """ Given an undirected nx tree (or forest) with edges weighted by
+    length, returns a list of its node IDs, an array with the index of the
+    parent of each node (-1 for roots) and an array with the length of the
+    edge to each parent. """
+    node_ids = list(G.nodes())
+    index = dict((node, i) for i, node in enumerate(node_ids))
+    parents = np.empty(len(node_ids), dtype=np.int64)
+    parents.fill(-1)
+    lengths = np.zeros(len(node_ids))
+    seen = set()
+    for root in node_ids:
+        if root in seen:
+            continue
+        seen.add(root)
+        for parent, child in nx.bfs_edges(G, root):
+            seen.add(child)
+            parents[index[child]] = index[parent]
+            lengths[index[child]] = G[parent][child].get('weight', 1)
+    return node_ids, parents, lengths
+
+def _array_tree_edges(tree):
+    """ Like _graph_tree_edges, for an ArrayTree with locations. """
+    has_parent = tree.parents != -1
+    lengths = np.zeros(len(tree))
+    deltas = tree.locations[has_parent] - tree.locations[tree.parents[has_parent]]
+    lengths[has_parent] = np.sqrt((deltas * deltas).sum(axis=1))
+    return tree.node_ids.tolist(), tree.parents, lengths
+
+def _children(parents):
+    """ Returns the children of all nodes in CSR form: two arrays (ptr,
+    indices) so that the children of node i are indices[ptr[i]:ptr[i+1]]. """
+    n = len(parents)
+    nodes = np.flatnonzero(parents != -1)
+    order = np.argsort(parents[nodes], kind='mergesort')
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    if len(nodes):
+        ptr[1:] = np.cumsum(np.bincount(parents[nodes], minlength=n))
+    return ptr, nodes[order]
+
+def tree_distances(parents, lengths, sources, cutoff=np.inf):
+    """ Finds all nodes within <cutoff> of each of the <sources> (node
+    indices) in a tree given as parent indices and edge lengths. Rather than
+    running Dijkstra from every source, all sources are expanded at once
+    along the tree, one edge per step: in a tree the first path that reaches
+    a node is the only one. Returns three arrays: the position of the source
+    in <sources>, the node index and the distance. Memory is proportional to
+    the number of (source, node) pairs within the cutoff. """
+    ptr, children = _children(parents)
+    n_sources = len(sources)
+    origin = np.arange(n_sources, dtype=np.int64)
+    node = np.asarray(sources, dtype=np.int64)
+    previous = np.empty(n_sources, dtype=np.int64)
+    previous.fill(-1)
+    distance = np.zeros(n_sources)
+    result = [(origin, node, distance)]
+
+    while len(node):
+        # Step to the parent
+        parent = parents[node]
+        up = (parent != -1) & (parent != previous)
+        up_distance = distance[up] + lengths[node[up]]
+        within = up_distance <= cutoff
+        up_origin = origin[up][within]
+        up_node = parent[up][within]
+        up_previous = node[up][within]
+        up_distance = up_distance[within]
+
+        # Step to the children
+        starts = ptr[node]
+        counts = ptr[node + 1] - starts
+        total = counts.sum()
+        offsets = np.cumsum(counts) - counts
+        pos = np.arange(total) - np.repeat(offsets - starts, counts)
+        child = children[pos]
+        down_previous = np.repeat(node, counts)
+        down_origin = np.repeat(origin, counts)
+        down_distance = np.repeat(distance, counts) + lengths[child]
+        keep = (child != np.repeat(previous, counts)) & (down_distance <= cutoff)
+
+        origin = np.concatenate((up_origin, down_origin[keep]))
+        node = np.concatenate((up_node, child[keep]))
+        previous = np.concatenate((up_previous, down_previous[keep]))
+        distance = np.concatenate((up_distance, down_distance[keep]))
+        result.append((origin, node, distance))
+
+    return tuple(np.concatenate(column) for column in zip(*result))
+
+def _density_fields(parents, lengths, synapse_nodes, h, cutoff):
+    """ Returns an (nodes x bandwidths) array with the sum of exp(-d^2/h^2)
+    over the distance d to all synapse nodes, for every bandwidth h. """
+    _, nodes, distances = tree_distances(parents, lengths, synapse_nodes,
+            cutoff)
+    n, n_h = len(parents), len(h)
+    weights = np.exp(-np.square(distances)[:, np.newaxis] / np.square(h))
+    bins = nodes[:, np.newaxis] * n_h + np.arange(n_h)
+    return np.bincount(bins.ravel(), weights=weights.ravel(),
+            minlength=n * n_h).reshape(n, n_h)
+
+def _hill_climb(parents, density):
+    """ Returns for every node the local density maximum that is reached by
+    repeatedly moving to the neighbor with the highest density, as long as
+    that is higher than the density at the current node. """
+    n = len(parents)
+    child = np.flatnonzero(parents != -1)
+    # Both directions of all edges, as (node, neighbor) pairs
+    node = np.concatenate((child, parents[child]))
+    neighbor = np.concatenate((parents[child], child))
+    # Per node, the neighbor with the highest density comes first
+    order = np.lexsort((neighbor, -density[neighbor], node))
+    node, neighbor = node[order], neighbor[order]
+    first = np.ones(len(node), dtype=bool)
+    first[1:] = node[1:] != node[:-1]
 
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
+    target = np.arange(n, dtype=np.int64)
+    best_node, best_neighbor = node[first], neighbor[first]
+    climb = density[best_neighbor] > density[best_node]
+    target[best_node[climb]] = best_neighbor[climb]
 
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+    # Follow the climbing steps to their end by pointer jumping
+    while True:
+        next_target = target[target]
+        if np.array_equal(next_target, target):
+            return target
+        target = next_target
 
 def countTargets( skeleton_id ):
     nTargets = {}
@@ -1,6 +1,17 @@
+""" Tiles of image and label stacks stored in HDF5 files.
+
+Each process keeps a bounded pool of open HDF5 files, which are reopened if
+they changed on disk. Data is read in blocks aligned to the chunks of a
+dataset and recently read blocks as well as recently encoded tiles are cached
+in memory, bounded by their size in bytes. Both are cached together with the
+version of their file, so that changed files are read again.
+"""
+
 import os
+import threading
 import cStringIO
-from contextlib import closing
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 import h5py
 import numpy as np
 import base64
@@ -13,6 +24,151 @@ except:
 
 from django.http import HttpResponse
 
+from catmaid.control.cache import LRUCache
+
+
+# The content types of the formats tiles can be requested in. Raw tiles are
+# the unsigned 8 bit pixel values, row by row.
+TILE_FORMATS = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'raw': 'application/octet-stream',
+}
+
+# The edge length of the blocks data is read in from datasets that aren't
+# chunked.
+DEFAULT_BLOCK_SIZE = 256
+
+
+class HDF5FilePool(object):
+    """ A thread safe pool of at most <max_files> HDF5 files that are open
+    for reading. The least recently used file is closed first.
+    """
+
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def open(self, path):
+        """ Provides the version of the file at <path> and the open file, or
+        None if it doesn't exist. No other thread reads from the file or
+        closes it until the context is left. The version changes whenever the
+        file is modified, in which case it is reopened.
+        """
+        while True:
+            entry = self._get(path)
+            if entry is None:
+                yield None
+                return
+            with entry[2]:
+                # The file may have been closed in the meantime
+                if entry[1].id.valid:
+                    yield entry[0], entry[1]
+                    return
+
+    def _get(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        version = (stat.st_mtime, stat.st_size)
+        with self.lock:
+            entry = self.files.pop(path, None)
+            if entry and entry[0] != version:
+                self._close(entry)
+                entry = None
+            if entry is None:
+                entry = (version, h5py.File(path, 'r'), threading.Lock())
+            self.files[path] = entry
+            while len(self.files) > self.max_files:
+                self._close(self.files.popitem(last=False)[1])
+        return entry
+
+    def _close(self, entry):
+        with entry[2]:
+            entry[1].close()
+
+
+_pool = None
+_blocks = None
+_tiles = None
+_empty_tiles = LRUCache(64)
+_init_lock = threading.Lock()
+
+
+def _caches():
+    """ Returns the file pool and the block and tile caches of this process.
+    """
+    global _pool, _blocks, _tiles
+    with _init_lock:
+        if _pool is None:
+            _pool = HDF5FilePool(settings.HDF5_FILE_POOL_SIZE)
+            _blocks = LRUCache(settings.HDF5_BLOCK_CACHE_SIZE,
+                    lambda block: block.nbytes)
+            _tiles = LRUCache(settings.HDF5_TILE_CACHE_SIZE, len)
+    return _pool, _blocks, _tiles
+
+
+def _encode(data, width, height, format):
+    """ Encodes a (height, width) array of pixel values in the passed in
+    format.
+    """
+    data = np.ascontiguousarray(data, dtype=np.uint8)
+    if 'raw' == format:
+        return data.tostring()
+    output = cStringIO.StringIO()
+    if 'png' == format:
+        pilImage = Image.frombuffer('RGBA', (width, height), data, 'raw', 'L', 0, 1)
+        pilImage.save(output, "PNG")
+    else:
+        pilImage = Image.frombuffer('L', (width, height), data, 'raw', 'L', 0, 1)
+        pilImage.save(output, "JPEG")
+    return output.getvalue()
+
+
+def _empty_tile(width, height, format):
+    key = (width, height, format)
+    tile = _empty_tiles.get(key)
+    if tile is None:
+        tile = _encode(np.zeros((height, width), dtype=np.uint8), width,
+                height, format)
+        _empty_tiles.set(key, tile)
+    return tile
+
+
+def _read_region(blocks, block_key, dataset, x, y, width, height):
+    """ Returns the (height, width) region of a 2D dataset that starts at
+    (x, y). Parts outside of the dataset are zero. Data is read in blocks of
+    the dataset's chunk size, which are cached with <block_key> plus their
+    row and column as key.
+    """
+    region = np.zeros((height, width), dtype=dataset.dtype)
+    rows, cols = dataset.shape[:2]
+    y0, y1 = max(y, 0), min(y + height, rows)
+    x0, x1 = max(x, 0), min(x + width, cols)
+    if y0 >= y1 or x0 >= x1:
+        return region
+
+    bh, bw = dataset.chunks[:2] if dataset.chunks else \
+            (DEFAULT_BLOCK_SIZE, DEFAULT_BLOCK_SIZE)
+    for by in xrange(y0 // bh, (y1 - 1) // bh + 1):
+        for bx in xrange(x0 // bw, (x1 - 1) // bw + 1):
+            key = block_key + (by, bx)
+            block = blocks.get(key)
+            if block is None:
+                block = dataset[by * bh:(by + 1) * bh, bx * bw:(bx + 1) * bw]
+                blocks.set(key, block)
+            # The part of the block within the region
+            top, bottom = max(y0, by * bh), min(y1, by * bh + block.shape[0])
+            left, right = max(x0, bx * bw), min(x1, bx * bw + block.shape[1])
+            region[top - y:bottom - y, left - x:right - x] = \
+                    block[top - by * bh:bottom - by * bh,
+                          left - bx * bw:right - bx * bw]
+    return region
+
+
 def get_tile(request, project_id=None, stack_id=None):
 
     scale = float(request.GET.get('scale', '0'))
@@ -25,37 +181,38 @@ def get_tile(request, project_id=None, stack_id=None):
     row = request.GET.get('row', 'x')
     file_extension = request.GET.get('file_extension', 'png')
     basename = request.GET.get('basename', 'raw')
+    format = request.GET.get('format', 'png')
+    if format not in TILE_FORMATS:
+        raise ValueError("Unknown tile format: %s" % format)
+
+    pool, blocks, tiles = _caches()
 
     # need to know the stack name
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
 
-    if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-        # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(content_type="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+    hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
+    with pool.open(fpath) as entry:
+        if entry is None:
+            return HttpResponse(_empty_tile(width, height, format),
+                    content_type=TILE_FORMATS[format])
+            # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
+        version, hfile = entry
+        tile_key = (fpath, version, int(scale), z, x, y, width, height,
+                format)
+        tile = tiles.get(tile_key)
+        if tile is None:
+            if not str(int(scale)) in hfile['/']:
+                return HttpResponse(_empty_tile(width, height, format),
+                        content_type=TILE_FORMATS[format])
+                # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
+            data = _read_region(blocks, (fpath, version, hdfpath),
+                    hfile[hdfpath], x, y, width, height)
+
+    if tile is None:
+        tile = _encode(data, width, height, format)
+        tiles.set(tile_key, tile)
+
+    return HttpResponse(tile, content_type=TILE_FORMATS[format])
 
 def put_tile(request, project_id=None, stack_id=None):
     """ Store labels to HDF5 """
@@ -18,6 +18,7 @@ from catmaid.control.authentication import requires_user_role, \
 from catmaid.control.common import get_class_to_id_map, \
         get_relation_to_id_map, insert_into_log
 from catmaid.control.tracing import check_tracing_setup_detailed
+from catmaid.control import node_cache
 
 @requires_user_role(UserRole.Annotate)
 def instance_operation(request, project_id=None):
@@ -38,6 +39,7 @@ def instance_operation(request, project_id=None):
     instance_operation.res_on_err = ''
 
     def remove_skeletons(skeleton_id_list):
+        node_cache.invalidate_project(project_id)
         if request.user.is_superuser:
             instance_operation.res_on_err = 'Failed to delete in treenode for skeletons #%s' % skeleton_id_list
             # TODO this failed at least once, whereas direct deletion of a single skeleton by skeleton_id on the treenode table succeeded. Inspect!
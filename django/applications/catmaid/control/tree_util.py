@@ -1,22 +1,278 @@
-# A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# A 'tree' is a networkx.DiGraph with a single root node (a node without parents),
+# or an ArrayTree. The functions below accept both.
+
+import numpy as np
 
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
 from math import sqrt
-from itertools import izip, islice
+from itertools import izip, islice, groupby, count
+from django.db import connection
 from catmaid.models import Treenode
 
+
+LOCATION_COLUMNS = ('location_x', 'location_y', 'location_z')
+
+# The default amount of memory lazy_load_trees() uses for fetched rows, and
+# the estimated size of a row and of each of its values in bytes.
+LAZY_LOAD_MEMORY_BUDGET = 32 * 1024 * 1024
+_ROW_BYTES = 80
+_VALUE_BYTES = 40
+
+_cursor_ids = count()
+
+
+class ArrayTree(object):
+    """ A tree stored as parallel arrays: the node IDs, the index of the
+    parent of each node (-1 for the root), optionally the location of each
+    node as a row of an N x 3 array, and further per-node properties as a
+    dictionary of property name vs array. The children of each node are
+    available in compressed sparse row form (see children()). Unlike with
+    networkx, nodes are referred to by their index in most methods; index()
+    maps node IDs to indices.
+    """
+
+    def __init__(self, node_ids, parents, locations=None, properties=None):
+        """ node_ids: a sequence of node IDs.
+        parents: the index of the parent of each node, -1 for the root.
+        locations: an optional N x 3 sequence of node locations.
+        properties: an optional dictionary of property name vs sequence. """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self._sorter = np.argsort(self.node_ids, kind='mergesort')
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.locations = None if locations is None else \
+                np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        self.properties = dict((name, np.asarray(values))
+                for name, values in (properties or {}).iteritems())
+        self._clear_caches()
+
+    @classmethod
+    def from_parent_ids(cls, node_ids, parent_ids, locations=None,
+            properties=None):
+        """ Like the constructor, but with the parent node ID of each node,
+        None for the root, instead of parent indices. """
+        tree = cls(node_ids, np.empty(len(node_ids), dtype=np.int64),
+                locations, properties)
+        parent_ids = np.fromiter((-1 if p is None else p for p in parent_ids),
+                dtype=np.int64, count=len(tree.node_ids))
+        has_parent = parent_ids != -1
+        tree.parents.fill(-1)
+        tree.parents[has_parent] = tree.index(parent_ids[has_parent])
+        return tree
+
+    def _clear_caches(self):
+        self._children = None
+        self._depths = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        pos = np.searchsorted(self.node_ids, node_id, sorter=self._sorter)
+        return pos < len(self.node_ids) and \
+                self.node_ids[self._sorter[pos]] == node_id
+
+    def index(self, node_ids):
+        """ Returns the indices of the passed in node IDs, which can be a
+        single ID or an array of IDs. Raises a KeyError for unknown IDs. """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        pos = np.searchsorted(self.node_ids, node_ids, sorter=self._sorter)
+        pos = np.minimum(pos, max(len(self.node_ids) - 1, 0))
+        indices = self._sorter[pos] if len(self.node_ids) else pos
+        if len(self.node_ids) == 0 or \
+                not np.all(self.node_ids[indices] == node_ids):
+            raise KeyError("Node not in tree: %s" % node_ids)
+        return indices
+
+    def root(self):
+        """ Returns the index of the root node. """
+        return int(np.flatnonzero(self.parents == -1)[0])
+
+    def children(self):
+        """ Returns two arrays (ptr, indices) so that the children of node i
+        are indices[ptr[i]:ptr[i+1]]. """
+        if self._children is None:
+            n = len(self.node_ids)
+            has_parent = self.parents != -1
+            nodes = np.flatnonzero(has_parent)
+            parents = self.parents[has_parent]
+            order = np.argsort(parents, kind='mergesort')
+            ptr = np.zeros(n + 1, dtype=np.int64)
+            if len(parents):
+                ptr[1:] = np.cumsum(np.bincount(parents, minlength=n))
+            self._children = (ptr, nodes[order])
+        return self._children
+
+    def out_degrees(self):
+        """ Returns the number of children of each node. """
+        return np.diff(self.children()[0])
+
+    def end_nodes(self):
+        """ Returns the indices of all nodes without children. """
+        return np.flatnonzero(self.out_degrees() == 0)
+
+    def depths(self):
+        """ Returns the number of edges from each node to the root. Computed
+        by pointer jumping, i.e. in a logarithmic number of vectorized steps.
+        """
+        if self._depths is None:
+            jump = self.parents.copy()
+            depths = (jump != -1).astype(np.int64)
+            todo = np.flatnonzero(jump != -1)
+            while len(todo):
+                up = jump[todo]
+                depths[todo] += depths[up]
+                jump[todo] = jump[up]
+                todo = todo[jump[todo] != -1]
+            self._depths = depths
+        return self._depths
+
+    def reroot(self, new_root):
+        """ Reverse in place the direction of the edges from the node at
+        index new_root to the root. """
+        path = [new_root]
+        parents = self.parents
+        while parents[path[-1]] != -1:
+            path.append(parents[path[-1]])
+        if len(path) < 2:
+            return
+        path = np.array(path, dtype=np.int64)
+        parents[path[1:]] = path[:-1]
+        parents[new_root] = -1
+        self._clear_caches()
+
+    def _mark_paths_to_root(self, indices):
+        """ Returns a boolean array that is true for the passed in nodes and
+        all their ancestors. Each node is visited at most once. """
+        marked = [False] * len(self.node_ids)
+        parents = self.parents.tolist()
+        for i in indices:
+            while i != -1 and not marked[i]:
+                marked[i] = True
+                i = parents[i]
+        return np.array(marked, dtype=bool)
+
+    def _nearest_marked_ancestors(self, marked):
+        """ Returns for each node the index of the closest ancestor for which
+        marked is true, or -1. Computed by pointer jumping. """
+        jump = self.parents.copy()
+        todo = np.flatnonzero(jump != -1)
+        todo = todo[~marked[jump[todo]]]
+        while len(todo):
+            jump[todo] = jump[jump[todo]]
+            todo = todo[jump[todo] != -1]
+            todo = todo[~marked[jump[todo]]]
+        return jump
+
+    def spanning_mask(self, indices):
+        """ Returns a boolean array that is true for all nodes on the paths
+        between the passed in nodes. """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        members = self._mark_paths_to_root(indices.tolist())
+        # Remove the path from the root down to the lowest common ancestor.
+        # Along it, nodes are neither wanted nor have more than one member
+        # child.
+        wanted = np.zeros(len(self.node_ids), dtype=bool)
+        wanted[indices] = True
+        member_children = np.bincount(
+                self.parents[members & (self.parents != -1)],
+                minlength=len(self.node_ids))
+        ptr, children = self.children()
+        node = self.root()
+        while not wanted[node] and 1 == member_children[node]:
+            members[node] = False
+            kids = children[ptr[node]:ptr[node + 1]]
+            node = kids[members[kids]][0]
+        return members
+
+    def subtree(self, mask, parents=None):
+        """ Returns a new ArrayTree with the nodes for which mask is true.
+        Nodes are connected to the passed in parent indices, by default
+        their parent in this tree, if that is part of the new tree. """
+        parents = (self.parents if parents is None else parents)[mask]
+        new_index = np.cumsum(mask) - 1
+        keep = parents != -1
+        keep[keep] = mask[parents[keep]]
+        new_parents = np.empty(len(parents), dtype=np.int64)
+        new_parents.fill(-1)
+        new_parents[keep] = new_index[parents[keep]]
+        return ArrayTree(self.node_ids[mask], new_parents,
+                None if self.locations is None else self.locations[mask],
+                dict((name, values[mask])
+                    for name, values in self.properties.iteritems()))
+
+    def simplify(self, keepers):
+        """ Returns a new ArrayTree with only the passed in nodes (indices)
+        and the branch nodes between them, each linked to its closest
+        remaining ancestor. Other than simplify(), the tree is not rerooted.
+        """
+        members = self.spanning_mask(keepers)
+        kept = np.zeros(len(self.node_ids), dtype=bool)
+        kept[np.asarray(list(keepers), dtype=np.int64)] = True
+        # Branch nodes of the spanning tree have at least three neighbors
+        has_parent = members & (self.parents != -1)
+        member_children = np.bincount(self.parents[has_parent],
+                minlength=len(self.node_ids))
+        degree = member_children + (has_parent & members[np.maximum(self.parents, 0)])
+        kept |= members & (degree > 2)
+        parents = self._nearest_marked_ancestors(kept)
+        # If the lowest common ancestor isn't kept, the topmost kept nodes of
+        # its two branches are linked directly.
+        tops = np.flatnonzero(kept & (parents == -1))
+        if 2 == len(tops):
+            parents[tops[1]] = tops[0]
+        return self.subtree(kept, parents)
+
+    def spanning_tree(self, preserve):
+        """ Returns a new ArrayTree with all nodes on the paths between the
+        passed in nodes (indices). """
+        return self.subtree(self.spanning_mask(preserve))
+
+    def partition(self):
+        """ Returns a generator of sequences of node indices, see partition().
+        """
+        depths = self.depths()
+        ends = self.end_nodes()
+        # Sort from highest to lowest distance to root, stable for equal ones
+        ends = ends[np.argsort(-depths[ends], kind='mergesort')]
+        parents = self.parents.tolist()
+        seen = [False] * len(self.node_ids)
+        for node in ends.tolist():
+            sequence = [node]
+            parent = parents[node]
+            while parent != -1:
+                sequence.append(parent)
+                if seen[parent]:
+                    break
+                seen[parent] = True
+                parent = parents[parent]
+            if len(sequence) > 1:
+                yield sequence
+
+    def cable_length(self):
+        """ Returns the summed length of all edges. """
+        has_parent = self.parents != -1
+        deltas = self.locations[has_parent] - \
+                self.locations[self.parents[has_parent]]
+        return float(np.sqrt((deltas * deltas).sum(axis=1)).sum())
+
+
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
     Will be the root node in directed graphs.
     Avoids one database lookup. """
+    if isinstance(tree, ArrayTree):
+        return tree.node_ids[tree.root()]
     for node in tree:
         if not next(tree.predecessors_iter(node), None):
             return node
 
 def edge_count_to_root(tree, root_node=None):
     """ Return a map of nodeID vs number of edges from the first node that lacks predecessors (aka the root). If root_id is None, it will be searched for."""
+    if isinstance(tree, ArrayTree):
+        # Counts start at 1 for the root, like below
+        return dict(izip(tree.node_ids.tolist(), (tree.depths() + 1).tolist()))
     distances = {}
     count = 1
     current_level = [root_node if root_node else find_root(tree)]
@@ -59,6 +315,9 @@ def find_common_ancestors(tree, node_groups):
 
 def reroot(tree, new_root):
     """ Reverse in place the direction of the edges from the new_root to root. """
+    if isinstance(tree, ArrayTree):
+        tree.reroot(tree.index(new_root))
+        return
     parent = next(tree.predecessors_iter(new_root), None)
     if not parent:
         # new_root is already the root
@@ -74,7 +333,10 @@ def simplify(tree, keepers):
     """ Given a tree and a set of nodes to keep, create a new tree
     where only the nodes to keep and the branch points between them are preserved.
     WARNING: will reroot the tree at the first of the keepers.
-    WARNING: keepers can't be empty. """
+    WARNING: keepers can't be empty.
+    An ArrayTree is not rerooted, and the result is an ArrayTree as well. """
+    if isinstance(tree, ArrayTree):
+        return tree.simplify(tree.index(list(set(keepers))))
     # Ensure no repeats
     keepers = set(keepers)
     # Add all keeper nodes to the minified graph
@@ -125,6 +387,11 @@ def partition(tree, root_node=None):
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
     Each sequence runs from an end node to either the root or a branch node. """
+    if isinstance(tree, ArrayTree):
+        node_ids = tree.node_ids
+        for sequence in tree.partition():
+            yield node_ids[sequence].tolist()
+        return
     distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
     seen = set()
     # Iterate end nodes sorted from highest to lowest distance to root
@@ -145,7 +412,10 @@ def partition(tree, root_node=None):
 
 def spanning_tree(tree, preserve):
     """ Return a new DiGraph with the spanning tree including the desired nodes.
-    preserve: the set of nodes that delimit the spanning tree. """
+    preserve: the set of nodes that delimit the spanning tree.
+    For an ArrayTree, the result is an ArrayTree as well. """
+    if isinstance(tree, ArrayTree):
+        return tree.spanning_tree(tree.index(list(set(preserve))))
     spanning = DiGraph()
     preserve = set(preserve) # duplicate, will be altered
     if 1 == len(preserve):
@@ -185,41 +455,98 @@ def spanning_tree(tree, preserve):
 
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
-    Returns the total cable length. """
+    Returns the total cable length.
+    The locations of an ArrayTree are taken from the tree itself. """
+    if isinstance(tree, ArrayTree):
+        return tree.cable_length()
     return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
 
 
-def lazy_load_trees(skeleton_ids, node_properties):
+def lazy_load_trees(skeleton_ids, node_properties, as_arrays=False,
+        memory_budget=LAZY_LOAD_MEMORY_BUDGET):
     """ Return a lazy collection of pairs of (long, DiGraph)
     representing (skeleton_id, tree).
     The node_properties is a list of strings, each being a name of a column
     in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
+    or skeleton_id.
+    With as_arrays, trees are returned as ArrayTree instances instead. The
+    location columns end up in their locations array and all other
+    properties in their properties dictionary.
+    Treenodes are streamed from a server-side cursor, in batches of about
+    memory_budget bytes. Each tree is returned as soon as all of its nodes
+    have been read. """
 
     values_list = ('id', 'parent_id', 'skeleton_id')
     props = tuple(set(node_properties) - set(values_list))
-    values_list += props
-
-    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
-            .order_by('skeleton') \
-            .values_list(*values_list)
-    skid = None
-    tree = None
-    for t in ts:
-        if t[2] != skid:
-            if tree:
-                yield (skid, tree)
-            # Prepare for the next one
-            skid = t[2]
-            tree = DiGraph()
+    rows = _stream_treenodes(skeleton_ids, props, memory_budget)
+    if as_arrays:
+        return ((skid, _array_tree(list(skeleton_rows), props))
+                for skid, skeleton_rows in groupby(rows, itemgetter(0)))
+    return ((skid, _digraph(skeleton_rows, props))
+            for skid, skeleton_rows in groupby(rows, itemgetter(0)))
+
+
+def _stream_treenodes(skeleton_ids, props, memory_budget):
+    """ Yields rows of (skeleton ID, node ID, parent ID) followed by the
+    values of props for all treenodes of the passed in skeletons, ordered
+    by skeleton. Rows are fetched from a server-side cursor, so that only
+    one batch of them is held in memory at a time. """
+    skeleton_ids = tuple(skeleton_ids)
+    if not skeleton_ids:
+        return
+    attname_to_column = dict((f.attname, f.column)
+            for f in Treenode._meta.fields)
+    batch_size = max(1, memory_budget //
+            (_ROW_BYTES + _VALUE_BYTES * (3 + len(props))))
+    name = 'lazy_load_trees_%s' % next(_cursor_ids)
+
+    cursor = connection.cursor()
+    # Outside of a transaction, the cursor has to outlive the implicit
+    # transaction of its DECLARE statement.
+    cursor.execute('''
+    DECLARE %s NO SCROLL CURSOR %s FOR
+    SELECT skeleton_id, id, parent_id%s
+    FROM treenode
+    WHERE skeleton_id IN (%s)
+    ORDER BY skeleton_id
+    ''' % (name,
+           'WITHOUT HOLD' if connection.in_atomic_block else 'WITH HOLD',
+           ''.join(', ' + attname_to_column[p] for p in props),
+           ','.join(str(int(skid)) for skid in skeleton_ids)))
+    try:
+        while True:
+            cursor.execute('FETCH FORWARD %s FROM %s' % (batch_size, name))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.execute('CLOSE %s' % name)
+
 
+def _digraph(rows, props):
+    """ Creates a DiGraph from rows of (skeleton ID, node ID, parent ID)
+    followed by the values of props. Edges point from child to parent. """
+    tree = DiGraph()
+    for t in rows:
         fields = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields)
+        tree.add_node(t[1], fields)
 
-        if t[1]:
+        if t[2]:
             # From child to parent
-            tree.add_edge(t[0], t[1])
+            tree.add_edge(t[1], t[2])
+    return tree
 
-    if tree:
-        yield (skid, tree)
 
+def _array_tree(rows, props):
+    """ Creates an ArrayTree from rows of (skeleton ID, node ID, parent ID)
+    followed by the values of props. """
+    columns = zip(*rows)
+    properties = dict(izip(props, columns[3:]))
+    locations = None
+    if all(c in properties for c in LOCATION_COLUMNS):
+        locations = np.column_stack([properties.pop(c)
+                for c in LOCATION_COLUMNS])
+    return ArrayTree.from_parent_ids(columns[1], columns[2], locations,
+            properties)
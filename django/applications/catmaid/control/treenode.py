@@ -14,6 +14,7 @@ from catmaid.control.authentication import requires_user_role, \
 from catmaid.control.common import get_relation_to_id_map, \
         get_class_to_id_map, insert_into_log
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control import node_cache
 
 
 def can_edit_treenode_or_fail(user, project_id, treenode_id):
@@ -94,6 +95,7 @@ def create_treenode(request, project_id=None):
         if parent_id:
             new_treenode.parent_id = parent_id
         new_treenode.save()
+        node_cache.invalidate_treenodes(project_id, [new_treenode.id])
         return new_treenode
 
     def relate_neuron_to_skeleton(neuron, skeleton):
@@ -213,18 +215,20 @@ def create_interpolated_treenode(request, project_id=None):
     for p in int_values.keys():
         params[p] = int(request.POST.get(p, int_values[p]))
 
-    last_treenode_id, skeleton_id = _create_interpolated_treenode(request, \
-         params, project_id, False)
+    last_treenode_id, skeleton_id, treenode_ids = \
+         _create_interpolated_treenode(request, params, project_id, False)
     return HttpResponse(json.dumps({
         'treenode_id': last_treenode_id,
-        'skeleton_id': skeleton_id
+        'skeleton_id': skeleton_id,
+        'treenode_ids': treenode_ids
     }))
 
 
 def _create_interpolated_treenode(request, params, project_id, skip_last):
     """ Create interpolated treenodes between the 'parent_id' and the clicked
     x,y,z coordinate. The skip_last is to prevent the creation of the last
-    node, used by the join_skeletons_interpolated. """
+    node, used by the join_skeletons_interpolated. Returns the ID of the last
+    node, the skeleton ID and the IDs of all new nodes. """
     response_on_error = 'Could not create interpolated treenode'
     try:
         # Raise an Exception if the user doesn't have permission to edit
@@ -250,37 +254,74 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
             BrokenSlice.objects.filter(stack=params['stack_id']))
         sign = -1 if dz < 0 else 1
 
-        # Loop the creation of treenodes in z resolution steps until target
-        # section is reached
-        parent_id = params['parent_id']
+        # Compute the locations of treenodes in z resolution steps until
+        # the target section is reached, skipping broken sections.
+        locations = []
         atn_slice_index = ((parent_z - params['stack_translation_z']) / params['resz']) \
             .quantize(decimal.Decimal('1'), rounding=decimal.ROUND_FLOOR)
         for i in range(1, steps + (0 if skip_last else 1)):
             if (atn_slice_index + i * sign) in broken_slices:
                 continue
-            response_on_error = 'Error while trying to insert treenode.'
-            new_treenode = Treenode()
-            new_treenode.user_id = request.user.id
-            new_treenode.editor_id = request.user.id
-            new_treenode.project_id = project_id
-            new_treenode.location_x = float(parent_x + dx * i)
-            new_treenode.location_y = float(parent_y + dy * i)
-            new_treenode.location_z = float(parent_z + dz * i)
-            new_treenode.radius = params['radius']
-            new_treenode.skeleton_id = parent_skeleton_id
-            new_treenode.confidence = params['confidence']
-            new_treenode.parent_id = parent_id  # This is not a root node.
-            new_treenode.save()
-
-            parent_id = new_treenode.id
-
-        # parent_id contains the ID of the last added node
-        return parent_id, parent_skeleton_id
+            locations.append((float(parent_x + dx * i),
+                              float(parent_y + dy * i),
+                              float(parent_z + dz * i)))
+
+        response_on_error = 'Error while trying to insert treenodes.'
+        new_treenode_ids = _insert_treenode_chain(project_id,
+                request.user.id, params['parent_id'], parent_skeleton_id,
+                locations, params['radius'], params['confidence'])
+
+        node_cache.invalidate_treenodes(project_id, new_treenode_ids)
+
+        # Return the ID of the last added node and all new IDs
+        last_treenode_id = new_treenode_ids[-1] if new_treenode_ids \
+                else params['parent_id']
+        return last_treenode_id, parent_skeleton_id, new_treenode_ids
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
 
+def _insert_treenode_chain(project_id, user_id, parent_id, skeleton_id,
+        locations, radius, confidence):
+    """ Inserts a chain of treenodes at the passed in list of (x, y, z)
+    locations with a single statement. The first node becomes a child of the
+    node with ID <parent_id> and each following one a child of its
+    predecessor. Returns the IDs of the new nodes, ordered along the chain.
+    """
+    if not locations:
+        return []
+    parent_id = int(parent_id)
+    params = []
+    for n, location in enumerate(locations):
+        params.extend((n,) + tuple(location))
+    params.extend((int(project_id), user_id, user_id, skeleton_id,
+            float(radius), int(confidence), parent_id))
+    cursor = connection.cursor()
+    cursor.execute('''
+    WITH new_node AS (
+        SELECT v.n, v.x, v.y, v.z, nextval('location_id_seq') AS id
+        FROM (VALUES %s) v(n, x, y, z)
+    )
+    INSERT INTO treenode (id, project_id, location_x, location_y, location_z,
+        editor_id, user_id, skeleton_id, radius, confidence, parent_id)
+    SELECT id, %%s, x, y, z, %%s, %%s, %%s, %%s, %%s,
+        coalesce(lag(id) OVER (ORDER BY n), %%s)
+    FROM new_node
+    ORDER BY n
+    RETURNING id, parent_id
+    ''' % ','.join(['(%s::integer, %s::real, %s::real, %s::real)'] *
+            len(locations)), params)
+    children = dict((row[1], row[0]) for row in cursor.fetchall())
+
+    new_treenode_ids = []
+    node_id = children.get(parent_id)
+    while node_id is not None:
+        new_treenode_ids.append(node_id)
+        node_id = children.get(node_id)
+    return new_treenode_ids
+
+
 @requires_user_role(UserRole.Annotate)
 def update_radius(request, project_id=None, treenode_id=None):
     treenode_id = int(treenode_id)
@@ -294,6 +335,7 @@ def update_radius(request, project_id=None, treenode_id=None):
         # Update radius only for the treenode
         Treenode.objects.filter(pk=treenode_id).update(editor=request.user,
                                                        radius=radius)
+        node_cache.invalidate_treenodes(project_id, [treenode_id])
         return HttpResponse(json.dumps({'success': True}))
 
     cursor.execute('''
@@ -317,6 +359,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        node_cache.invalidate_treenodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 2 == option:
@@ -335,6 +378,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        node_cache.invalidate_treenodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 3 == option:
@@ -349,6 +393,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        node_cache.invalidate_treenodes(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 4 == option:
@@ -358,6 +403,7 @@ def update_radius(request, project_id=None, treenode_id=None):
                 .filter(pk=treenode_id) \
                 .values('skeleton_id')) \
             .update(editor=request.user, radius=radius)
+        node_cache.invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
 
@@ -372,6 +418,9 @@ def delete_treenode(request, project_id=None):
     can_edit_treenode_or_fail(request.user, project_id, treenode_id)
     treenode = Treenode.objects.get(pk=treenode_id)
     parent_id = treenode.parent_id
+    # The treenode, its parent, children and connectors won't be found anymore
+    # after the deletion.
+    node_cache.invalidate_treenodes(project_id, [treenode_id])
 
     response_on_error = ''
     try:
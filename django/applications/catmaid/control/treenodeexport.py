@@ -9,7 +9,8 @@ from django.db.models import Count
 
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, id_generator
-from catmaid.control.cropping import CropJob, extract_substack, ImageRetrievalError
+from catmaid.control.cropping import CropJob, extract_substack, \
+        ImageRetrievalError, to_x_index, to_y_index, to_z_index
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
         Message, User, UserRole, Treenode
 
@@ -76,6 +77,10 @@ class TreenodeExporter:
         # Store meta data for each node
         self.metadata = {}
 
+        # The crop job of the first exported node, crop jobs of other nodes
+        # are derived from it.
+        self.crop_job = None
+
     def create_message(self, title, message, url):
         msg = Message()
         msg.user = User.objects.get(pk=int(self.job.user.id))
@@ -113,10 +118,10 @@ class TreenodeExporter:
             neuron_cici = ClassInstanceClassInstance.objects.get(
                     relation_id=self.relation_map['model_of'],
                     project_id=self.job.project_id,
-                    class_instance_a=treenode.skeleton.id)
+                    class_instance_a=treenode.skeleton_id)
             treenode_path = os.path.join(self.output_path,
                     str(neuron_cici.class_instance_b_id))
-            self.skid_to_neuron_folder[treenode.skeleton.id] = treenode_path
+            self.skid_to_neuron_folder[treenode.skeleton_id] = treenode_path
 
             # Create path output_path/neuron_id
             try:
@@ -145,24 +150,62 @@ class TreenodeExporter:
             return Treenode.objects.filter(project_id=self.job.project_id,
                     skeleton_id__in=self.job.skeleton_ids)
 
-    def export_single_node(self, treenode):
-        """ Exports a treenode and expects the output path to be existing
-        and writable.
+    def get_location(self, treenode):
+        """ Returns the location an exported image of a node is centered on.
+        """
+        return (treenode.location_x, treenode.location_y, treenode.location_z)
+
+    def create_crop_job(self, node):
+        """ Returns a crop job for the bounding box around a node. Stack and
+        project information is only looked up for the first node, the crop
+        jobs of all other nodes are copies of the first one.
         """
-        # Calculate bounding box for current connector
-        x_min = treenode.location_x - self.job.x_radius
-        x_max = treenode.location_x + self.job.x_radius
-        y_min = treenode.location_y - self.job.y_radius
-        y_max = treenode.location_y + self.job.y_radius
-        z_min = treenode.location_z - self.job.z_radius
-        z_max = treenode.location_z + self.job.z_radius
+        x, y, z = self.get_location(node)
+        # Calculate bounding box for current node
+        x_min = x - self.job.x_radius
+        x_max = x + self.job.x_radius
+        y_min = y - self.job.y_radius
+        y_max = y + self.job.y_radius
+        z_min = z - self.job.z_radius
+        z_max = z + self.job.z_radius
+
+        if self.crop_job:
+            return self.crop_job.copy_for_region(x_min, x_max, y_min, y_max,
+                    z_min, z_max)
+
         rotation_cw = 0
         zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
+        self.crop_job = CropJob(self.job.user, self.job.project_id,
                 self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
                 rotation_cw, zoom_level, single_channel=True)
+        self.crop_job.initialize()
+        return self.crop_job
+
+    def order_by_tiles(self, nodes):
+        """ Returns the passed in nodes sorted by the section and the tile of
+        the stack they are located in. Images of nodes that are exported one
+        after another share most of their tiles this way, which therefore have
+        to be loaded only once and can be taken from the tile cache
+        afterwards.
+        """
+        if not nodes:
+            return []
+        crop_job = self.create_crop_job(nodes[0])
+        stack = crop_job.ref_stack
+        translation = crop_job.get_translation(stack)
+        def tile_key(node):
+            x, y, z = self.get_location(node)
+            return (to_z_index(z - translation.z, crop_job),
+                    to_y_index(y - translation.y, crop_job) // stack.tile_height,
+                    to_x_index(x - translation.x, crop_job) // stack.tile_width)
+        return sorted(nodes, key=tile_key)
+
+    def export_single_node(self, treenode):
+        """ Exports a treenode and expects the output path to be existing
+        and writable.
+        """
+        # Create a single file for each section (instead of a mulipage TIFF)
+        crop_self = self.create_crop_job(treenode)
         cropped_stack = extract_substack(crop_self)
         # Save each file in output path
         output_path = self.create_path(treenode)
@@ -200,11 +243,11 @@ class TreenodeExporter:
         # parent-id, nr. presynaptic sites, nr. postsynaptic sites, x, y, z
         skid_to_metadata = {}
         for n in nodes:
-            ls = skid_to_metadata.get(n.skeleton.id)
+            ls = skid_to_metadata.get(n.skeleton_id)
             if not ls:
                 ls = []
-                skid_to_metadata[n.skeleton.id] = ls
-            p = n.parent.id if n.parent else 'null'
+                skid_to_metadata[n.skeleton_id] = ls
+            p = n.parent_id if n.parent_id else 'null'
             n_pre = presynaptic_map.get(n.id, 0)
             n_post = postsynaptic_map.get(n.id, 0)
             x = n.location_x
@@ -244,10 +287,10 @@ class ConnectorExporter(TreenodeExporter):
             neuron_cici = ClassInstanceClassInstance.objects.get(
                     relation_id=self.relation_map['model_of'],
                     project_id=self.job.project_id,
-                    class_instance_a=connector_link.skeleton.id)
-            self.skid_to_neuron_folder[connector_link.skeleton.id] = \
+                    class_instance_a=connector_link.skeleton_id)
+            self.skid_to_neuron_folder[connector_link.skeleton_id] = \
                     str(neuron_cici.class_instance_b_id)
-        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton.id]
+        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton_id]
 
         # get (and create if needed) cache entry for string of relation name
         if connector_link.relation_id not in self.relid_to_rel_folder:
@@ -262,7 +305,7 @@ class ConnectorExporter(TreenodeExporter):
 
         # Create path output_path/neuron_id/relation_name/connector_id
         connector_path = os.path.join(self.output_path, neuron_folder,
-                relation_folder, str(connector_link.connector.id))
+                relation_folder, str(connector_link.connector_id))
         try:
             os.makedirs(connector_path)
         except OSError as e:
@@ -309,26 +352,23 @@ class ConnectorExporter(TreenodeExporter):
 
         return connector_links
 
+    def get_location(self, connector_link):
+        """ Returns the location of the linked connector, exported images are
+        centered on it.
+        """
+        connector = connector_link.connector
+        return (connector.location_x, connector.location_y,
+                connector.location_z)
+
     def export_single_node(self, connector_link):
         """ Exports a single connector and expects the output path to be existing
         and writable.
         """
         connector = connector_link.connector
-
-        # Calculate bounding box for current connector
-        x_min = connector.location_x - self.job.x_radius
-        x_max = connector.location_x + self.job.x_radius
-        y_min = connector.location_y - self.job.y_radius
-        y_max = connector.location_y + self.job.y_radius
         z_min = connector.location_z - self.job.z_radius
-        z_max = connector.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
 
         # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
+        crop_self = self.create_crop_job(connector_link)
         cropped_stack = extract_substack(crop_self)
         # Save each file in output path
         connector_path = self.create_path(connector_link)
@@ -366,8 +406,9 @@ def process_export_job(exporter):
     # Store error codes and URLs for unreachable images for each failed link
     error_urls = {}
     try:
-        # Export every node
-        for node in nodes:
+        # Export every node. Nodes that are close to each other are exported
+        # one after another so that they can share loaded tiles.
+        for node in exporter.order_by_tiles(nodes):
             try:
                 exporter.export_single_node(node)
             except ImageRetrievalError as e:
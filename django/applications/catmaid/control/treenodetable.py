@@ -12,6 +12,7 @@ from catmaid.models import ProjectStack, Stack, Treenode, \
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
 from catmaid.control.review import get_treenodes_to_reviews
+from catmaid.control import node_cache
 
 
 @requires_user_role(UserRole.Annotate)
@@ -48,6 +49,7 @@ def update_treenode_table(request, project_id=None):
         setattr(treenode, property_name, property_value)
         treenode.user = request.user
         treenode.save()
+        node_cache.invalidate_treenodes(project_id, [treenode_id])
 
         return HttpResponse(property_value)
 
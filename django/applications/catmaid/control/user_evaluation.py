@@ -2,19 +2,36 @@ import json
 
 from datetime import datetime, timedelta
 from collections import defaultdict, namedtuple
-from itertools import imap
+from itertools import imap, islice
 from networkx import connected_components
 from functools import partial
+from billiard import Pool
 
+from django.conf import settings
+from django.db import connection
 from django.db.models import Count
 from django.http import HttpResponse
 
-from catmaid.models import Treenode, Log, Relation, TreenodeConnector, \
-        UserRole, Review
+from catmaid.models import Treenode, Log, Relation, UserRole
 from catmaid.control.review import get_review_status
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.tree_util import lazy_load_trees
 
+from celery.task import task
+from celery.result import AsyncResult
+
+
+# The most recent reviews of a treenode come first
+ReviewEntry = namedtuple('ReviewEntry', ['reviewer_id', 'review_time'])
+
+# A connector link of a treenode
+SynapseEntry = namedtuple('SynapseEntry', ['treenode_id', 'relation_id', 'user_id', 'creation_time'])
+
+# A split_skeleton or join_skeleton log entry
+LogEntry = namedtuple('LogEntry', ['user_id', 'operation_type', 'location', 'creation_time'])
+
+EpochOps = namedtuple('EpochOps', ['reviewer_id', 'review_date_range', 'creation_date_range', 'user_node_counts', 'splits', 'merges', 'appended', 'node_count', 'n_pre', 'n_post', 'reviewer_n_pre', 'reviewer_n_post', 'newer_pre_count', 'newer_post_count'])
+
 
 def _find_nearest(tree, nodes, loc1):
     """ Returns a tuple of the closest node and the square of the distance. """
@@ -33,13 +50,14 @@ def _find_nearest(tree, nodes, loc1):
 def _parse_location(loc):
     return map(float, loc[1:-1].split(','))
 
-def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
+def _evaluate_epochs(epochs, skeleton_id, tree, reviews, synapses, log_entries, relations):
     """ Evaluate each epoch:
     1. Detect merges done by the reviewer: one of the two nodes is edited by the reviewer within the review epoch (but not both: could be a reroot then), with a corresponding join_skeleton entry in the log table. Perhaps the latter is enough, if the x,y,z of the log corresponds to that of the node (plus/minus a tiny bit, may have moved).
     2. Detect additions by the reviewer (a kind of merge), where the reviewer's node is newer than the other node, and it was created within the review epoch. These nodes would have been created and reviewed by the reviewer within the review epoch.
     3. Detect splits by the reviewer: query the log table for split_skeleton events involving the skeleton, performed by the reviewer within the review epoch.
     Returns a list with one entry per epoch, where each entry is an object with three fields: 
     4. Detect synapses added by the reviewer within the epoch. Unfortunately, the removal of synapses has not been logged.
+    The synapses and split or join log entries of the skeleton are passed in as lists of SynapseEntry and LogEntry.
     """
 
     # TODO extended branches when the last node didn't have an ends tag prior to reviewing should not be considered an error.
@@ -51,14 +69,13 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
     # merges: list of dictionary of user_id vs count
     # appended: similar to merges; list of dictionary of user_id vs count of nodes added by the reviewer within the review epoch
     # node_count: total number of nodes reviewed within the epoch.
-    EpochOps = namedtuple('EpochOps', ['reviewer_id', 'review_date_range', 'creation_date_range', 'user_node_counts', 'splits', 'merges', 'appended', 'node_count', 'n_pre', 'n_post', 'reviewer_n_pre', 'reviewer_n_post', 'newer_pre_count', 'newer_post_count'])
 
     # List of EpochOps, indexed like epochs
     epoch_ops = []
 
     # Synapses on the arbor: keyed by treenode_id
     all_synapses = defaultdict(list)
-    for s in TreenodeConnector.objects.filter(skeleton=skeleton_id):
+    for s in synapses:
         all_synapses[s.treenode_id].append(s)
 
     for epoch in epochs:
@@ -133,15 +150,8 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
                     if in_range(s.creation_time):
                         reviewer_n_post[tree.node[s.treenode_id]['user_id']] += 1
 
-
-        date_range = [start_date, end_date]
-
-        log_ops = Log.objects.filter(
-                      user_id=reviewer_id,
-                      freetext__contains=' %s ' % skeleton_id,
-                      creation_time__range=date_range,
-                      operation_type__in=('split_skeleton', 'join_skeleton')) \
-                   .values_list('operation_type', 'location')
+        log_ops = [(e.operation_type, e.location) for e in log_entries
+                   if e.user_id == reviewer_id and in_range(e.creation_time)]
 
         # Only join_skeleton operations performed by the reviewer
         # within the reviewing epoch are considered.
@@ -153,7 +163,7 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
         merges = defaultdict(int)
         appended = defaultdict(list)
 
-        epoch_ops.append(EpochOps(reviewer_id, date_range, user_ranges,
+        epoch_ops.append(EpochOps(reviewer_id, [start_date, end_date], user_ranges,
             user_node_counts, splits, merges, appended, len(nodes),
             epoch_n_pre, epoch_n_post, reviewer_n_pre, reviewer_n_post,
             newer_synapses_count.get(relations['presynaptic_to'], {}),
@@ -234,7 +244,7 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     epochs = [(last_review.reviewer_id, epoch)]
 
     # Iterate from second-oldest node forward in time
-    for node, props in nodes:
+    for node, props in islice(nodes, 1, None):
         # Most recent review of current node
         node_review = reviews[node][0]
         # Add to current epoch if same reviewer and we are within max_gap
@@ -251,14 +261,126 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     return epochs
 
 
-def _evaluate_arbor(user_id, skeleton_id, tree, reviews, relations, max_gap):
+def _evaluate_arbor(user_id, skeleton_id, tree, reviews, synapses, log_entries, relations, max_gap):
     """ Split the arbor into review epochs and then evaluate each independently. """
     epochs = _split_into_epochs(skeleton_id, tree, reviews, max_gap)
-    epoch_ops = _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations)
+    epoch_ops = _evaluate_epochs(epochs, skeleton_id, tree, reviews, synapses, log_entries, relations)
     return epoch_ops
 
 
-def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
+def _evaluate_skeleton(args):
+    """ Evaluates a single arbor and returns the entries of all review epochs
+    to which the user contributed. Runs in a worker process of the pool, all
+    database queries have been done already. """
+    user_id, skid, tree, reviews, synapses, log_entries, relations, max_gap = args
+    arbor_epoch_ops = _evaluate_arbor(user_id, skid, tree, reviews, synapses, log_entries, relations, max_gap)
+
+    # The X axis is the last (user) creation date within the review epoch
+    # The Y axis is multiple, and includes:
+    #  * skeleton_id
+    #  * reviewer_id
+    #  * time of the last node created by the user_id in skeleton_id
+    #  * nodes contributed by the user that were reviewed within the epoch
+    #  * number of nodes missed by the user (which were added by the reviewer)
+    #  * splits onto the user's nodes
+    #  * merges onto the user's nodes
+    #  * additions by the reviewer onto nodes of this user (another form of merges)
+    #  * total number of presynaptic relations of skeleton_id
+    #  * total number of postsynaptic relations of skeleton_id
+    #  * number of presynaptic_to relations created by the reviewer within the review period onto treenodes created by user_id
+    #  * number of postsynaptic_to relations created by the reviewer within the review period onto treenodes created by user_id
+    #  * newer_synapses: number of synapses created by someone else onto treenodes created by user_id, after the creation of the treenode
+
+    d = []
+    for epoch_ops in arbor_epoch_ops:
+        if 0 == epoch_ops.user_node_counts[user_id]:
+            # user did not contribute at all to this chunk
+            continue
+        appended = epoch_ops.appended[user_id]
+        d.append({'skeleton_id': skid,
+                  'reviewer_id': epoch_ops.reviewer_id,
+                  'timepoint': epoch_ops.creation_date_range[user_id]['end'].strftime('%Y-%m-%d'),
+                  'n_created_nodes': epoch_ops.user_node_counts[user_id],
+                  'n_nodes': epoch_ops.node_count,
+                  'n_missed_nodes': sum(appended),
+                  'n_splits': epoch_ops.splits[user_id],
+                  'n_merges': epoch_ops.merges[user_id] + len(appended),
+                  'n_pre': epoch_ops.n_pre,
+                  'n_post': epoch_ops.n_post,
+                  'reviewer_n_pre': epoch_ops.reviewer_n_pre.get(user_id, 0),
+                  'reviewer_n_post': epoch_ops.reviewer_n_post.get(user_id, 0),
+                  'newer_pre': epoch_ops.newer_pre_count.get(user_id, 0),
+                  'newer_post': epoch_ops.newer_post_count.get(user_id, 0)})
+    return d
+
+
+def _prefetch(skeleton_ids):
+    """ Fetches the reviews, synapses and split or join log entries of all
+    passed in skeletons at once. Returns three dictionaries of skeleton ID vs
+    treenode ID vs list of ReviewEntry (most recent first), skeleton ID vs
+    list of SynapseEntry and skeleton ID vs list of LogEntry. """
+    ids = ",".join(str(int(skid)) for skid in skeleton_ids)
+    cursor = connection.cursor()
+
+    # Get review information and organize it by skeleton ID and treenode ID
+    reviews = defaultdict(lambda: defaultdict(list))
+    cursor.execute('''
+    SELECT skeleton_id, treenode_id, reviewer_id, review_time
+    FROM review
+    WHERE skeleton_id IN (%s)
+    ''' % ids)
+    for skid, tid, reviewer_id, review_time in cursor.fetchall():
+        reviews[skid][tid].append(ReviewEntry(reviewer_id, review_time))
+
+    # Sort all reviews of all treenodes by review time, most recent first
+    reviewer_ids = set()
+    start_date, end_date = datetime.max, datetime.min
+    for skid, tid_to_rs in reviews.iteritems():
+        for tid, rs in tid_to_rs.iteritems():
+            rs.sort(key=lambda r: r.review_time)
+            rs.reverse()
+            reviewer_ids.add(rs[0].reviewer_id)
+            start_date = min(start_date, rs[0].review_time)
+            end_date = max(end_date, rs[0].review_time)
+
+    synapses = defaultdict(list)
+    cursor.execute('''
+    SELECT skeleton_id, treenode_id, relation_id, user_id, creation_time
+    FROM treenode_connector
+    WHERE skeleton_id IN (%s)
+    ''' % ids)
+    for row in cursor.fetchall():
+        synapses[row[0]].append(SynapseEntry(*row[1:]))
+
+    # Only splits and joins of the most recent reviewers within the review
+    # epochs are evaluated. A log entry belongs to all skeletons whose ID is
+    # part of its text, enclosed in spaces.
+    log_entries = defaultdict(list)
+    if reviewer_ids:
+        skids = set(str(skid) for skid in skeleton_ids)
+        for user_id, operation_type, location, creation_time, freetext in Log.objects.filter(
+                user_id__in=reviewer_ids,
+                creation_time__range=(start_date, end_date),
+                operation_type__in=('split_skeleton', 'join_skeleton')) \
+                .values_list('user_id', 'operation_type', 'location', 'creation_time', 'freetext'):
+            entry = LogEntry(user_id, operation_type, location, creation_time)
+            for word in set(freetext.split(' ')[1:-1]):
+                if word in skids:
+                    log_entries[int(word)].append(entry)
+
+    return reviews, synapses, log_entries
+
+
+def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes,
+        processes=1, progress=None):
+    """ Evaluates all fully reviewed skeletons the user contributed to. By
+    default, this is done by the calling process. With more than one process,
+    a pool of <processes> worker processes is used, which only Celery tasks
+    do: a web worker would have to fork for every request. Billiard's pool is
+    used, because unlike the one of multiprocessing, it can be created by the
+    daemonic worker processes of Celery. If given,
+    <progress> is called with the number of evaluated and the total number of
+    skeletons after each batch of skeletons. """
 
     # Obtain neurons that are fully reviewed at the moment
     # and to which the user contributed nodes within the date range.
@@ -290,71 +412,52 @@ def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
     if not skeleton_ids:
         return None
 
-    # Get review information and organize it by skeleton ID and treenode ID
-    reviews = defaultdict(lambda: defaultdict(list))
-    for r in Review.objects.filter(skeleton_id__in=skeleton_ids):
-        reviews[r.skeleton_id][r.treenode_id].append(r)
-
-    # Sort all reviews of all treenodes by review time, most recent first
-    for skid, tid_to_rs in reviews.iteritems():
-        for tid, rs in tid_to_rs.iteritems():
-            rs.sort(key=lambda r: r.review_time)
-            rs.reverse()
+    # 2. Fetch everything but the arbors themselves in bulk
+    reviews, synapses, log_entries = _prefetch(skeleton_ids)
 
     relations = dict(Relation.objects.filter(project_id=project_id, relation_name__in=['presynaptic_to', 'postsynaptic_to']).values_list('relation_name', 'id'))
 
-    # 2. Load each fully reviewed skeleton one at a time
-    evaluations = {skid: _evaluate_arbor(user_id, skid, tree, reviews[skid], relations, max_gap) \
+    # 3. Load the fully reviewed skeletons one at a time and evaluate them
+    #    in batches, in parallel.
+    jobs = ((user_id, skid, tree, reviews[skid], synapses[skid], log_entries[skid], relations, max_gap) \
         for skid, tree in lazy_load_trees(skeleton_ids, ('location_x', 'location_y', 'location_z', \
                                                          'creation_time', 'user_id', 'editor_id', \
-                                                         'edition_time'))}
-
-    # 3. Extract evaluations for the user_id over time
-    # Each evaluation contains an instance of EpochOps namedtuple, with members:
-    # 'review_date_range', 'creation_date_range', 'user_node_counts',
-    # 'splits', 'merges', 'appended', 'node_count'
-
-    # The X axis is the last (user) creation date within the review epoch
-    # The Y axis is multiple, and includes:
-    #  * skeleton_id
-    #  * reviewer_id
-    #  * time of the last node created by the user_id in skeleton_id
-    #  * nodes contributed by the user that were reviewed within the epoch
-    #  * number of nodes missed by the user (which were added by the reviewer)
-    #  * splits onto the user's nodes
-    #  * merges onto the user's nodes
-    #  * additions by the reviewer onto nodes of this user (another form of merges)
-    #  * total number of presynaptic relations of skeleton_id
-    #  * total number of postsynaptic relations of skeleton_id
-    #  * number of presynaptic_to relations created by the reviewer within the review period onto treenodes created by user_id
-    #  * number of postsynaptic_to relations created by the reviewer within the review period onto treenodes created by user_id
-    #  * newer_synapses: number of synapses created by someone else onto treenodes created by user_id, after the creation of the treenode
+                                                         'edition_time')))
+
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        d = []
+        done = 0
+        batch_size = 4 * processes
+        while True:
+            batch = list(islice(jobs, batch_size))
+            if not batch:
+                break
+            results = pool.map(_evaluate_skeleton, batch) if pool else \
+                    imap(_evaluate_skeleton, batch)
+            for entries in results:
+                d.extend(entries)
+            done += len(batch)
+            if progress:
+                progress(done, len(skeleton_ids))
+    finally:
+        if pool:
+            pool.terminate()
 
-    d = []
+    return d
 
-    for skid, arbor_epoch_ops in evaluations.iteritems():
-        for epoch_ops in arbor_epoch_ops:
-            if 0 == epoch_ops.user_node_counts[user_id]:
-                # user did not contribute at all to this chunk
-                continue
-            appended = epoch_ops.appended[user_id]
-            print appended
-            d.append({'skeleton_id': skid,
-                      'reviewer_id': epoch_ops.reviewer_id,
-                      'timepoint': epoch_ops.creation_date_range[user_id]['end'].strftime('%Y-%m-%d'),
-                      'n_created_nodes': epoch_ops.user_node_counts[user_id],
-                      'n_nodes': epoch_ops.node_count,
-                      'n_missed_nodes': sum(appended),
-                      'n_splits': epoch_ops.splits[user_id],
-                      'n_merges': epoch_ops.merges[user_id] + len(appended),
-                      'n_pre': epoch_ops.n_pre,
-                      'n_post': epoch_ops.n_post,
-                      'reviewer_n_pre': epoch_ops.reviewer_n_pre.get(user_id, 0),
-                      'reviewer_n_post': epoch_ops.reviewer_n_post.get(user_id, 0),
-                      'newer_pre': epoch_ops.newer_pre_count.get(user_id, 0),
-                      'newer_post': epoch_ops.newer_post_count.get(user_id, 0)})
 
-    return d
+@task()
+def evaluate_user_task(project_id, user_id, start_date, end_date, max_gap, min_nodes):
+    """ Runs a user evaluation as Celery task with a pool of
+    settings.USER_EVALUATION_PROCESSES worker processes. The number of
+    evaluated skeletons is reported as progress. """
+    def progress(done, total):
+        evaluate_user_task.update_state(state='PROGRESS',
+                meta={'done': done, 'total': total})
+    return _evaluate(project_id, user_id, start_date, end_date, max_gap,
+            min_nodes, processes=settings.USER_EVALUATION_PROCESSES,
+            progress=progress)
 
 
 def _parse_date(s):
@@ -373,5 +476,26 @@ def evaluate_user(request, project_id=None):
     if min_nodes < 1:
         min_nodes = 1
 
+    if request.POST.get('async', 'false') == 'true':
+        # Evaluate as Celery job, whose state can be queried with
+        # evaluate_user_status.
+        job = evaluate_user_task.delay(project_id, user_id, start_date, end_date, max_gap, min_nodes)
+        return HttpResponse(json.dumps({'job_id': job.id}))
+
     return HttpResponse(json.dumps(_evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes)))
 
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def evaluate_user_status(request, project_id=None, job_id=None):
+    """ Returns the state of a user evaluation job and, once it finished, its
+    result. While running, the number of evaluated and the total number of
+    skeletons are reported. """
+    job = AsyncResult(job_id)
+    response = {'state': job.state}
+    if job.successful():
+        response['result'] = job.result
+    elif job.failed():
+        response['error'] = str(job.result)
+    elif 'PROGRESS' == job.state:
+        response.update(job.info)
+    return HttpResponse(json.dumps(response))
+
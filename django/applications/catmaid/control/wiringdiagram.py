@@ -3,9 +3,9 @@ import networkx as nx
 from networkx.readwrite import json_graph
 
 from django.http import HttpResponse
-from django.db.models import Count
+from django.db import connection
 
-from catmaid.models import Treenode, TreenodeConnector, UserRole
+from catmaid.models import TreenodeConnector, UserRole
 from catmaid.control.authentication import requires_user_role
 
 
@@ -27,10 +27,14 @@ def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
             # connector with multiple presynaptic connections
             pass
 
-    skeletons={}
-    qs = Treenode.objects.filter(project=project_id).values('skeleton').annotate(Count('skeleton'))
-    for e in qs:
-        skeletons[ e['skeleton'] ]=e['skeleton__count']
+    # get the number of nodes of each skeleton from the skeleton summary
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT skeleton_id, num_nodes
+    FROM skeleton_summary
+    WHERE project_id = %s
+    ''', (int(project_id),))
+    skeletons = dict(cursor.fetchall())
 
     # get the postsynaptic connections
     qs = TreenodeConnector.objects.filter(
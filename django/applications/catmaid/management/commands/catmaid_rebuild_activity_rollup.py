@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+class Command(NoArgsCommand):
+    help = "Recreate the per user and half hour counts of created and " \
+           "edited treenodes and connectors and of reviews from scratch"
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("SELECT rebuild_activity_rollup()")
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+class Command(NoArgsCommand):
+    help = "Recreate the closure of all annotation hierarchies, i.e. the " \
+           "direct and indirect sub-annotations of all annotations, from " \
+           "scratch"
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("SELECT rebuild_annotation_closure()")
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+class Command(NoArgsCommand):
+    help = "Recreate the summaries of all skeletons (node counts, cable " \
+           "length, review and synapse counts) and the synaptic edges " \
+           "between them from scratch"
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("SELECT rebuild_skeleton_summary()")
+            cursor.execute("SELECT rebuild_synapse_edges()")
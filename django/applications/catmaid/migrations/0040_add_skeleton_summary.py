@@ -0,0 +1,1042 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        db.execute('''
+            /* Summaries of all skeletons, they are kept up to date by the
+             * triggers below. The cable length is the sum of the lengths of
+             * the edges between all nodes and their parents.
+             */
+            CREATE TABLE skeleton_summary (
+                skeleton_id integer PRIMARY KEY,
+                project_id integer NOT NULL,
+                num_nodes integer NOT NULL DEFAULT 0,
+                cable_length double precision NOT NULL DEFAULT 0,
+                num_reviewed integer NOT NULL DEFAULT 0,
+                num_presynaptic integer NOT NULL DEFAULT 0,
+                num_postsynaptic integer NOT NULL DEFAULT 0,
+                last_edition_time timestamp with time zone NOT NULL
+            );
+            CREATE INDEX skeleton_summary_project_id_index
+                ON skeleton_summary (project_id);
+
+            /* The number of nodes each user reviewed in each skeleton.
+             */
+            CREATE TABLE review_summary (
+                skeleton_id integer NOT NULL,
+                reviewer_id integer NOT NULL,
+                num_reviewed integer NOT NULL DEFAULT 0,
+                PRIMARY KEY (skeleton_id, reviewer_id)
+            );
+
+            /* Adds the passed in differences to the summary of a skeleton.
+             * A summary is only created for skeletons that get nodes and it
+             * is removed if a skeleton doesn't have any nodes anymore. If
+             * another transaction creates the summary first, the insert
+             * fails and the summary is updated instead.
+             */
+            CREATE FUNCTION update_skeleton_summary(_skeleton_id integer,
+                    _project_id integer, _num_nodes integer,
+                    _cable_length double precision, _num_reviewed integer,
+                    _num_presynaptic integer, _num_postsynaptic integer,
+                    _edition_time timestamp with time zone)
+                RETURNS void AS
+            $$
+                BEGIN
+                    LOOP
+                        UPDATE skeleton_summary SET
+                            num_nodes = num_nodes + _num_nodes,
+                            cable_length = cable_length + _cable_length,
+                            num_reviewed = num_reviewed + _num_reviewed,
+                            num_presynaptic = num_presynaptic + _num_presynaptic,
+                            num_postsynaptic = num_postsynaptic + _num_postsynaptic,
+                            last_edition_time = greatest(last_edition_time, _edition_time)
+                        WHERE skeleton_id = _skeleton_id;
+                        IF FOUND THEN
+                            IF _num_nodes < 0 THEN
+                                DELETE FROM skeleton_summary
+                                WHERE skeleton_id = _skeleton_id
+                                  AND num_nodes <= 0;
+                            END IF;
+                            RETURN;
+                        END IF;
+                        IF _num_nodes <= 0 THEN
+                            RETURN;
+                        END IF;
+                        BEGIN
+                            INSERT INTO skeleton_summary VALUES (_skeleton_id,
+                                _project_id, _num_nodes, _cable_length,
+                                _num_reviewed, _num_presynaptic,
+                                _num_postsynaptic, _edition_time);
+                            RETURN;
+                        EXCEPTION WHEN unique_violation THEN
+                            -- Update the summary created in the meantime
+                        END;
+                    END LOOP;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Adds the passed in difference to the number of nodes a user
+             * reviewed in a skeleton, like update_skeleton_summary().
+             */
+            CREATE FUNCTION update_review_summary(_skeleton_id integer,
+                    _reviewer_id integer, _num_reviewed integer)
+                RETURNS void AS
+            $$
+                BEGIN
+                    LOOP
+                        UPDATE review_summary
+                        SET num_reviewed = num_reviewed + _num_reviewed
+                        WHERE skeleton_id = _skeleton_id
+                          AND reviewer_id = _reviewer_id;
+                        IF FOUND THEN
+                            IF _num_reviewed < 0 THEN
+                                DELETE FROM review_summary
+                                WHERE skeleton_id = _skeleton_id
+                                  AND reviewer_id = _reviewer_id
+                                  AND num_reviewed <= 0;
+                            END IF;
+                            RETURN;
+                        END IF;
+                        IF _num_reviewed <= 0 THEN
+                            RETURN;
+                        END IF;
+                        BEGIN
+                            INSERT INTO review_summary VALUES (_skeleton_id,
+                                _reviewer_id, _num_reviewed);
+                            RETURN;
+                        EXCEPTION WHEN unique_violation THEN
+                            -- Update the summary created in the meantime
+                        END;
+                    END LOOP;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Updates skeleton summaries when treenodes are created, moved,
+             * re-parented, assigned to another skeleton or deleted. An edge
+             * belongs to the skeleton of its child node. Since the triggers
+             * run before each row is changed, they see the changes made to
+             * rows processed earlier by the same statement. This makes sure
+             * edges between two nodes that are created or deleted by the same
+             * statement are counted exactly once. Updates that don't change
+             * the skeleton, parent, location or confidence of a node leave
+             * the summary alone, confidence changes only count as an edit.
+             */
+            CREATE FUNCTION on_change_treenode_update_summary()
+                RETURNS trigger AS
+            $$
+                DECLARE
+                    parent_x double precision;
+                    parent_y double precision;
+                    parent_z double precision;
+                    old_length double precision := 0;
+                    new_length double precision := 0;
+                    child record;
+                BEGIN
+                    IF TG_OP = 'UPDATE' THEN
+                        IF NEW.skeleton_id = OLD.skeleton_id
+                                AND NEW.parent_id IS NOT DISTINCT FROM OLD.parent_id
+                                AND NEW.location_x = OLD.location_x
+                                AND NEW.location_y = OLD.location_y
+                                AND NEW.location_z = OLD.location_z THEN
+                            IF NEW.confidence <> OLD.confidence THEN
+                                PERFORM update_skeleton_summary(NEW.skeleton_id,
+                                    NEW.project_id, 0, 0, 0, 0, 0,
+                                    NEW.edition_time);
+                            END IF;
+                            RETURN NEW;
+                        END IF;
+                    END IF;
+
+                    -- Length of the edge to the old parent
+                    IF TG_OP <> 'INSERT' AND OLD.parent_id IS NOT NULL THEN
+                        SELECT location_x, location_y, location_z
+                        INTO parent_x, parent_y, parent_z
+                        FROM treenode WHERE id = OLD.parent_id;
+                        IF FOUND THEN
+                            old_length := sqrt((OLD.location_x - parent_x)^2 +
+                                               (OLD.location_y - parent_y)^2 +
+                                               (OLD.location_z - parent_z)^2);
+                        END IF;
+                    END IF;
+
+                    -- Length of the edge to the new parent
+                    IF TG_OP <> 'DELETE' AND NEW.parent_id IS NOT NULL THEN
+                        SELECT location_x, location_y, location_z
+                        INTO parent_x, parent_y, parent_z
+                        FROM treenode WHERE id = NEW.parent_id;
+                        IF FOUND THEN
+                            new_length := sqrt((NEW.location_x - parent_x)^2 +
+                                               (NEW.location_y - parent_y)^2 +
+                                               (NEW.location_z - parent_z)^2);
+                        END IF;
+                    END IF;
+
+                    -- Edges of child nodes change if a node is created,
+                    -- moved or deleted.
+                    IF TG_OP = 'INSERT' THEN
+                        FOR child IN
+                            SELECT c.skeleton_id, c.project_id,
+                                sum(sqrt((c.location_x - NEW.location_x)^2 +
+                                         (c.location_y - NEW.location_y)^2 +
+                                         (c.location_z - NEW.location_z)^2)) AS length
+                            FROM treenode c WHERE c.parent_id = NEW.id
+                            GROUP BY c.skeleton_id, c.project_id
+                        LOOP
+                            PERFORM update_skeleton_summary(child.skeleton_id,
+                                child.project_id, 0, child.length, 0, 0, 0, NULL);
+                        END LOOP;
+                    ELSIF TG_OP = 'DELETE' THEN
+                        FOR child IN
+                            SELECT c.skeleton_id, c.project_id,
+                                sum(sqrt((c.location_x - OLD.location_x)^2 +
+                                         (c.location_y - OLD.location_y)^2 +
+                                         (c.location_z - OLD.location_z)^2)) AS length
+                            FROM treenode c WHERE c.parent_id = OLD.id
+                            GROUP BY c.skeleton_id, c.project_id
+                        LOOP
+                            PERFORM update_skeleton_summary(child.skeleton_id,
+                                child.project_id, 0, -child.length, 0, 0, 0, NULL);
+                        END LOOP;
+                    ELSIF NEW.location_x <> OLD.location_x
+                            OR NEW.location_y <> OLD.location_y
+                            OR NEW.location_z <> OLD.location_z THEN
+                        FOR child IN
+                            SELECT c.skeleton_id, c.project_id,
+                                sum(sqrt((c.location_x - NEW.location_x)^2 +
+                                         (c.location_y - NEW.location_y)^2 +
+                                         (c.location_z - NEW.location_z)^2) -
+                                    sqrt((c.location_x - OLD.location_x)^2 +
+                                         (c.location_y - OLD.location_y)^2 +
+                                         (c.location_z - OLD.location_z)^2)) AS length
+                            FROM treenode c WHERE c.parent_id = NEW.id
+                            GROUP BY c.skeleton_id, c.project_id
+                        LOOP
+                            PERFORM update_skeleton_summary(child.skeleton_id,
+                                child.project_id, 0, child.length, 0, 0, 0, NULL);
+                        END LOOP;
+                    END IF;
+
+                    IF TG_OP = 'INSERT' THEN
+                        PERFORM update_skeleton_summary(NEW.skeleton_id,
+                            NEW.project_id, 1, new_length, 0, 0, 0,
+                            NEW.edition_time);
+                        RETURN NEW;
+                    ELSIF TG_OP = 'DELETE' THEN
+                        PERFORM update_skeleton_summary(OLD.skeleton_id,
+                            OLD.project_id, -1, -old_length, 0, 0, 0, now());
+                        RETURN OLD;
+                    ELSIF NEW.skeleton_id = OLD.skeleton_id THEN
+                        PERFORM update_skeleton_summary(NEW.skeleton_id,
+                            NEW.project_id, 0, new_length - old_length, 0, 0,
+                            0, NEW.edition_time);
+                    ELSE
+                        PERFORM update_skeleton_summary(OLD.skeleton_id,
+                            OLD.project_id, -1, -old_length, 0, 0, 0,
+                            NEW.edition_time);
+                        PERFORM update_skeleton_summary(NEW.skeleton_id,
+                            NEW.project_id, 1, new_length, 0, 0, 0,
+                            NEW.edition_time);
+                    END IF;
+                    RETURN NEW;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Updates the number of reviewed nodes of skeletons. A node
+             * counts as reviewed if at least one review refers to it. The
+             * reviewed treenodes are locked before their other reviews are
+             * looked for, so that concurrent first reviews of a node don't
+             * both count it.
+             */
+            CREATE FUNCTION on_change_review_update_summary()
+                RETURNS trigger AS
+            $$
+                BEGIN
+                    IF TG_OP = 'UPDATE' THEN
+                        IF NEW.skeleton_id = OLD.skeleton_id
+                                AND NEW.treenode_id = OLD.treenode_id
+                                AND NEW.reviewer_id = OLD.reviewer_id THEN
+                            RETURN NEW;
+                        END IF;
+                        PERFORM 1 FROM treenode
+                        WHERE id IN (OLD.treenode_id, NEW.treenode_id)
+                        ORDER BY id FOR UPDATE;
+                    ELSIF TG_OP = 'INSERT' THEN
+                        PERFORM 1 FROM treenode WHERE id = NEW.treenode_id
+                        FOR UPDATE;
+                    ELSE
+                        PERFORM 1 FROM treenode WHERE id = OLD.treenode_id
+                        FOR UPDATE;
+                    END IF;
+
+                    IF TG_OP <> 'INSERT' THEN
+                        PERFORM update_review_summary(OLD.skeleton_id,
+                            OLD.reviewer_id, -1);
+                        IF NOT EXISTS (SELECT 1 FROM review
+                                WHERE treenode_id = OLD.treenode_id
+                                  AND skeleton_id = OLD.skeleton_id
+                                  AND id <> OLD.id) THEN
+                            PERFORM update_skeleton_summary(OLD.skeleton_id,
+                                OLD.project_id, 0, 0, -1, 0, 0, NULL);
+                        END IF;
+                    END IF;
+
+                    IF TG_OP <> 'DELETE' THEN
+                        PERFORM update_review_summary(NEW.skeleton_id,
+                            NEW.reviewer_id, 1);
+                        IF NOT EXISTS (SELECT 1 FROM review
+                                WHERE treenode_id = NEW.treenode_id
+                                  AND skeleton_id = NEW.skeleton_id
+                                  AND id <> NEW.id) THEN
+                            PERFORM update_skeleton_summary(NEW.skeleton_id,
+                                NEW.project_id, 0, 0, 1, 0, 0, NULL);
+                        END IF;
+                        RETURN NEW;
+                    END IF;
+                    RETURN OLD;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Updates the number of pre- and postsynaptic links of
+             * skeletons.
+             */
+            CREATE FUNCTION on_change_treenode_connector_update_summary()
+                RETURNS trigger AS
+            $$
+                DECLARE
+                    _relation_name text;
+                BEGIN
+                    IF TG_OP = 'UPDATE' THEN
+                        IF NEW.skeleton_id = OLD.skeleton_id
+                                AND NEW.relation_id = OLD.relation_id THEN
+                            RETURN NEW;
+                        END IF;
+                    END IF;
+
+                    IF TG_OP <> 'INSERT' THEN
+                        SELECT relation_name INTO _relation_name
+                        FROM relation WHERE id = OLD.relation_id;
+                        IF _relation_name = 'presynaptic_to' THEN
+                            PERFORM update_skeleton_summary(OLD.skeleton_id,
+                                OLD.project_id, 0, 0, 0, -1, 0, now());
+                        ELSIF _relation_name = 'postsynaptic_to' THEN
+                            PERFORM update_skeleton_summary(OLD.skeleton_id,
+                                OLD.project_id, 0, 0, 0, 0, -1, now());
+                        END IF;
+                    END IF;
+
+                    IF TG_OP <> 'DELETE' THEN
+                        SELECT relation_name INTO _relation_name
+                        FROM relation WHERE id = NEW.relation_id;
+                        IF _relation_name = 'presynaptic_to' THEN
+                            PERFORM update_skeleton_summary(NEW.skeleton_id,
+                                NEW.project_id, 0, 0, 0, 1, 0, now());
+                        ELSIF _relation_name = 'postsynaptic_to' THEN
+                            PERFORM update_skeleton_summary(NEW.skeleton_id,
+                                NEW.project_id, 0, 0, 0, 0, 1, now());
+                        END IF;
+                        RETURN NEW;
+                    END IF;
+                    RETURN OLD;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Statements that change many treenodes at once, like splitting,
+             * joining or rerooting skeletons, would update the same summaries
+             * once for every row. Instead, they run between
+             * begin_bulk_update() and end_bulk_update(), which get the IDs of
+             * all treenodes and connectors the statements change. The
+             * triggers below don't run in between. begin_bulk_update() locks
+             * the passed in rows and records what the nodes, their edges and
+             * the edges of their children, their reviews and connector links
+             * contribute to the summaries. end_bulk_update() records the
+             * contributions again and applies the differences with one update
+             * per summary. The temporary tables of a bulk update are dropped
+             * at its end or, if it fails, with its transaction.
+             *
+             * Bulk updates set the transaction local setting
+             * catmaid.bulk_update, which the triggers check for every row.
+             * It is only defined once a transaction of the session began a
+             * bulk update.
+             */
+            CREATE FUNCTION in_bulk_update() RETURNS boolean AS
+            $$
+                BEGIN
+                    RETURN current_setting('catmaid.bulk_update') = 'on';
+                EXCEPTION WHEN undefined_object THEN
+                    RETURN false;
+                END;
+            $$ LANGUAGE plpgsql STABLE;
+
+            CREATE FUNCTION record_bulk_summary_changes(_sign integer)
+                RETURNS void AS
+            $$
+                BEGIN
+                    IF _sign < 0 THEN
+                        CREATE TEMPORARY TABLE bulk_skeleton_summary (
+                            skeleton_id integer,
+                            project_id integer,
+                            num_nodes integer,
+                            cable_length double precision,
+                            num_reviewed integer,
+                            num_presynaptic integer,
+                            num_postsynaptic integer
+                        ) ON COMMIT DROP;
+                        CREATE TEMPORARY TABLE bulk_review_summary (
+                            skeleton_id integer,
+                            reviewer_id integer,
+                            num_reviewed integer
+                        ) ON COMMIT DROP;
+                    END IF;
+
+                    INSERT INTO bulk_skeleton_summary
+                    SELECT t.skeleton_id, t.project_id, _sign, 0, 0, 0, 0
+                    FROM treenode t, bulk_treenode b
+                    WHERE t.id = b.id;
+
+                    INSERT INTO bulk_skeleton_summary
+                    SELECT t.skeleton_id, t.project_id, 0,
+                           _sign * sqrt((t.location_x - p.location_x)^2 +
+                                        (t.location_y - p.location_y)^2 +
+                                        (t.location_z - p.location_z)^2),
+                           0, 0, 0
+                    FROM (SELECT id FROM bulk_treenode
+                          UNION
+                          SELECT c.id FROM treenode c, bulk_treenode b
+                          WHERE c.parent_id = b.id) e,
+                         treenode t, treenode p
+                    WHERE t.id = e.id AND p.id = t.parent_id;
+
+                    INSERT INTO bulk_skeleton_summary
+                    SELECT r.skeleton_id, min(r.project_id), 0, 0,
+                           _sign * count(DISTINCT r.treenode_id), 0, 0
+                    FROM review r, bulk_treenode b
+                    WHERE r.treenode_id = b.id
+                    GROUP BY r.skeleton_id;
+
+                    INSERT INTO bulk_skeleton_summary
+                    SELECT tc.skeleton_id, tc.project_id, 0, 0, 0,
+                           CASE WHEN r.relation_name = 'presynaptic_to'
+                                THEN _sign ELSE 0 END,
+                           CASE WHEN r.relation_name = 'postsynaptic_to'
+                                THEN _sign ELSE 0 END
+                    FROM treenode_connector tc, bulk_treenode b, relation r
+                    WHERE tc.treenode_id = b.id AND tc.relation_id = r.id;
+
+                    INSERT INTO bulk_review_summary
+                    SELECT r.skeleton_id, r.reviewer_id, _sign * count(*)
+                    FROM review r, bulk_treenode b
+                    WHERE r.treenode_id = b.id
+                    GROUP BY r.skeleton_id, r.reviewer_id;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Every skeleton that had or has one of the changed nodes gets
+             * updated, even if its counts didn't change.
+             */
+            CREATE FUNCTION apply_bulk_summary_changes() RETURNS void AS
+            $$
+                DECLARE
+                    change record;
+                BEGIN
+                    FOR change IN
+                        SELECT skeleton_id, min(project_id) AS project_id,
+                               sum(num_nodes)::integer AS num_nodes,
+                               sum(cable_length) AS cable_length,
+                               sum(num_reviewed)::integer AS num_reviewed,
+                               sum(num_presynaptic)::integer AS num_presynaptic,
+                               sum(num_postsynaptic)::integer AS num_postsynaptic
+                        FROM bulk_skeleton_summary
+                        GROUP BY skeleton_id
+                        ORDER BY skeleton_id
+                    LOOP
+                        PERFORM update_skeleton_summary(change.skeleton_id,
+                            change.project_id, change.num_nodes,
+                            change.cable_length, change.num_reviewed,
+                            change.num_presynaptic, change.num_postsynaptic,
+                            now());
+                    END LOOP;
+
+                    FOR change IN
+                        SELECT skeleton_id, reviewer_id,
+                               sum(num_reviewed)::integer AS num_reviewed
+                        FROM bulk_review_summary
+                        GROUP BY skeleton_id, reviewer_id
+                        HAVING sum(num_reviewed) <> 0
+                        ORDER BY skeleton_id, reviewer_id
+                    LOOP
+                        PERFORM update_review_summary(change.skeleton_id,
+                            change.reviewer_id, change.num_reviewed);
+                    END LOOP;
+
+                    DROP TABLE bulk_skeleton_summary, bulk_review_summary;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE FUNCTION begin_bulk_update(_treenode_ids bigint[],
+                    _connector_ids bigint[])
+                RETURNS void AS
+            $$
+                BEGIN
+                    CREATE TEMPORARY TABLE bulk_treenode ON COMMIT DROP AS
+                        SELECT DISTINCT unnest(_treenode_ids) AS id;
+                    CREATE TEMPORARY TABLE bulk_connector ON COMMIT DROP AS
+                        SELECT DISTINCT unnest(_connector_ids) AS id;
+                    ALTER TABLE bulk_treenode ADD PRIMARY KEY (id);
+                    ALTER TABLE bulk_connector ADD PRIMARY KEY (id);
+                    ANALYZE bulk_treenode;
+                    ANALYZE bulk_connector;
+
+                    PERFORM 1 FROM treenode t, bulk_treenode b
+                    WHERE t.id = b.id FOR UPDATE OF t;
+                    PERFORM 1 FROM connector c, bulk_connector b
+                    WHERE c.id = b.id FOR UPDATE OF c;
+                    PERFORM 1 FROM treenode_connector tc, bulk_treenode b
+                    WHERE tc.treenode_id = b.id FOR UPDATE OF tc;
+                    PERFORM 1 FROM review r, bulk_treenode b
+                    WHERE r.treenode_id = b.id FOR UPDATE OF r;
+
+                    PERFORM record_bulk_changes(-1);
+                    PERFORM set_config('catmaid.bulk_update', 'on', true);
+                END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE FUNCTION end_bulk_update() RETURNS void AS
+            $$
+                BEGIN
+                    PERFORM record_bulk_changes(1);
+                    PERFORM apply_bulk_changes();
+                    DROP TABLE bulk_treenode, bulk_connector;
+                    PERFORM set_config('catmaid.bulk_update', 'off', true);
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Records and applies the changes of all tables that are kept
+             * up to date by bulk updates.
+             */
+            CREATE FUNCTION record_bulk_changes(_sign integer)
+                RETURNS void AS
+            $$
+                BEGIN
+                    PERFORM record_bulk_summary_changes(_sign);
+                END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE FUNCTION apply_bulk_changes() RETURNS void AS
+            $$
+                BEGIN
+                    PERFORM apply_bulk_summary_changes();
+                END;
+            $$ LANGUAGE plpgsql;
+
+            /* Recreates all skeleton summaries from scratch.
+             */
+            CREATE FUNCTION rebuild_skeleton_summary() RETURNS void AS
+            $$
+                BEGIN
+                    DELETE FROM skeleton_summary;
+                    DELETE FROM review_summary;
+
+                    INSERT INTO skeleton_summary (skeleton_id, project_id,
+                        num_nodes, last_edition_time)
+                    SELECT skeleton_id, project_id, count(*), max(edition_time)
+                    FROM treenode
+                    GROUP BY skeleton_id, project_id;
+
+                    UPDATE skeleton_summary s SET cable_length = e.length
+                    FROM (SELECT t.skeleton_id,
+                                 sum(sqrt((t.location_x - p.location_x)^2 +
+                                          (t.location_y - p.location_y)^2 +
+                                          (t.location_z - p.location_z)^2)) AS length
+                          FROM treenode t, treenode p
+                          WHERE t.parent_id = p.id
+                          GROUP BY t.skeleton_id) e
+                    WHERE s.skeleton_id = e.skeleton_id;
+
+                    UPDATE skeleton_summary s SET num_reviewed = r.num_reviewed
+                    FROM (SELECT skeleton_id,
+                                 count(DISTINCT treenode_id) AS num_reviewed
+                          FROM review
+                          GROUP BY skeleton_id) r
+                    WHERE s.skeleton_id = r.skeleton_id;
+
+                    UPDATE skeleton_summary s SET
+                        num_presynaptic = l.num_presynaptic,
+                        num_postsynaptic = l.num_postsynaptic
+                    FROM (SELECT tc.skeleton_id,
+                                 sum(CASE WHEN r.relation_name = 'presynaptic_to'
+                                     THEN 1 ELSE 0 END) AS num_presynaptic,
+                                 sum(CASE WHEN r.relation_name = 'postsynaptic_to'
+                                     THEN 1 ELSE 0 END) AS num_postsynaptic
+                          FROM treenode_connector tc, relation r
+                          WHERE tc.relation_id = r.id
+                          GROUP BY tc.skeleton_id) l
+                    WHERE s.skeleton_id = l.skeleton_id;
+
+                    INSERT INTO review_summary (skeleton_id, reviewer_id,
+                        num_reviewed)
+                    SELECT skeleton_id, reviewer_id, count(*)
+                    FROM review
+                    GROUP BY skeleton_id, reviewer_id;
+                END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER treenode_summary_update
+                BEFORE INSERT OR UPDATE OR DELETE ON treenode
+                FOR EACH ROW WHEN (NOT in_bulk_update())
+                EXECUTE PROCEDURE on_change_treenode_update_summary();
+            CREATE TRIGGER review_summary_update
+                BEFORE INSERT OR UPDATE OR DELETE ON review
+                FOR EACH ROW WHEN (NOT in_bulk_update())
+                EXECUTE PROCEDURE on_change_review_update_summary();
+            CREATE TRIGGER treenode_connector_summary_update
+                BEFORE INSERT OR UPDATE OR DELETE ON treenode_connector
+                FOR EACH ROW WHEN (NOT in_bulk_update())
+                EXECUTE PROCEDURE on_change_treenode_connector_update_summary();
+
+            SELECT rebuild_skeleton_summary();
+        ''')
+
+    def backwards(self, orm):
+        db.execute('''
+            DROP TRIGGER treenode_summary_update ON treenode;
+            DROP TRIGGER review_summary_update ON review;
+            DROP TRIGGER treenode_connector_summary_update ON treenode_connector;
+            DROP FUNCTION rebuild_skeleton_summary();
+            DROP FUNCTION apply_bulk_changes();
+            DROP FUNCTION record_bulk_changes(integer);
+            DROP FUNCTION end_bulk_update();
+            DROP FUNCTION begin_bulk_update(bigint[], bigint[]);
+            DROP FUNCTION apply_bulk_summary_changes();
+            DROP FUNCTION record_bulk_summary_changes(integer);
+            DROP FUNCTION on_change_treenode_update_summary();
+            DROP FUNCTION on_change_review_update_summary();
+            DROP FUNCTION on_change_treenode_connector_update_summary();
+            DROP FUNCTION update_skeleton_summary(integer, integer, integer,
+                double precision, integer, integer, integer,
+                timestamp with time zone);
+            DROP FUNCTION update_review_summary(integer, integer, integer);
+            DROP FUNCTION in_bulk_update();
+            DROP TABLE review_summary;
+            DROP TABLE skeleton_summary;
+        ''')
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'catmaid.apikey': {
+            'Meta': {'object_name': 'ApiKey'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        u'catmaid.brokenslice': {
+            'Meta': {'object_name': 'BrokenSlice', 'db_table': "'broken_slice'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'index': ('django.db.models.fields.IntegerField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"})
+        },
+        u'catmaid.cardinalityrestriction': {
+            'Meta': {'object_name': 'CardinalityRestriction', 'db_table': "'cardinality_restriction'"},
+            'cardinality_type': ('django.db.models.fields.IntegerField', [], {}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'value': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'catmaid.changerequest': {
+            'Meta': {'object_name': 'ChangeRequest', 'db_table': "'change_request'"},
+            'approve_action': ('django.db.models.fields.TextField', [], {}),
+            'completion_time': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'recipient': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'change_recipient'", 'db_column': "'recipient_id'", 'to': u"orm['auth.User']"}),
+            'reject_action': ('django.db.models.fields.TextField', [], {}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'validate_action': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.class': {
+            'Meta': {'object_name': 'Class', 'db_table': "'class'"},
+            'class_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.classclass': {
+            'Meta': {'object_name': 'ClassClass', 'db_table': "'class_class'"},
+            'class_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_a'", 'db_column': "'class_a'", 'to': u"orm['catmaid.Class']"}),
+            'class_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_b'", 'db_column': "'class_b'", 'to': u"orm['catmaid.Class']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.classinstance': {
+            'Meta': {'object_name': 'ClassInstance', 'db_table': "'class_instance'"},
+            'class_column': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Class']", 'db_column': "'class_id'"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.classinstanceclassinstance': {
+            'Meta': {'object_name': 'ClassInstanceClassInstance', 'db_table': "'class_instance_class_instance'"},
+            'class_instance_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_a'", 'db_column': "'class_instance_a'", 'to': u"orm['catmaid.ClassInstance']"}),
+            'class_instance_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_b'", 'db_column': "'class_instance_b'", 'to': u"orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.concept': {
+            'Meta': {'object_name': 'Concept', 'db_table': "'concept'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.connector': {
+            'Meta': {'object_name': 'Connector', 'db_table': "'connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'connector_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.connectorclassinstance': {
+            'Meta': {'object_name': 'ConnectorClassInstance', 'db_table': "'connector_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.dataview': {
+            'Meta': {'ordering': "('position',)", 'object_name': 'DataView', 'db_table': "'data_view'"},
+            'comment': ('django.db.models.fields.TextField', [], {'default': "''", 'null': 'True', 'blank': 'True'}),
+            'config': ('django.db.models.fields.TextField', [], {'default': "'{}'"}),
+            'data_view_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.DataViewType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'position': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.dataviewtype': {
+            'Meta': {'object_name': 'DataViewType', 'db_table': "'data_view_type'"},
+            'code_type': ('django.db.models.fields.TextField', [], {}),
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.deprecatedappliedmigrations': {
+            'Meta': {'object_name': 'DeprecatedAppliedMigrations', 'db_table': "'applied_migrations'"},
+            'id': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'})
+        },
+        u'catmaid.deprecatedsession': {
+            'Meta': {'object_name': 'DeprecatedSession', 'db_table': "'sessions'"},
+            'data': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_accessed': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'session_id': ('django.db.models.fields.CharField', [], {'max_length': '26'})
+        },
+        u'catmaid.location': {
+            'Meta': {'object_name': 'Location', 'db_table': "'location'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'location_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.log': {
+            'Meta': {'object_name': 'Log', 'db_table': "'log'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'freetext': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'operation_type': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.message': {
+            'Meta': {'object_name': 'Message', 'db_table': "'message'"},
+            'action': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'read': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'New message'", 'null': 'True', 'blank': 'True'}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.overlay': {
+            'Meta': {'object_name': 'Overlay', 'db_table': "'overlay'"},
+            'default_opacity': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'file_extension': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.project': {
+            'Meta': {'object_name': 'Project', 'db_table': "'project'"},
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stacks': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['catmaid.Stack']", 'through': u"orm['catmaid.ProjectStack']", 'symmetrical': 'False'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.projectstack': {
+            'Meta': {'object_name': 'ProjectStack', 'db_table': "'project_stack'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'orientation': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"}),
+            'translation': ('catmaid.fields.Double3DField', [], {'default': '(0, 0, 0)'})
+        },
+        u'catmaid.regionofinterest': {
+            'Meta': {'object_name': 'RegionOfInterest', 'db_table': "'region_of_interest'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'roi_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            'height': ('django.db.models.fields.FloatField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'rotation_cw': ('django.db.models.fields.FloatField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'width': ('django.db.models.fields.FloatField', [], {}),
+            'zoom_level': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'catmaid.regionofinterestclassinstance': {
+            'Meta': {'object_name': 'RegionOfInterestClassInstance', 'db_table': "'region_of_interest_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'region_of_interest': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.RegionOfInterest']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.relation': {
+            'Meta': {'object_name': 'Relation', 'db_table': "'relation'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'isreciprocal': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'uri': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.relationinstance': {
+            'Meta': {'object_name': 'RelationInstance', 'db_table': "'relation_instance'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.restriction': {
+            'Meta': {'object_name': 'Restriction', 'db_table': "'restriction'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.review': {
+            'Meta': {'object_name': 'Review', 'db_table': "'review'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'reviewer': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"})
+        },
+        u'catmaid.settings': {
+            'Meta': {'object_name': 'Settings', 'db_table': "'settings'"},
+            'key': ('django.db.models.fields.TextField', [], {'primary_key': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'null': 'True'})
+        },
+        u'catmaid.stack': {
+            'Meta': {'object_name': 'Stack', 'db_table': "'stack'"},
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'dimension': ('catmaid.fields.Integer3DField', [], {}),
+            'file_extension': ('django.db.models.fields.TextField', [], {'default': "'jpg'", 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'metadata': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'num_zoom_levels': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'resolution': ('catmaid.fields.Double3DField', [], {}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'trakem2_project': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        u'catmaid.textlabel': {
+            'Meta': {'object_name': 'Textlabel', 'db_table': "'textlabel'"},
+            'colour': ('catmaid.fields.RGBAField', [], {'default': '(1, 0.5, 0, 1)'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'font_name': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'font_size': ('django.db.models.fields.FloatField', [], {'default': '32'}),
+            'font_style': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'scaling': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'Edit this text ...'"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'})
+        },
+        u'catmaid.textlabellocation': {
+            'Meta': {'object_name': 'TextlabelLocation', 'db_table': "'textlabel_location'"},
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'textlabel': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Textlabel']"})
+        },
+        u'catmaid.treenode': {
+            'Meta': {'object_name': 'Treenode', 'db_table': "'treenode'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'treenode_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'children'", 'null': 'True', 'to': u"orm['catmaid.Treenode']"}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'radius': ('django.db.models.fields.FloatField', [], {}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.treenodeclassinstance': {
+            'Meta': {'object_name': 'TreenodeClassInstance', 'db_table': "'treenode_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.treenodeconnector': {
+            'Meta': {'object_name': 'TreenodeConnector', 'db_table': "'treenode_connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'color': ('catmaid.fields.RGBAField', [], {'default': '(0.37377097471048537, 1.0, 0.7682593521111639, 1)'}),
+            'display_stack_reference_lines': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'independent_ontology_workspace_is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'inverse_mouse_wheel': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_cropping_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_ontology_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_segmentation_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tagging_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_text_label_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tracing_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'tracing_overlay_scale': ('django.db.models.fields.FloatField', [], {'default': '1'}),
+            'tracing_overlay_screen_scaling': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['auth.User']", 'unique': 'True'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['catmaid']
\ No newline at end of file
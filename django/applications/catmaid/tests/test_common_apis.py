@@ -1,24 +1,43 @@
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Permission, Group
 from django.conf import settings
 from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 from django.http import HttpResponse
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404
-from guardian.shortcuts import assign_perm
+from guardian.shortcuts import assign_perm, remove_perm
 import os
 import re
+import shutil
+import tempfile
 import urllib
 import json
+import struct
+import tarfile
 import datetime
+import multiprocessing
+import billiard
+import numpy
+import networkx
+from cStringIO import StringIO
+from contextlib import closing
 
 from catmaid.models import Project, Stack, ProjectStack
 from catmaid.models import ClassInstance, Log, Message, TextlabelLocation
 from catmaid.models import Treenode, Connector, TreenodeConnector, User
 from catmaid.models import Textlabel, TreenodeClassInstance, ClassInstanceClassInstance
+from catmaid.models import Review, Relation, Class
 from catmaid.fields import Double3D, Integer3D
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
-from catmaid.control.neuron_annotations import _annotate_entities
+from catmaid.control.neuron_annotations import _annotate_entities, \
+        get_sub_annotation_ids
+from catmaid.control.tree_util import lazy_load_trees, ArrayTree
+from catmaid.control.synapseclustering import tree_max_density
+from catmaid.control.user_evaluation import _evaluate
+from catmaid.control.skeletonexport import _measure_skeletons
+from catmaid.control.activity import get_activity_counts
+from catmaid.control.authentication import user_domain, user_can_edit
 
 
 class TransactionTests(TransactionTestCase):
@@ -291,6 +310,120 @@ class ViewPageTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.compare_swc_data(response.content, swc_output_for_skeleton_235)
 
+    def test_export_skeletons_archive(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/export/swc' % (self.test_project_id,)
+        response = self.client.post(url, {'skeleton_ids[]': [235, 373]})
+        self.assertEqual(response.status_code, 200)
+        archive = tarfile.open(fileobj=StringIO(
+                ''.join(response.streaming_content)), mode='r:gz')
+        self.assertEqual(['235.swc', '373.swc'], archive.getnames())
+        self.compare_swc_data(archive.extractfile('235.swc').read(),
+                swc_output_for_skeleton_235)
+        self.assertEqual(5,
+                len(archive.extractfile('373.swc').read().splitlines()))
+
+        # Skeletons can also be selected by the annotations of their neurons
+        annotations = _annotate_entities(self.test_project_id, [233],
+                {'export': self.test_user_id})
+        url = '/%d/skeletons/export/json' % (self.test_project_id,)
+        response = self.client.post(url, {
+            'neuron_query_by_annotation': annotations.keys()[0].id})
+        self.assertEqual(response.status_code, 200)
+        archive = tarfile.open(fileobj=StringIO(
+                ''.join(response.streaming_content)), mode='r:gz')
+        self.assertEqual(['235.json'], archive.getnames())
+        skeleton = json.loads(archive.extractfile('235.json').read())
+        self.assertEqual(235, skeleton['id'])
+        self.assertEqual(28, len(skeleton['nodes']))
+        self.assertEqual(sorted(Treenode.objects.filter(skeleton_id=235)
+                .values_list('id', flat=True)),
+                sorted(node[0] for node in skeleton['nodes']))
+
+    def test_annotation_hierarchy(self):
+        self.fake_authentication()
+        def annotate(entity_id, name):
+            annotations = _annotate_entities(self.test_project_id,
+                    [entity_id], {name: self.test_user_id})
+            return annotations.keys()[0].id
+
+        # Neuron 233 is annotated with A, A with B and B with C
+        a = annotate(233, 'A')
+        b = annotate(a, 'B')
+        c = annotate(b, 'C')
+        sub_annotations = get_sub_annotation_ids(self.test_project_id, [b, c])
+        self.assertEqual([a], sub_annotations[b])
+        self.assertEqual(sorted([a, b]), sorted(sub_annotations[c]))
+
+        response = self.client.post(
+                '/%d/neuron/query-by-annotations' % self.test_project_id, {
+                    'neuron_query_by_annotation': c,
+                    'neuron_query_include_subannotation': c})
+        self.assertEqual(response.status_code, 200)
+        # Annotations are annotated entities as well
+        entities = json.loads(response.content)['entities']
+        self.assertEqual(sorted([233, a, b]), sorted(e['id'] for e in entities))
+
+        # Without sub-annotations, only directly annotated entities are found.
+        # Several annotations have to be present all.
+        for query, expected in (
+                ({'neuron_query_by_annotation': c}, [b]),
+                ({'neuron_query_by_annotation[0]': c,
+                  'neuron_query_include_subannotation[0]': c,
+                  'neuron_query_by_annotation[1]': a}, [233]),
+                ({'neuron_query_by_annotation': a,
+                  'neuron_query_by_annotator': self.test_user_id + 1}, [])):
+            response = self.client.post(
+                    '/%d/neuron/query-by-annotations' % self.test_project_id,
+                    query)
+            self.assertEqual(response.status_code, 200)
+            entities = json.loads(response.content)['entities']
+            self.assertEqual(expected, [e['id'] for e in entities])
+
+        # Removing a link removes the indirect ones through it, too
+        ClassInstanceClassInstance.objects.filter(class_instance_a=a,
+                class_instance_b=b).delete()
+        sub_annotations = get_sub_annotation_ids(self.test_project_id, [b, c])
+        self.assertEqual([], sub_annotations[b])
+        self.assertEqual([b], sub_annotations[c])
+
+    def test_hdf5_tiles(self):
+        import h5py
+        hdf5_path = tempfile.mkdtemp()
+        try:
+            data = (numpy.arange(300 * 400) % 251).astype(numpy.uint8) \
+                    .reshape((300, 400))
+            with closing(h5py.File(os.path.join(hdf5_path,
+                    '%d_1_raw.hdf' % self.test_project_id), 'w')) as hfile:
+                hfile.create_dataset('/0/0/data', data=data, chunks=(128, 128))
+
+            with self.settings(HDF5_STORAGE_PATH=hdf5_path):
+                url = '/%d/stack/1/tile' % self.test_project_id
+                params = {'x': 250, 'y': 200, 'width': 200, 'height': 200,
+                          'scale': 0, 'z': 0, 'format': 'raw'}
+                # Parts outside of the data are empty, tiles are cached
+                expected = numpy.zeros((200, 200), dtype=numpy.uint8)
+                expected[:100, :150] = data[200:, 250:]
+                for i in range(2):
+                    response = self.client.get(url, params)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(expected.tostring(), response.content)
+
+                params['format'] = 'png'
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual('image/png', response['Content-Type'])
+
+                params['format'] = 'raw'
+                params['scale'] = 1
+                response = self.client.get(url, params)
+                self.assertEqual('\0' * 200 * 200, response.content)
+                params['basename'] = 'missing'
+                response = self.client.get(url, params)
+                self.assertEqual('\0' * 200 * 200, response.content)
+        finally:
+            shutil.rmtree(hdf5_path)
+
     def test_labels(self):
         self.fake_authentication()
         response = self.client.get('/%d/labels-all' % (self.test_project_id,))
@@ -551,6 +684,123 @@ class ViewPageTests(TestCase):
         parsed_response = json.loads(response.content)
         self.assertEqual(expected_result, parsed_response)
 
+    def test_activity_counts(self):
+        self.fake_authentication()
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 5,
+            'y': 10,
+            'z': 15,
+            'confidence': 5,
+            'parent_id': -1,
+            'radius': 2})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/%d/stats/summary' % (self.test_project_id,))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(1, json.loads(response.content)['treenodes_created'])
+
+        # Counts of time ranges that don't start or end at a full half hour
+        # match the raw data.
+        cursor = connection.cursor()
+        start_date = datetime.datetime(2011, 9, 27, 7, 57, 30)
+        end_date = datetime.datetime(2011, 12, 20, 10, 46, 1, 360000)
+        for activity, column in (('treenode_created', 'creation_time'),
+                                 ('treenode_edited', 'edition_time')):
+            cursor.execute('''
+                SELECT user_id, date_trunc('day', %s) AS day, count(*)
+                FROM treenode
+                WHERE project_id = %%s AND %s BETWEEN %%s AND %%s
+                GROUP BY user_id, day ORDER BY user_id, day
+                ''' % (column, column),
+                (self.test_project_id, start_date, end_date))
+            expected = cursor.fetchall()
+            self.assertTrue(expected)
+            counts = get_activity_counts(activity, group_by=('creator_id',),
+                    project_id=self.test_project_id, start_date=start_date,
+                    end_date=end_date, interval='day')
+            self.assertEqual(expected, counts)
+
+    def test_permission_cache(self):
+        self.fake_authentication()
+        url = '/%d/stats/nodecount' % self.test_project_id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse('permission_error' in json.loads(response.content))
+
+        # Removed permissions take effect immediately
+        user = User.objects.get(pk=self.test_user_id)
+        p = Project.objects.get(pk=self.test_project_id)
+        remove_perm('can_browse', user, p)
+        remove_perm('can_annotate', user, p)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)['permission_error'])
+
+        # So do changed group memberships
+        cursor = connection.cursor()
+        self.assertEqual(set([2, 3]), user_domain(cursor, 3))
+        self.assertTrue(user_can_edit(cursor, 3, 2))
+        user.groups.remove(Group.objects.get(name='test1'))
+        self.assertEqual(set([3]), user_domain(cursor, 3))
+        self.assertFalse(user_can_edit(cursor, 3, 2))
+
+        # Logins don't clear the cache, other changes to users do
+        cursor.execute('''
+            INSERT INTO auth_user_groups (user_id, group_id)
+            SELECT 3, id FROM auth_group WHERE name = 'test1'
+        ''')
+        user = User.objects.get(pk=3)
+        user.save(update_fields=['last_login'])
+        self.assertEqual(set([3]), user_domain(cursor, 3))
+        user.save()
+        self.assertEqual(set([2, 3]), user_domain(cursor, 3))
+
+    def test_relation_and_class_ids(self):
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.assertEqual(23, relations['presynaptic_to'])
+        self.assertEqual(24, relations['postsynaptic_to'])
+        self.assertFalse('test_relation' in relations)
+        classes = get_class_to_id_map(self.test_project_id)
+        self.assertFalse('test_class' in classes)
+
+        # Changes are visible right away, returned maps are copies
+        relations['test_relation'] = 1
+        self.assertFalse('test_relation' in
+                get_relation_to_id_map(self.test_project_id))
+        relation = Relation.objects.create(user_id=self.test_user_id,
+                project_id=self.test_project_id, relation_name='test_relation')
+        c = Class.objects.create(user_id=self.test_user_id,
+                project_id=self.test_project_id, class_name='test_class')
+        self.assertEqual(relation.id,
+                get_relation_to_id_map(self.test_project_id)['test_relation'])
+        self.assertEqual(c.id,
+                get_class_to_id_map(self.test_project_id)['test_class'])
+        relation.delete()
+        self.assertFalse('test_relation' in
+                get_relation_to_id_map(self.test_project_id))
+
+        # Names created by other processes, i.e. without clearing the cache
+        # of this one, are found by looking them up once more.
+        def create_relation(project_id, name):
+            cursor = connection.cursor()
+            cursor.execute('''
+                INSERT INTO relation (user_id, project_id, relation_name)
+                VALUES (%s, %s, %s) RETURNING id
+            ''', (self.test_user_id, project_id, name))
+            return cursor.fetchone()[0]
+        relation_id = create_relation(self.test_project_id, 'other_relation')
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.assertFalse('other_relation' in relations)
+        self.assertEqual(relation_id, relations['other_relation'])
+        self.assertRaises(KeyError, lambda: relations['missing_relation'])
+
+        # Projects without relations aren't cached
+        project = Project.objects.create(title='Empty project')
+        self.assertEqual({}, get_relation_to_id_map(project.id))
+        relation_id = create_relation(project.id, 'test_relation')
+        self.assertEqual({'test_relation': relation_id},
+                get_relation_to_id_map(project.id))
+
     def test_multiple_treenodes(self):
         pass
         # self.fake_authentication()
@@ -875,6 +1125,18 @@ class ViewPageTests(TestCase):
         self.assertEqual(z, treenode.location_z)
         self.assertEqual(parsed_response['skeleton_id'], treenode.skeleton_id)
         self.assertEqual(get_object_or_404(Treenode, id=parent_id).skeleton_id, treenode.skeleton_id)
+
+        # The nodes in between are created as a chain, one per section
+        treenode_ids = parsed_response['treenode_ids']
+        self.assertEqual(4, len(treenode_ids))
+        self.assertEqual(treenode.id, treenode_ids[-1])
+        self.assertEqual(4 + treenode_count, count_treenodes())
+        parent = parent_id
+        for n, treenode_id in enumerate(treenode_ids):
+            treenode = Treenode.objects.get(id=treenode_id)
+            self.assertEqual(parent, treenode.parent_id)
+            self.assertEqual(9 * (n + 1), treenode.location_z)
+            parent = treenode_id
         # Ensure nodes in-between have been created
         self.assertEqual(4 + treenode_count, count_treenodes())
         # Ensure the returned treenode has the latest edition time
@@ -1823,6 +2085,52 @@ class ViewPageTests(TestCase):
                 {"id":233, "name":"branched neuron", "class_name":"neuron"}]
         self.assertEqual(expected_result, parsed_response)
 
+    def test_search_invalid_limit(self):
+        self.fake_authentication()
+
+        def search(limit):
+            response = self.client.get('/%d/search' % self.test_project_id,
+                    {'substring': 'e', 'limit': limit})
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        # Invalid limits fall back to the default, others are clamped
+        all_results = search(500)
+        self.assertTrue(len(all_results) > 1)
+        self.assertEqual(all_results, search('abc'))
+        self.assertEqual(all_results, search(10 ** 20))
+        self.assertEqual(1, len(search(0)))
+        self.assertEqual(1, len(search(-5)))
+
+    def test_search_ranked_and_limited(self):
+        self.fake_authentication()
+
+        # The best matches are returned: exact ones, then prefix matches
+        response = self.client.get(
+                '/%d/search' % self.test_project_id,
+                {'substring': 't', 'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        expected_result = [
+                {"id":465, "name":"tubby bye bye", "class_name":"driver_line"},
+                {"id":2345, "name":"t", "class_name":"label"},
+                {"id":351, "name":"TODO", "class_name":"label", "nodes":[
+                    {"id":349, "x":3580, "y":3350, "z":252, "skid":1},
+                    {"id":261, "x":2820, "y":1345, "z":0, "skid":235}]}]
+        self.assertEqual(expected_result, parsed_response)
+
+        response = self.client.get(
+                '/%d/search' % self.test_project_id,
+                {'substring': 'SKELETON 23', 'match': 'prefix',
+                 'class_names[]': ['skeleton', 'neuron']})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        expected_result = [
+                {"id":235, "name":"skeleton 235", "class_name":"skeleton"},
+                {"id":2364, "name":"skeleton 2364", "class_name":"skeleton"},
+                {"id":2388, "name":"skeleton 2388", "class_name":"skeleton"}]
+        self.assertEqual(expected_result, parsed_response)
+
     def test_delete_link_success(self):
         self.fake_authentication()
         connector_id = 356
@@ -1843,6 +2151,9 @@ class ViewPageTests(TestCase):
         self.fake_authentication()
 
         new_root = 407
+        # Confidences of the edges 407-405 and 405-377, which are reversed
+        Treenode.objects.filter(id=407).update(confidence=2)
+        Treenode.objects.filter(id=405).update(confidence=3)
 
         count_logs = lambda: Log.objects.all().count()
         log_count = count_logs()
@@ -1863,6 +2174,12 @@ class ViewPageTests(TestCase):
         assertHasParent(405, 407)
         assertHasParent(377, 405)
         assertHasParent(407, None)
+        assertHasParent(403, 377)
+        assertHasParent(409, 407)
+
+        confidences = dict(Treenode.objects.filter(
+                id__in=(377, 403, 405, 407)).values_list('id', 'confidence'))
+        self.assertEqual({377: 3, 403: 5, 405: 2, 407: 5}, confidences)
 
     def test_reroot_and_join_skeletons(self):
         self.fake_authentication()
@@ -1912,6 +2229,442 @@ class ViewPageTests(TestCase):
 
         self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=2405).skeleton_id)
 
+    def assertSummariesUpToDate(self):
+        """ Compares the skeleton and review summaries, the synapse edges and
+        the activity counts with the ones rebuilt from scratch.
+        """
+        cursor = connection.cursor()
+
+        def get_summaries():
+            cursor.execute('''
+                SELECT skeleton_id, num_nodes, cable_length, num_reviewed,
+                       num_presynaptic, num_postsynaptic
+                FROM skeleton_summary ORDER BY skeleton_id''')
+            skeletons = cursor.fetchall()
+            cursor.execute('''
+                SELECT skeleton_id, reviewer_id, num_reviewed
+                FROM review_summary ORDER BY skeleton_id, reviewer_id''')
+            reviews = cursor.fetchall()
+            cursor.execute('''
+                SELECT pre_skeleton_id, post_skeleton_id, num_synapses
+                FROM synapse_edge ORDER BY pre_skeleton_id, post_skeleton_id''')
+            edges = cursor.fetchall()
+            cursor.execute('''
+                SELECT project_id, activity, user_id, creator_id, bucket, count
+                FROM activity_rollup
+                ORDER BY project_id, activity, user_id, creator_id, bucket''')
+            return skeletons, reviews, edges, cursor.fetchall()
+
+        skeletons, reviews, edges, activity = get_summaries()
+        cursor.execute('SELECT rebuild_skeleton_summary()')
+        cursor.execute('SELECT rebuild_synapse_edges()')
+        cursor.execute('SELECT rebuild_activity_rollup()')
+        expected_skeletons, expected_reviews, expected_edges, \
+                expected_activity = get_summaries()
+
+        self.assertEqual(expected_reviews, reviews)
+        self.assertEqual(expected_edges, edges)
+        self.assertEqual(expected_activity, activity)
+        self.assertEqual(len(expected_skeletons), len(skeletons))
+        for expected, summary in zip(expected_skeletons, skeletons):
+            self.assertEqual(expected[:2], summary[:2])
+            self.assertAlmostEqual(expected[2], summary[2], places=3)
+            self.assertEqual(expected[3:], summary[3:])
+
+    def test_skeleton_summary(self):
+        self.fake_authentication()
+
+        # Change skeletons by rerooting, joining, adding a node, removing
+        # a connector link and moving several nodes at once.
+        response = self.client.post(
+                '/%d/skeleton/reroot' % self.test_project_id,
+                {'treenode_id': 2394})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+                '/%d/skeleton/join' % self.test_project_id, {
+                    'from_id': 2415,
+                    'to_id': 2394,
+                    'annotation_set': '{}'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 5,
+            'y': 10,
+            'z': 15,
+            'confidence': 5,
+            'parent_id': 2394,
+            'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/%d/link/delete' % self.test_project_id, {
+            'connector_id': 356,
+            'treenode_id': 377})
+        self.assertEqual(response.status_code, 200)
+        # Nodes are moved by the triggers of each row and as bulk update
+        for bulk_min_nodes, x in ((200, 100), (2, 700)):
+            with self.settings(NODE_UPDATE_BULK_MIN_NODES=bulk_min_nodes):
+                response = self.client.post('/%d/node/update' % self.test_project_id, {
+                    't[0][0]': 2394, 't[0][1]': x, 't[0][2]': 200, 't[0][3]': 0,
+                    't[1][0]': 2415, 't[1][1]': x + 200, 't[1][2]': 400, 't[1][3]': 0,
+                    'c[0][0]': 356, 'c[0][1]': x + 400, 'c[0][2]': 600, 'c[0][3]': 0})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(3, json.loads(response.content)['updated'])
+            self.assertSummariesUpToDate()
+
+    def test_tree_max_density(self):
+        # A chain of nodes 1 to 10, one unit apart, except for a gap of 20
+        # between nodes 5 and 6.
+        node_ids = range(1, 11)
+        parent_ids = [None] + node_ids[:-1]
+        locations = [(0, 0, 0)]
+        for node_id in node_ids[1:]:
+            locations.append((locations[-1][0] + (20 if 6 == node_id else 1), 0, 0))
+        tree = ArrayTree.from_parent_ids(node_ids, parent_ids, locations)
+        graph = networkx.Graph()
+        for node_id, parent_id in zip(node_ids[1:], parent_ids[1:]):
+            graph.add_edge(parent_id, node_id,
+                    weight=locations[node_id - 1][0] - locations[parent_id - 1][0])
+
+        synapse_nodes = [1, 2, 3, 7, 8, 9]
+        connector_ids = [11, 12, 13, 17, 18, 19]
+        relations = [1, 1, 2, 2, 2, 1]
+        for arbor in (tree, graph):
+            for cutoff_factor in (None, 3):
+                groups = tree_max_density(arbor, synapse_nodes, connector_ids,
+                        relations, [2, 50], cutoff_factor=cutoff_factor)
+                self.assertEqual(2, len(groups[2]))
+                self.assertEqual([1, 2, 3], groups[2][0].node_ids)
+                self.assertEqual([11, 12, 13], groups[2][0].connector_ids)
+                self.assertEqual([1, 1, 2], groups[2][0].relations)
+                self.assertEqual(2, groups[2][0].local_max)
+                self.assertEqual([7, 8, 9], groups[2][1].node_ids)
+                self.assertEqual(8, groups[2][1].local_max)
+                self.assertEqual(1, len(groups[50]))
+                self.assertEqual(synapse_nodes, groups[50][0].node_ids)
+
+    def test_lazy_load_trees(self):
+        skeleton_ids = (1, 235, 373)
+        properties = ('location_x', 'location_y', 'location_z', 'user_id')
+        expected = dict((skid, Treenode.objects.filter(skeleton_id=skid) \
+                .values_list('id', 'parent_id', 'location_x', 'user_id'))
+                for skid in skeleton_ids)
+
+        # A budget this small makes every batch a single row
+        trees = list(lazy_load_trees(skeleton_ids, properties,
+                memory_budget=1))
+        self.assertEqual(list(skeleton_ids), [skid for skid, _ in trees])
+        for skid, tree in trees:
+            nodes = expected[skid]
+            self.assertEqual(len(nodes), tree.number_of_nodes())
+            for node_id, parent_id, x, user_id in nodes:
+                self.assertEqual(x, tree.node[node_id]['location_x'])
+                self.assertEqual(user_id, tree.node[node_id]['user_id'])
+                if parent_id:
+                    self.assertEqual([parent_id], tree.successors(node_id))
+
+        trees = list(lazy_load_trees(skeleton_ids, properties,
+                as_arrays=True, memory_budget=1))
+        self.assertEqual(list(skeleton_ids), [skid for skid, _ in trees])
+        for skid, tree in trees:
+            nodes = expected[skid]
+            self.assertEqual(len(nodes), len(tree))
+            for node_id, parent_id, x, user_id in nodes:
+                i = tree.index(node_id)
+                self.assertEqual(x, tree.locations[i][0])
+                self.assertEqual(user_id, tree.properties['user_id'][i])
+                if parent_id:
+                    self.assertEqual(parent_id,
+                            tree.node_ids[tree.parents[i]])
+                else:
+                    self.assertEqual(-1, tree.parents[i])
+
+    def test_last_openleaf(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/skeleton/235/openleaf' % self.test_project_id,
+                {'tnid': 253})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([277, [6090.0, 1550.0, 0.0]],
+                json.loads(response.content))
+
+        # The only other end of skeleton 1 is tagged
+        response = self.client.post(
+                '/%d/skeleton/1/openleaf' % self.test_project_id,
+                {'tnid': 17})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([7, [3590.0, 3240.0, 0.0]],
+                json.loads(response.content))
+
+    def test_circles_of_hell_and_directed_paths(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/graph/circlesofhell' % self.test_project_id, {
+                    'skeleton_ids[0]': 235,
+                    'n_circles': 1,
+                    'min_pre': -1,
+                    'min_post': 1})
+        self.assertEqual(response.status_code, 200)
+        skeleton_ids, names = json.loads(response.content)
+        self.assertEqual([361, 373], sorted(skeleton_ids))
+
+        # Only skeleton 373 receives two synapses from 235
+        response = self.client.post(
+                '/%d/graph/circlesofhell' % self.test_project_id, {
+                    'skeleton_ids[0]': 235,
+                    'n_circles': 2,
+                    'min_pre': 1,
+                    'min_post': 2})
+        self.assertEqual(response.status_code, 200)
+        skeleton_ids, names = json.loads(response.content)
+        self.assertEqual([373], skeleton_ids)
+
+        response = self.client.post(
+                '/%d/graph/circlesofhell' % self.test_project_id, {
+                    'skeleton_ids[0]': 2364,
+                    'n_circles': 1,
+                    'min_pre': 1,
+                    'min_post': -1})
+        self.assertEqual(response.status_code, 200)
+        skeleton_ids, names = json.loads(response.content)
+        self.assertEqual([2388, 2411], sorted(skeleton_ids))
+
+        response = self.client.post(
+                '/%d/graph/directedpaths' % self.test_project_id, {
+                    'skeleton_ids[0]': 235,
+                    'skeleton_ids[1]': 361,
+                    'skeleton_ids[2]': 373,
+                    'n_circles': 1,
+                    'min_pre': 1,
+                    'min_post': 1})
+        self.assertEqual(response.status_code, 200)
+        paths = json.loads(response.content)
+        self.assertEqual([[235, 361], [235, 373]], sorted(paths))
+
+        # 2388 and 2411 are both presynaptic to 2364, there is no directed
+        # path between them.
+        response = self.client.post(
+                '/%d/graph/directedpaths' % self.test_project_id, {
+                    'skeleton_ids[0]': 2388,
+                    'skeleton_ids[1]': 2411,
+                    'n_circles': 2,
+                    'min_pre': 1,
+                    'min_post': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([], json.loads(response.content))
+
+    def test_split_graph_cache(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+
+        def get_graph():
+            response = self.client.post(
+                    '/%d/skeletongroup/skeletonlist_confidence_compartment_subgraph' % self.test_project_id, {
+                        'skeleton_list[0]': 235,
+                        'skeleton_list[1]': 361,
+                        'skeleton_list[2]': 373,
+                        'confidence_threshold': 3})
+            self.assertEqual(response.status_code, 200)
+            graph = json.loads(response.content)
+            return sorted(graph['nodes']), sorted(graph['edges'])
+
+        def get_version():
+            cursor.execute('''
+                SELECT edit_version FROM skeleton_summary
+                WHERE skeleton_id = 235''')
+            return cursor.fetchone()[0]
+
+        expected = (['235', '361', '373'],
+                    [['235', '361', 1], ['235', '373', 2]])
+        self.assertEqual(expected, get_graph())
+        # The second request is answered from the cache
+        self.assertEqual(expected, get_graph())
+
+        # Break skeleton 235 between its two presynaptic nodes 285 and 415
+        version = get_version()
+        response = self.client.post(
+                '/%d/node/289/confidence/update' % self.test_project_id,
+                {'new_confidence': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(version, get_version())
+
+        nodes, edges = get_graph()
+        self.assertEqual(['235_1', '235_2', '361', '373'], nodes)
+        self.assertEqual(3, len(edges))
+        self.assertEqual(set(['361', '373']), set(e[1] for e in edges))
+        self.assertTrue(all(1 == e[2] for e in edges))
+
+        # Edges with a confidence equal to the threshold don't break skeletons
+        cursor.execute('''
+            UPDATE treenode SET confidence = 3 WHERE skeleton_id = 235''')
+        self.assertEqual(expected, get_graph())
+
+    def test_split_skeleton(self):
+        self.fake_authentication()
+        for treenode_id in (247, 281):
+            Review.objects.create(project_id=self.test_project_id,
+                    reviewer_id=self.test_user_id, skeleton_id=235,
+                    treenode_id=treenode_id)
+
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': 279,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({}, json.loads(response.content))
+
+        new_skeleton_id = Treenode.objects.get(pk=279).skeleton_id
+        self.assertNotEqual(235, new_skeleton_id)
+        self.assertEqual(None, Treenode.objects.get(pk=279).parent_id)
+        self.assertEqual([279, 281, 283, 285, 289, 415, 417], sorted(
+                Treenode.objects.filter(skeleton_id=new_skeleton_id)
+                .values_list('id', flat=True)))
+        self.assertEqual(21, Treenode.objects.filter(skeleton_id=235).count())
+        self.assertEqual([360, 425], sorted(TreenodeConnector.objects.filter(
+                skeleton_id=new_skeleton_id).values_list('id', flat=True)))
+        self.assertEqual(235, TreenodeConnector.objects.get(pk=437).skeleton_id)
+        self.assertEqual(new_skeleton_id,
+                Review.objects.get(treenode_id=281).skeleton_id)
+        self.assertEqual(235, Review.objects.get(treenode_id=247).skeleton_id)
+
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT skeleton_id, num_nodes, num_reviewed, num_presynaptic
+            FROM skeleton_summary WHERE skeleton_id IN (%s, %s)
+            ORDER BY skeleton_id''', (235, new_skeleton_id))
+        self.assertEqual([(235, 21, 1, 1), (new_skeleton_id, 7, 1, 2)],
+                cursor.fetchall())
+
+    def test_split_large_skeleton(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+
+        def grow(parent_id, n, tag):
+            """ Adds a binary tree of <n> nodes, created and edited by
+            different users at different times, to skeleton 235 below node
+            <parent_id>. The nodes are marked with their index as X and <tag>
+            as Y coordinate. Every third node is reviewed.
+            """
+            cursor.execute('''
+                INSERT INTO treenode (project_id, user_id, editor_id,
+                    creation_time, edition_time, location_x, location_y,
+                    location_z, radius, confidence, skeleton_id, parent_id)
+                SELECT %(project_id)s, 1 + i %% 3, 1 + i %% 2,
+                       '2014-01-01'::timestamptz + i * interval '7 minutes',
+                       '2014-02-01'::timestamptz + i * interval '13 minutes',
+                       i, %(tag)s, 0, -1, 5, 235, %(parent_id)s
+                FROM generate_series(1, %(n)s) i;
+
+                UPDATE treenode c SET parent_id = p.id
+                FROM treenode p
+                WHERE c.location_y = %(tag)s AND c.location_x > 1
+                  AND p.location_y = %(tag)s
+                  AND p.location_x = floor(c.location_x / 2);
+
+                INSERT INTO review (project_id, reviewer_id, review_time,
+                    skeleton_id, treenode_id)
+                SELECT project_id, 1 + location_x::integer %% 2,
+                       edition_time + interval '1 day', skeleton_id, id
+                FROM treenode
+                WHERE location_y = %(tag)s AND location_x::integer %% 3 = 0;
+            ''', {'project_id': self.test_project_id, 'parent_id': parent_id,
+                   'n': n, 'tag': tag})
+
+        # Node 289 ends up in the new skeleton, node 247 stays
+        grow(289, 2000, -1)
+        grow(247, 1000, -2)
+
+        # Every tenth node of both parts is presynaptic to a connector that
+        # nodes of the other part and of skeleton 361 are postsynaptic to.
+        cursor.execute('''
+            INSERT INTO connector (project_id, user_id, editor_id,
+                location_x, location_y, location_z, confidence)
+            SELECT %(project_id)s, 1, 1, i, -3, 0, 5
+            FROM generate_series(10, 2000, 10) i;
+
+            INSERT INTO treenode_connector (project_id, user_id, treenode_id,
+                connector_id, relation_id, skeleton_id, confidence)
+            SELECT t.project_id, 1, t.id, c.id, r.id, t.skeleton_id, 5
+            FROM connector c, treenode t, relation r
+            WHERE c.location_y = -3
+              AND ((t.location_y = -1 AND t.location_x = c.location_x
+                    AND r.relation_name = 'presynaptic_to')
+                OR (t.location_y = -2 AND t.location_x = c.location_x / 2
+                    AND r.relation_name = 'postsynaptic_to')
+                OR (t.id = 367 AND r.relation_name = 'postsynaptic_to'))
+              AND r.project_id = t.project_id;
+        ''', {'project_id': self.test_project_id})
+
+        # Edit versions are taken from one sequence, whenever a summary
+        # changes.
+        def edit_version():
+            cursor.execute('SELECT last_value FROM skeleton_edit_version_seq')
+            return cursor.fetchone()[0]
+        version = edit_version()
+
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': 279,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({}, json.loads(response.content))
+
+        new_skeleton_id = Treenode.objects.get(pk=279).skeleton_id
+        self.assertEqual(2007,
+                Treenode.objects.filter(skeleton_id=new_skeleton_id).count())
+        self.assertEqual(1021, Treenode.objects.filter(skeleton_id=235).count())
+        cursor.execute('''
+            SELECT num_synapses FROM synapse_edge
+            WHERE pre_skeleton_id = %s AND post_skeleton_id = 235
+        ''', (new_skeleton_id,))
+        self.assertEqual([(200,)], cursor.fetchall())
+        # Both summaries were updated once, not once per moved row
+        self.assertEqual(version + 2, edit_version())
+        self.assertSummariesUpToDate()
+
+    def test_user_evaluation(self):
+        # Let user test0 review all nodes of skeleton 373, which were created
+        # by user test2.
+        for treenode in Treenode.objects.filter(skeleton_id=373):
+            Review.objects.create(project_id=self.test_project_id,
+                    reviewer_id=1, skeleton_id=373, treenode=treenode)
+
+        expected = [{'skeleton_id': 373,
+                     'reviewer_id': 1,
+                     'timepoint': '2011-09-27',
+                     'n_created_nodes': 5,
+                     'n_nodes': 5,
+                     'n_missed_nodes': 0,
+                     'n_splits': 0,
+                     'n_merges': 0,
+                     'n_pre': 0,
+                     'n_post': 2,
+                     'reviewer_n_pre': 0,
+                     'reviewer_n_post': 0,
+                     'newer_pre': 0,
+                     'newer_post': 0}]
+        # Evaluate in this process and with a pool of workers
+        for processes in (1, 2):
+            result = _evaluate(self.test_project_id, 3,
+                    datetime.datetime(2011, 1, 1), datetime.datetime(2012, 1, 1),
+                    datetime.timedelta(3), 1, processes=processes)
+            self.assertEqual(expected, result)
+
+        # Daemonic processes, like the workers of Celery, can use a pool, too
+        processes = (multiprocessing.current_process(),
+                billiard.current_process())
+        for process in processes:
+            process.daemon = True
+        try:
+            result = _evaluate(self.test_project_id, 3,
+                    datetime.datetime(2011, 1, 1), datetime.datetime(2012, 1, 1),
+                    datetime.timedelta(3), 1, processes=2)
+        finally:
+            for process in processes:
+                process.daemon = False
+        self.assertEqual(expected, result)
+
     def test_treenode_info_nonexisting_treenode_failure(self):
         self.fake_authentication()
         treenode_id = 55555
@@ -2014,6 +2767,32 @@ class ViewPageTests(TestCase):
         for mi in ('0','1','2','3'):
             self.assertEqual(expected_result[mi], parsed_response[mi])
 
+    def test_measure_skeletons(self):
+        # Raw, smooth and principal branch cable, ends, branches and nodes, as
+        # measured with networkx before the measurements used arrays. It
+        # failed on skeletons of a single node.
+        expected = {
+            1: (848.7389213307833, 468.69496418458033, 468.69496418458033, 2, 0, 29),
+            235: (11243.358872299335, 10640.24221772398, 7391.12911805557, 4, 2, 28),
+            361: (4575.388050306952, 4005.1515647423485, 2142.009799879039, 2, 0, 9),
+            373: (2345.737898012321, 2324.611483948003, 1705.8585462212545, 2, 0, 5),
+            2364: (4057.5693355151852, 2879.5780843973725, 2879.5780843973725, 2, 0, 6),
+            2388: (1513.2441332699595, 1411.8922006262549, 1411.8922006262549, 2, 0, 3),
+            2411: (1480.6957180093427, 1344.5421231912403, 947.5794160431797, 2, 0, 4),
+            2433: (0, 0, 0, 0, 0, 1),
+            2440: (1980.7666027852756, 1000.1946325219983, 645.8784438693258, 2, 0, 3),
+            2451: (0, 0, 0, 0, 0, 1)}
+        # Measure in one and in several chunks
+        for chunk_size in (500, 3):
+            skeletons = _measure_skeletons(expected.keys(), chunk_size)
+            self.assertEqual(sorted(expected.keys()), sorted(skeletons.keys()))
+            for skeleton_id, values in expected.iteritems():
+                m = skeletons[skeleton_id]
+                self.assertAlmostEqual(values[0], m.raw_cable, 6)
+                self.assertAlmostEqual(values[1], m.smooth_cable, 6)
+                self.assertAlmostEqual(values[2], m.principal_branch_cable, 6)
+                self.assertEqual(values[3:], (m.n_ends, m.n_branch, m.n_nodes))
+
     def test_skeleton_ancestry(self):
         skeleton_id = 361
 
@@ -2186,6 +2965,21 @@ class ViewPageTests(TestCase):
             self.assertEqual(orig_y, treenode[1])
             self.assertEqual(orig_z, treenode[2])
 
+    def test_node_update_invalid_id(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    't[0][0]': 'abc', 't[0][1]': 1, 't[0][2]': 2, 't[0][3]': 0,
+                    't[1][0]': 289, 't[1][1]': 3, 't[1][2]': 4, 't[1][3]': 0})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(1, parsed_response['updated'])
+        self.assertEqual([['treenode', 'abc', 'Invalid node']],
+                parsed_response['failed'])
+        treenode = Treenode.objects.get(id=289)
+        self.assertEqual((3, 4, 0), (treenode.location_x,
+                treenode.location_y, treenode.location_z))
+
     def test_node_update_many_nodes(self):
         self.fake_authentication()
         self.maxDiff = None
@@ -2247,13 +3041,30 @@ class ViewPageTests(TestCase):
         insert_params(param_dict, 2, y)
         insert_params(param_dict, 3, z)
 
+        orig_locations = dict((t.id, (t.location_x, t.location_y,
+                t.location_z)) for t in Treenode.objects.filter(id__in=node_id))
+
+        # Test2 can edit the nodes of test1 (2368, 2370), but not the ones of
+        # test0 (2372, 2374). Only the latter aren't moved.
         response = self.client.post(
                 '/%d/node/update' % self.test_project_id, param_dict)
         self.assertEqual(response.status_code, 200)
         parsed_response = json.loads(response.content)
-        expected_result = {'error': 'User test2 cannot edit all of the 4 '
-                           'unique objects from table treenode'}
-        self.assertEqual(expected_result['error'], parsed_response['error'])
+        self.assertEqual(2, parsed_response['updated'])
+        self.assertEqual('Could not update 2 of the 4 nodes',
+                parsed_response['error'])
+        self.assertEqual([
+                ['treenode', 2372, 'User test2 cannot edit this node'],
+                ['treenode', 2374, 'User test2 cannot edit this node']],
+                sorted(parsed_response['failed']))
+        for i, n_id in enumerate(node_id):
+            node = Treenode.objects.get(id=n_id)
+            location = (node.location_x, node.location_y, node.location_z)
+            if n_id in (2368, 2370):
+                self.assertEqual((x[i], y[i], z[i]), location)
+                self.assertEqual(self.test_user_id, node.editor_id)
+            else:
+                self.assertEqual(orig_locations[n_id], location)
 
     def test_node_list_without_active_skeleton(self):
         self.fake_authentication()
@@ -2338,6 +3149,43 @@ class ViewPageTests(TestCase):
         for row in expected_c_result:
             self.assertTrue(row in parsed_response[1])
 
+    @override_settings(NODE_LIST_CACHE='default', NODE_LIST_CACHE_TILE_SIZE=2048)
+    def test_node_list_with_cache(self):
+        self.fake_authentication()
+        params = {
+                'sid': 3,
+                'z': 0,
+                'top': 4625,
+                'left': 2860,
+                'width': 8000,
+                'height': 3450,
+                'zres': 9,
+                'as': 0,
+                'labels': False}
+        expected_row = [2374, 2372, 3310, 5190, 0, 5, -1, 2364, False]
+
+        # The first request fills the cache, the second is served from it
+        for i in range(2):
+            response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            self.assertEqual(11, len(parsed_response[0]))
+            self.assertEqual(1, len(parsed_response[1]))
+            self.assertTrue(expected_row in parsed_response[0])
+
+        # Moving a node has to invalidate the cached tiles
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    't[0][0]': 2394,
+                    't[0][1]': 3120,
+                    't[0][2]': 6040,
+                    't[0][3]': 0})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertTrue([2394, 2392, 3120, 6040, 0, 5, -1, 2388, True] in parsed_response[0])
+
     def test_textlabels_empty(self):
         self.fake_authentication()
         expected_result = {}
@@ -2427,6 +3275,46 @@ class ViewPageTests(TestCase):
         self.assertEqual(len(expected_result), len(parsed_response))
 
 
+    def test_compact_skeleton_binary(self):
+        self.fake_authentication()
+        skeleton_id = 235
+        url = '/%d/%d/1/0/compact-skeleton' % (self.test_project_id, skeleton_id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        nodes, connectors, tags = json.loads(response.content)
+
+        response = self.client.get(url, {'format': 'binary'})
+        self.assertEqual(response.status_code, 200)
+        data = response.content
+        magic, version, n_tables = struct.unpack_from('<4sHH', data, 0)
+        self.assertEqual(('CMSK', 1, 3), (magic, version, n_tables))
+
+        # Read the nodes table
+        offset = 8
+        name_length = struct.unpack_from('<H', data, offset)[0]
+        offset += 2
+        self.assertEqual('nodes', data[offset:offset + name_length])
+        offset += name_length
+        n_rows, n_columns = struct.unpack_from('<IH', data, offset)
+        offset += 6
+        self.assertEqual(len(nodes), n_rows)
+        columns = []
+        for i in range(n_columns):
+            name_length = struct.unpack_from('<H', data, offset)[0]
+            offset += 2
+            columns.append((data[offset:offset + name_length],
+                data[offset + name_length:offset + name_length + 3]))
+            offset += name_length + 3
+        self.assertEqual(('id', '<i8'), columns[0])
+        self.assertEqual(('parent_id', '<i8'), columns[1])
+        ids = numpy.frombuffer(data, dtype='<i8', count=n_rows, offset=offset)
+        parent_ids = numpy.frombuffer(data, dtype='<i8', count=n_rows,
+                offset=offset + 8 * n_rows)
+        self.assertEqual(sorted(n[0] for n in nodes), sorted(ids))
+        self.assertEqual(sorted(-1 if n[1] is None else n[1] for n in nodes),
+                sorted(parent_ids))
+
+
 class TreenodeTests(TestCase):
     fixtures = ['catmaid_testdata']
 
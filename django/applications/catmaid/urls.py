@@ -203,6 +203,7 @@ urlpatterns += patterns('catmaid.control.skeletonexport',
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/review$', 'export_review_skeleton'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/reviewed-nodes$', 'export_skeleton_reviews'),
     (r'^(?P<project_id>\d+)/skeletons/measure$', 'measure_skeletons'),
+    (r'^(?P<project_id>\d+)/skeletons/export/(?P<format>swc|json)$', 'export_skeletons_archive'),
     (r'^(?P<project_id>\d+)/skeleton/connectors-by-partner$', 'skeleton_connectors_by_partner'),
 )
 
@@ -383,6 +384,7 @@ urlpatterns += patterns('catmaid.control',
     # User analytics and proficiency
     (r'^useranalytics$', 'useranalytics.plot_useranalytics'),
     (r'^(?P<project_id>\d+)/userproficiency$', 'user_evaluation.evaluate_user'),
+    (r'^(?P<project_id>\d+)/userproficiency/(?P<job_id>[\w-]+)$', 'user_evaluation.evaluate_user_status'),
 
     (r'^(?P<project_id>\d+)/exportwidget$', ExportWidgetView.as_view() ),
 
@@ -120,12 +120,70 @@ MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
 # than this. This defaults to 50 Megabyte.
 GENERATED_FILES_MAXIMUM_SIZE = 52428800
 
+# The cropping tool and the treenode and connector exports load the tiles of
+# each slice concurrently with this many threads per process. A value smaller
+# than two makes them load tiles one after another.
+CROPPING_WORKERS = 4
+# Decoded tiles are kept in a cache so that overlapping crop jobs don't need to
+# load them again. This is its maximum size in Bytes per process, it defaults to
+# 256 Megabyte.
+CROPPING_TILE_CACHE_SIZE = 268435456
+
+# The tracing overlay's field of view queries can be answered from a cache of
+# treenodes and connectors, which is organized in square tiles per section.
+# Write operations invalidate cached tiles, therefore the cache has to be
+# shared by all processes that serve CATMAID (e.g. memcached). To enable it,
+# set NODE_LIST_CACHE to the name of such a cache in the CACHES setting.
+NODE_LIST_CACHE = None
+# The edge length of a cached tile in calibrated units (e.g. nm).
+NODE_LIST_CACHE_TILE_SIZE = 4096
+# Fields of view that span more tiles than this are queried directly.
+NODE_LIST_CACHE_MAX_TILES = 16
+# The time in seconds a tile stays in the cache.
+NODE_LIST_CACHE_TIMEOUT = 600
+
+# Moving at least this many nodes at once updates the summaries of the affected
+# skeletons once for all nodes, instead of once for each node.
+NODE_UPDATE_BULK_MIN_NODES = 200
+
+# The graph widget splits skeletons at low-confidence edges and into synapse
+# domains. Each process keeps the results for this many skeletons and split
+# settings in memory, so that only changed skeletons have to be split again.
+# Set it to 0 to disable this cache.
+GRAPH_SPLIT_CACHE_SIZE = 1000
+
+# User evaluations that run as Celery tasks analyze the review epochs of all
+# skeletons a user contributed to with this many worker processes. With 1, the
+# skeletons are evaluated by the task itself. Synchronous evaluations are
+# always done by the process that serves the request.
+USER_EVALUATION_PROCESSES = 4
+
+# The roles of users in projects and the users whose work they can edit are
+# cached per process for this many seconds. Changes to permissions or groups
+# made by other processes can take this long to take effect. Set it to 0 to
+# disable this cache.
+PERMISSION_CACHE_TIMEOUT = 30
+
+# The IDs of the relations and classes of a project are cached per process for
+# this many seconds. Relations and classes created by other processes, e.g.
+# when tracing is set up for a project, can take this long to be found. Set it
+# to 0 to disable this cache.
+ONTOLOGY_CACHE_TIMEOUT = 300
+
+# Tiles of HDF5 stacks are read from a pool of at most this many open files
+# per process. Data read from them and encoded tiles are cached per process,
+# up to the given number of bytes.
+HDF5_FILE_POOL_SIZE = 16
+HDF5_BLOCK_CACHE_SIZE = 268435456
+HDF5_TILE_CACHE_SIZE = 67108864
+
 # A sequence of modules that contain Celery tasks which we want Celery to know
 # about automatically.
 CELERY_IMPORTS = (
     'catmaid.control.cropping',
     'catmaid.control.roi',
     'catmaid.control.treenodeexport',
+    'catmaid.control.user_evaluation',
 )
 
 # We use django-pipeline to compress and reference JavaScript and CSS files. To
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Generates the tiled scale pyramids of a stack of images and a little
+# overview thumbnail for each section. The images are sorted by their file
+# name and the n-th image becomes section n of the stack, e.g.:
+#
+#   tile_pyramid.py --output tiles --tile-size 256 --thumbnail-size 192 *.tif
+#
+# Each image is read only once and its zoom levels are computed in memory by
+# averaging 2x2 pixels of the previous level. Zoom levels are generated until
+# a level fits into a single tile. Tiles at the right and bottom border are
+# padded with black to the full tile size. Tiles are written in the folder
+# layout of the tile source type passed with --layout:
+#
+#   1: <z>/<row>_<col>_<zoom>.<ext>, overview: <z>/small.<ext>
+#   4: <z>/<zoom>/<row>_<col>.<ext>, overview: <z>/small.<ext>
+#   5: <zoom>/<z>/<row>/<col>.<ext>, overview: small/<z>.<ext>
+#
+# Sections are processed in parallel by --jobs processes (all CPUs by
+# default). Finished sections are recorded in the file tile_pyramid.done in
+# the output folder and are skipped if the script is run again, so that an
+# interrupted run can be resumed.
+#
+# 16 bit gray scale images are scaled down to 8 bit. Requires numpy and PIL
+# (or pillow).
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+PROGRESS_FILE = 'tile_pyramid.done'
+
+TILE_PATHS = {
+    1: '%(z)s/%(row)s_%(col)s_%(zoom)s.%(ext)s',
+    4: '%(z)s/%(zoom)s/%(row)s_%(col)s.%(ext)s',
+    5: '%(zoom)s/%(z)s/%(row)s/%(col)s.%(ext)s',
+}
+
+THUMBNAIL_PATHS = {
+    1: '%(z)s/small.%(ext)s',
+    4: '%(z)s/small.%(ext)s',
+    5: 'small/%(z)s.%(ext)s',
+}
+
+FORMATS = {
+    'jpg': 'JPEG',
+    'png': 'PNG',
+}
+
+
+def read_section(path):
+    """ Returns the pixels of the image at <path> as (height, width) array
+    for gray scale images or as (height, width, 3) array for color images.
+    16 bit gray scale images are scaled down to 8 bit.
+    """
+    image = Image.open(path)
+    if image.mode.startswith('I'):
+        # PIL opens 16 bit images in one of the modes I;16, I;16B or I (32 bit
+        # integers). Converting them to L would clip all values above 255.
+        data = np.clip(np.asarray(image, dtype=np.int64), 0, 65535)
+        return ((data + 128) // 257).astype(np.uint8)
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB' if 'RGB' in image.mode else 'L')
+    return np.asarray(image)
+
+
+def downsample(data):
+    """ Halves the width and height of <data> by averaging blocks of 2x2
+    pixels. A last odd row or column is dropped.
+    """
+    height, width = data.shape[0] // 2, data.shape[1] // 2
+    data = data[:2 * height, :2 * width].astype(np.uint16)
+    result = data[0::2, 0::2] + data[1::2, 0::2] + \
+             data[0::2, 1::2] + data[1::2, 1::2]
+    return ((result + 2) // 4).astype(np.uint8)
+
+
+def pyramid(data, tile_size):
+    """ Returns the list of zoom levels of <data>, starting with <data>
+    itself. The last level fits into a single tile.
+    """
+    levels = [data]
+    while max(data.shape[:2]) > tile_size and min(data.shape[:2]) > 1:
+        data = downsample(data)
+        levels.append(data)
+    return levels
+
+
+def save(data, path, format, quality):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it in the meantime
+            if not os.path.isdir(directory):
+                raise
+    Image.fromarray(data).save(path, FORMATS[format], quality=quality)
+
+
+def write_tiles(data, z, zoom, options):
+    """ Cuts one zoom level of a section into tiles and writes them.
+    """
+    tile_size = options.tile_size
+    height, width = data.shape[:2]
+    tile = np.zeros((tile_size, tile_size) + data.shape[2:], dtype=np.uint8)
+    for row in range((height + tile_size - 1) // tile_size):
+        for col in range((width + tile_size - 1) // tile_size):
+            part = data[row * tile_size:(row + 1) * tile_size,
+                        col * tile_size:(col + 1) * tile_size]
+            if part.shape[:2] != tile.shape[:2]:
+                tile[:] = 0
+                tile[:part.shape[0], :part.shape[1]] = part
+                part = tile
+            path = TILE_PATHS[options.layout] % {'z': z, 'zoom': zoom,
+                    'row': row, 'col': col, 'ext': options.format}
+            save(part, os.path.join(options.output, path), options.format,
+                    options.quality)
+
+
+def write_thumbnail(levels, z, options):
+    """ Writes the overview of a section, whose longer side has the
+    thumbnail size. It is scaled down from the smallest zoom level that is at
+    least as large.
+    """
+    size = options.thumbnail_size
+    source = levels[0]
+    for level in levels:
+        if max(level.shape[:2]) >= size:
+            source = level
+    height, width = source.shape[:2]
+    scale = float(size) / max(height, width)
+    image = Image.fromarray(source).resize((max(1, int(round(width * scale))),
+            max(1, int(round(height * scale)))), Image.ANTIALIAS)
+    path = THUMBNAIL_PATHS[options.layout] % {'z': z, 'ext': options.format}
+    save(np.asarray(image), os.path.join(options.output, path),
+            options.format, options.quality)
+
+
+def tile_section(job):
+    """ Generates all tiles and the thumbnail of one section and returns its
+    index.
+    """
+    z, path, options = job
+    levels = pyramid(read_section(path), options.tile_size)
+    for zoom, data in enumerate(levels):
+        write_tiles(data, z, zoom, options)
+    write_thumbnail(levels, z, options)
+    return z
+
+
+def finished_sections(output):
+    """ Returns the set of sections a previous run finished.
+    """
+    path = os.path.join(output, PROGRESS_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(int(line) for line in f if line.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates the tiled "
+            "scale pyramids and overview thumbnails of a stack of images.")
+    parser.add_argument('images', nargs='+', help="The image files of the "
+            "sections, ordered by their file name")
+    parser.add_argument('--output', default='.',
+            help="The folder to write the tiles to (default: %(default)s)")
+    parser.add_argument('--tile-size', type=int, default=256,
+            help="The width and height of tiles (default: %(default)s)")
+    parser.add_argument('--thumbnail-size', type=int, default=192,
+            help="The longer side of overview thumbnails "
+            "(default: %(default)s)")
+    parser.add_argument('--layout', type=int, default=1,
+            choices=sorted(TILE_PATHS.keys()),
+            help="The tile source type (default: %(default)s)")
+    parser.add_argument('--format', default='jpg',
+            choices=sorted(FORMATS.keys()),
+            help="The file format of tiles (default: %(default)s)")
+    parser.add_argument('--quality', type=int, default=85,
+            help="The JPEG quality (default: %(default)s)")
+    parser.add_argument('--jobs', type=int,
+            default=multiprocessing.cpu_count(),
+            help="The number of sections processed in parallel "
+            "(default: %(default)s)")
+    options = parser.parse_args()
+
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    done = finished_sections(options.output)
+    jobs = [(z, path, options) for z, path in enumerate(sorted(options.images))
+            if z not in done]
+    if done:
+        sys.stderr.write("Skipping %s sections finished before\n" % len(done))
+
+    pool = multiprocessing.Pool(max(1, options.jobs))
+    try:
+        with open(os.path.join(options.output, PROGRESS_FILE), 'a') as progress:
+            for n, z in enumerate(pool.imap_unordered(tile_section, jobs)):
+                progress.write('%s\n' % z)
+                progress.flush()
+                sys.stderr.write("Finished section %s (%s/%s)\n" % (z, n + 1,
+                        len(jobs)))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.exit(1)
+    finally:
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()